@@ -1,18 +1,84 @@
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from models import setup_db, Actor, Movie, Casting, db
 import datetime
-from auth import AuthError, requires_auth
+from auth import AuthError, requires_auth, check_permissions, any_of, \
+    token_cache
+from bulk import bulk_items, batch_size_arg, upsert_actors, upsert_movies, \
+    insert_castings, summary, parse_date
+from listing import page_args, paginate, sort_arg, wants_stream, \
+    stream_ndjson, id_list_arg, encode_cursor, offset_args, fields_arg, \
+    with_sort_columns
+from filters import actor_filters, movie_filters, query_arg, \
+    ACTOR_SORT_COLUMNS, MOVIE_SORT_COLUMNS
+from search import SEARCHES, search_args, search_page
+from graph import cast_graph
+from stats import stats_report, top_arg
+from cache import ResponseCache, LocalBackend, RESPONSE_CACHE_SIZE
+from conditional import conditional
+from pool import pool_stats
+from serializers import json_response, model_columns, records
+from metrics import setup_metrics, exposition, PROMETHEUS_MIMETYPE
+from profiler import profile, profile_args
+from replicas import read_only
+
+
+def actor_tags(actor_ids):
+    """Returns the response cache tags of the actors
+    and of the movies they are cast in"""
+    movie_ids = {r[0] for r in db.session.query(Casting.movie_id)
+                 .filter(Casting.actor_id.in_(actor_ids))}
+    return [f'actor:{id}' for id in actor_ids] + \
+        [f'movie:{id}' for id in movie_ids]
+
+
+def movie_tags(movie_ids):
+    """Returns the response cache tags of the movies
+    and of the actors cast in them"""
+    actor_ids = {r[0] for r in db.session.query(Casting.actor_id)
+                 .filter(Casting.movie_id.in_(movie_ids))}
+    return [f'movie:{id}' for id in movie_ids] + \
+        [f'actor:{id}' for id in actor_ids]
+
+
+def created_cast_tags(items, results):
+    """Returns the response cache tags of the actors and movies
+    of the castings created by a bulk request"""
+    tags = set()
+    for item, result in zip(items, results):
+        if result['status'] == 'created':
+            tags.add(f'actor:{item["actor_id"]}')
+            tags.add(f'movie:{item["movie_id"]}')
+    return tags
+
+
+def updated_ids(results):
+    return [result['id'] for result in results
+            if result['status'] == 'updated']
+
+
+def created_tags(prefix, results):
+    """Returns the response cache tags of the rows created by a bulk
+    request, so that responses listing their ids as not found go"""
+    return [f'{prefix}:{result["id"]}' for result in results
+            if result['status'] == 'created']
 
 
 def create_app(test_config=None):
     """create and configure the app"""
     app = Flask(__name__)
     setup_db(app)
+    setup_metrics(app)
     CORS(app)
 
+    # in-process by default, share it between workers by replacing
+    # the backend with a cache.KeyValueBackend
+    response_cache = ResponseCache(
+        LocalBackend(RESPONSE_CACHE_SIZE) if RESPONSE_CACHE_SIZE else None)
+    app.extensions['response_cache'] = response_cache
+
     @app.after_request
     def after_request(response):
         response.headers.add('Access-Control-Allow-Headers',
@@ -25,26 +91,48 @@ def create_app(test_config=None):
 
     @app.route('/actors')
     @requires_auth('get:actors')
+    @read_only
+    @conditional('Actor')
+    @response_cache.cached('actors')
     def get_actors(jwt):
         """ Returns status code 200 and json 
-        {"success": True, "actors": actors}
-        where actors is the list of actors
+        {"success": True, "actors": actors, "next_cursor": cursor}
+        where actors is one page of the list of actors ordered by id,
+        or by ?sort= (id, name, age, gender, - for descending),
+        filtered with ?min_age=, ?max_age= and ?gender=,
+        with only the id and the ?fields= columns when given,
+        and cursor is the value to pass as ?cursor= for the next page
+        (null on the last page),
+        or every actor as NDJSON when requested with ?stream=1
+        or Accept: application/x-ndjson,
         or appropriate status code indicating 
         reason for failure
 
         Keyword arguments: 
         jwt -- json web token with permission
         """
+        order = sort_arg(ACTOR_SORT_COLUMNS, Actor.id)
+        columns = fields_arg(model_columns(Actor))
+        query = Actor.query.filter(*actor_filters()) \
+            .with_entities(*with_sort_columns(columns, order))
+        if wants_stream():
+            return stream_ndjson(query, order, columns)
+        limit, after = page_args(order)
         try:
-            actors = [actor.format() for actor in Actor.query.all()]
-            return jsonify({"success": True, "actors": actors}), 200
+            page, next_cursor = paginate(query, order, limit, after)
+            actors = records(page, columns)
+            return json_response({
+                "success": True,
+                "actors": actors,
+                "next_cursor": next_cursor}), 200
         except Exception:
             abort(404)
-        finally:
-            db.session.close()
 
     @app.route('/actors/<int:id>/movies')
     @requires_auth('get:actors')
+    @read_only
+    @conditional('Actor', 'Movie', 'Casting')
+    @response_cache.cached('actor:{id}')
     def get_actor_movies(jwt, id):
         """ Returns status code 200 and json 
         {"success": True, "actor_id": id, 
@@ -56,24 +144,134 @@ def create_app(test_config=None):
         id -- actor id
         """
         try:
-            actor = Actor.query.filter(Actor.id == id).one_or_none()
-            if actor is None:
+            filmography = Actor.filmography(id)
+            if filmography is None:
                 raise
-            movies_id_list = actor.format_long()['movies']
-            movies_title_tuple_list = db.session.query(Movie.title).filter(
-                Movie.id.in_(movies_id_list)).all()
-            movies_title_list = [
-                item for sublist in movies_title_tuple_list for item in sublist]
+            actor_name, movies_title_list = filmography
 
-            return jsonify({
+            return json_response({
                 "success": True,
                 "actor_id": id,
-                "actor": actor.format()['name'],
+                "actor": actor_name,
                 "movies": movies_title_list}), 200
         except Exception:
             abort(404)
-        finally:
-            db.session.close()
+
+    @app.route('/actors/movies', methods=["GET", "POST"])
+    @requires_auth('get:actors')
+    @read_only
+    @conditional('Actor', 'Movie', 'Casting')
+    @response_cache.cached(lambda: [f'actor:{id}' for id in id_list_arg()])
+    def get_actors_movies(jwt):
+        """ Returns status code 200 and json 
+        {"success": True, "actors": actors_list, "not_found": ids}
+        where actors_list holds {"actor_id": id, "actor": actor_name,
+        "movies": movies_list} for every requested actor
+        and ids lists the requested ids matching no actor
+        or appropriate status code indicating reason for failure
+
+        Keyword arguments: 
+        jwt -- json web token with permission
+        ids -- actor ids, as ?ids=1,2,3 or json body {"ids": [1, 2, 3]}
+        """
+        ids = id_list_arg()
+        try:
+            filmographies = Actor.filmographies(ids)
+            return json_response({
+                "success": True,
+                "actors": [{
+                    "actor_id": id,
+                    "actor": filmographies[id][0],
+                    "movies": filmographies[id][1]}
+                    for id in ids if id in filmographies],
+                "not_found": [id for id in ids if id not in filmographies]
+            }), 200
+        except Exception:
+            abort(500)
+
+    @app.route('/actors/<int:id>/costars')
+    @requires_auth('get:actors')
+    @read_only
+    @conditional('Actor', 'Casting')
+    @response_cache.cached('actors', 'cast')
+    def get_actor_costars(jwt, id):
+        """ Returns status code 200 and json
+        {"success": True, "actor_id": id, "costars": costars,
+        "next_cursor": cursor}
+        where costars is one page of the actors cast in a movie with
+        the actor, each with the number of movies they share
+        ("shared_movies"), most shared movies first,
+        and cursor is the value to pass as ?cursor= for the next page
+        (null on the last page),
+        or appropriate status code indicating reason for failure
+
+        Keyword arguments:
+        jwt -- json web token with permission
+        id -- actor id
+        """
+        limit, offset = offset_args()
+        try:
+            if Actor.query.get(id) is None:
+                raise
+            ranked = cast_graph.costars(id)
+            page = ranked[offset:offset + limit]
+            actors = {actor.id: actor for actor in
+                      Actor.query.filter(Actor.id.in_([a for a, _ in page]))}
+            costars = [dict(actors[actor_id].format(), shared_movies=shared)
+                       for actor_id, shared in page]
+            next_cursor = encode_cursor({'offset': offset + limit}) \
+                if len(ranked) > offset + limit else None
+            return json_response({
+                "success": True,
+                "actor_id": id,
+                "costars": costars,
+                "next_cursor": next_cursor}), 200
+        except Exception:
+            abort(404)
+
+    @app.route('/actors/<int:source>/path/<int:target>')
+    @requires_auth('get:actors', 'get:movies')
+    @read_only
+    @conditional('Actor', 'Movie', 'Casting')
+    @response_cache.cached('actors', 'movies', 'cast')
+    def get_actors_path(jwt, source, target):
+        """ Returns status code 200 and json
+        {"success": True, "degrees": degrees, "actors": actors,
+        "movies": movies}
+        where actors is a shortest chain of actors from source to target
+        and movies[i] a movie in which actors[i] and actors[i + 1] were
+        both cast, degrees being the number of movies in the chain
+        (null, with empty lists, when the actors are not connected
+        within ?max_degrees=),
+        or appropriate status code indicating reason for failure
+
+        Keyword arguments:
+        jwt -- json web token with permission
+        source -- actor id the chain starts from
+        target -- actor id the chain ends with
+        """
+        try:
+            max_degrees = int(request.args['max_degrees']) \
+                if 'max_degrees' in request.args else None
+        except ValueError:
+            abort(400)
+        try:
+            found = Actor.query.filter(Actor.id.in_([source, target])).count()
+            if found != len({source, target}):
+                raise
+            path = cast_graph.shortest_path(source, target, max_degrees)
+            actor_ids, movie_ids = path or ([], [])
+            actors = {actor.id: actor for actor in
+                      Actor.query.filter(Actor.id.in_(actor_ids))}
+            movies = {movie.id: movie for movie in
+                      Movie.query.filter(Movie.id.in_(movie_ids))}
+            return json_response({
+                "success": True,
+                "degrees": len(movie_ids) if path else None,
+                "actors": [actors[id].format() for id in actor_ids],
+                "movies": [movies[id].format() for id in movie_ids]}), 200
+        except Exception:
+            abort(404)
 
     @app.route('/actors', methods=["POST"])
     @requires_auth('post:actors')
@@ -93,11 +291,45 @@ def create_app(test_config=None):
             actor = Actor(name=data['name'],
                           age=data['age'], gender=data['gender'])
             actor.insert()
-            return jsonify({"success": True, "actor": actor.format()}), 200
+            response_cache.invalidate('actors', f'actor:{actor.id}')
+            return json_response({"success": True, "actor": actor.format()}), 200
         except Exception:
             abort(400)
-        finally:
-            db.session.close()
+
+    @app.route('/actors/bulk', methods=["POST"])
+    @requires_auth('post:actors')
+    def create_actors_bulk(jwt):
+        """ Returns status code 200 and json 
+        {"success": True, "summary": counts, "results": results}
+        where results holds the status (created, updated, exists,
+        not_found or invalid) and id of every item, in request order,
+        and counts the number of items per status.
+        Valid items are written in one transaction with multi-row
+        INSERTs of ?batch_size= rows
+        or appropriate status code indicating reason for failure
+
+        Keyword arguments: 
+        jwt -- json web token with permission
+        items -- json array (or NDJSON) of actors {"name", "age", "gender"},
+        items with an "id" update that actor and need patch:actors
+        """
+        items = bulk_items()
+        batch_size = batch_size_arg()
+        if any(isinstance(item, dict) and 'id' in item for item in items):
+            check_permissions('patch:actors', jwt)
+        try:
+            results = upsert_actors(items, batch_size)
+            db.session.commit()
+            response_cache.invalidate(
+                'actors', *actor_tags(updated_ids(results)),
+                *created_tags('actor', results))
+            return json_response({
+                "success": True,
+                "summary": summary(results),
+                "results": results}), 200
+        except Exception:
+            db.session.rollback()
+            abort(500)
 
     @app.route('/actors/<int:id>', methods=["PATCH"])
     @requires_auth('patch:actors')
@@ -123,11 +355,10 @@ def create_app(test_config=None):
             if 'gender' in data.keys():
                 actor.gender = data['gender']
             actor.update()
-            return jsonify({"success": True, "actor": actor.format()}), 200
+            response_cache.invalidate('actors', *actor_tags([id]))
+            return json_response({"success": True, "actor": actor.format()}), 200
         except Exception:
             abort(404)
-        finally:
-            db.session.close()
 
     @app.route('/actors/<int:id>', methods=["DELETE"])
     @requires_auth('delete:actors')
@@ -146,37 +377,61 @@ def create_app(test_config=None):
             actor = Actor.query.filter(Actor.id == id).one_or_none()
             if actor is None:
                 raise
+            tags = actor_tags([id])
             actor.delete()
-            return jsonify({"success": True, "deleted_id": id}), 200
+            cast_graph.actor_removed(id)
+            response_cache.invalidate('actors', 'cast', *tags)
+            return json_response({"success": True, "deleted_id": id}), 200
         except Exception:
             abort(404)
-        finally:
-            db.session.close()
 
     # Movie endpoints
 
     @app.route('/movies')
     @requires_auth('get:movies')
+    @read_only
+    @conditional('Movie')
+    @response_cache.cached('movies')
     def get_movies(jwt):
         """ Returns status code 200 and json 
-        {"success": True, "movies": movies}
-        where movies is the list of movies
+        {"success": True, "movies": movies, "next_cursor": cursor}
+        where movies is one page of the list of movies ordered by id,
+        or by ?sort= (id, title, release_date, - for descending),
+        filtered with ?year=, ?released_after=, ?released_before=
+        and ?title_prefix=,
+        with only the id and the ?fields= columns when given,
+        and cursor is the value to pass as ?cursor= for the next page
+        (null on the last page),
+        or every movie as NDJSON when requested with ?stream=1
+        or Accept: application/x-ndjson,
         or appropriate status code indicating 
         reason for failure
 
         Keyword arguments: 
         jwt -- json web token with permission
         """
+        order = sort_arg(MOVIE_SORT_COLUMNS, Movie.id)
+        columns = fields_arg(model_columns(Movie))
+        query = Movie.query.filter(*movie_filters()) \
+            .with_entities(*with_sort_columns(columns, order))
+        if wants_stream():
+            return stream_ndjson(query, order, columns)
+        limit, after = page_args(order)
         try:
-            movies = [movie.format() for movie in Movie.query.all()]
-            return jsonify({"success": True, "movies": movies}), 200
+            page, next_cursor = paginate(query, order, limit, after)
+            movies = records(page, columns)
+            return json_response({
+                "success": True,
+                "movies": movies,
+                "next_cursor": next_cursor}), 200
         except Exception:
             abort(404)
-        finally:
-            db.session.close()
 
     @app.route('/movies/<int:id>/actors')
     @requires_auth('get:movies')
+    @read_only
+    @conditional('Actor', 'Movie', 'Casting')
+    @response_cache.cached('movie:{id}')
     def get_movie_actors(jwt, id):
         """ Returns status code 200 and json 
          {"success": True, "movie_id": id, 
@@ -189,24 +444,50 @@ def create_app(test_config=None):
         id -- movie id
         """
         try:
-            movie = Movie.query.filter(Movie.id == id).one_or_none()
-            if movie is None:
+            cast_list = Movie.cast_list(id)
+            if cast_list is None:
                 raise
-            actors_id_list = movie.format_long()['actors']
-            actors_name_tuple_list = db.session.query(Actor.name).filter(
-                Actor.id.in_(actors_id_list)).all()
-            actors_name_list = [
-                item for sublist in actors_name_tuple_list for item in sublist]
+            movie_title, actors_name_list = cast_list
 
-            return jsonify({
+            return json_response({
                 "success": True,
                 "movie_id": id,
-                "movie": movie.format()['title'],
+                "movie": movie_title,
                 "actors": actors_name_list}), 200
         except Exception:
             abort(404)
-        finally:
-            db.session.close()
+
+    @app.route('/movies/actors', methods=["GET", "POST"])
+    @requires_auth('get:movies')
+    @read_only
+    @conditional('Actor', 'Movie', 'Casting')
+    @response_cache.cached(lambda: [f'movie:{id}' for id in id_list_arg()])
+    def get_movies_actors(jwt):
+        """ Returns status code 200 and json 
+        {"success": True, "movies": movies_list, "not_found": ids}
+        where movies_list holds {"movie_id": id, "movie": movie_title,
+        "actors": actors_list} for every requested movie
+        and ids lists the requested ids matching no movie
+        or appropriate status code indicating reason for failure
+
+        Keyword arguments: 
+        jwt -- json web token with permission
+        ids -- movie ids, as ?ids=1,2,3 or json body {"ids": [1, 2, 3]}
+        """
+        ids = id_list_arg()
+        try:
+            cast_lists = Movie.cast_lists(ids)
+            return json_response({
+                "success": True,
+                "movies": [{
+                    "movie_id": id,
+                    "movie": cast_lists[id][0],
+                    "actors": cast_lists[id][1]}
+                    for id in ids if id in cast_lists],
+                "not_found": [id for id in ids if id not in cast_lists]
+            }), 200
+        except Exception:
+            abort(500)
 
     @app.route('/movies', methods=["POST"])
     @requires_auth('post:movies')
@@ -223,14 +504,50 @@ def create_app(test_config=None):
         try:
             if 'title' not in data.keys() or 'release_date' not in data.keys():
                 raise
-            movie = Movie(title=data['title'],
-                          release_date=data['release_date'])
+            release_date = parse_date(data['release_date'])
+            if release_date is None:
+                raise
+            movie = Movie(title=data['title'], release_date=release_date)
             movie.insert()
-            return jsonify({"success": True, "movie": movie.format()}), 200
+            response_cache.invalidate('movies', f'movie:{movie.id}')
+            return json_response({"success": True, "movie": movie.format()}), 200
         except Exception:
             abort(400)
-        finally:
-            db.session.close()
+
+    @app.route('/movies/bulk', methods=["POST"])
+    @requires_auth('post:movies')
+    def create_movies_bulk(jwt):
+        """ Returns status code 200 and json 
+        {"success": True, "summary": counts, "results": results}
+        where results holds the status (created, updated, exists,
+        not_found or invalid) and id of every item, in request order,
+        and counts the number of items per status.
+        Valid items are written in one transaction with multi-row
+        INSERTs of ?batch_size= rows
+        or appropriate status code indicating reason for failure
+
+        Keyword arguments: 
+        jwt -- json web token with permission
+        items -- json array (or NDJSON) of movies {"title", "release_date"},
+        items with an "id" update that movie and need patch:movies
+        """
+        items = bulk_items()
+        batch_size = batch_size_arg()
+        if any(isinstance(item, dict) and 'id' in item for item in items):
+            check_permissions('patch:movies', jwt)
+        try:
+            results = upsert_movies(items, batch_size)
+            db.session.commit()
+            response_cache.invalidate(
+                'movies', *movie_tags(updated_ids(results)),
+                *created_tags('movie', results))
+            return json_response({
+                "success": True,
+                "summary": summary(results),
+                "results": results}), 200
+        except Exception:
+            db.session.rollback()
+            abort(500)
 
     @app.route('/movies/<int:id>', methods=["PATCH"])
     @requires_auth('patch:movies')
@@ -245,6 +562,10 @@ def create_app(test_config=None):
         id -- movie id to patch
         """
         data = request.get_json()
+        if isinstance(data, dict) and 'release_date' in data.keys():
+            release_date = parse_date(data['release_date'])
+            if release_date is None:
+                abort(400)
         try:
             movie = Movie.query.filter(Movie.id == id).one_or_none()
             if movie is None:
@@ -252,13 +573,12 @@ def create_app(test_config=None):
             if 'title' in data.keys():
                 movie.title = data['title']
             if 'release_date' in data.keys():
-                movie.release_date = data['release_date']
+                movie.release_date = release_date
             movie.update()
-            return jsonify({"success": True, "movie": movie.format()}), 200
+            response_cache.invalidate('movies', *movie_tags([id]))
+            return json_response({"success": True, "movie": movie.format()}), 200
         except Exception:
             abort(404)
-        finally:
-            db.session.close()
 
     @app.route('/movies/<int:id>', methods=["DELETE"])
     @requires_auth('delete:movies')
@@ -277,34 +597,51 @@ def create_app(test_config=None):
             movie = Movie.query.filter(Movie.id == id).one_or_none()
             if movie is None:
                 raise
+            tags = movie_tags([id])
             movie.delete()
-            return jsonify({"success": True, "deleted_id": id}), 200
+            cast_graph.movie_removed(id)
+            response_cache.invalidate('movies', 'cast', *tags)
+            return json_response({"success": True, "deleted_id": id}), 200
         except Exception:
             abort(404)
-        finally:
-            db.session.close()
 
     # Casting endpoints
 
     @app.route('/cast')
     @requires_auth('get:cast')
+    @read_only
+    @conditional('Casting')
+    @response_cache.cached('cast')
     def get_cast(jwt):
         """ Returns status code 200 and json 
-        {"success": True, "cast": cast_list}
-        where cast_list is the association between movies and actors
+        {"success": True, "cast": cast_list, "next_cursor": cursor}
+        where cast_list is one page of the association between movies
+        and actors ordered by id, with only the id and the ?fields=
+        columns when given, and cursor is the value to pass
+        as ?cursor= for the next page (null on the last page),
+        or every casting pair as NDJSON when requested with ?stream=1
+        or Accept: application/x-ndjson,
         or appropriate status code indicating 
         reason for failure
 
         Keyword arguments: 
         jwt -- json web token with permission
         """
+        order = sort_arg({'id': Casting.id}, Casting.id)
+        columns = fields_arg(model_columns(Casting))
+        query = Casting.query.with_entities(*columns)
+        if wants_stream():
+            return stream_ndjson(query, order, columns)
+        limit, after = page_args(order)
         try:
-            cast_list = [cast.format() for cast in Casting.query.all()]
-            return jsonify({"success": True, "cast": cast_list}), 200
+            page, next_cursor = paginate(query, order, limit, after)
+            cast_list = records(page, columns)
+            return json_response({
+                "success": True,
+                "cast": cast_list,
+                "next_cursor": next_cursor}), 200
         except Exception:
             abort(500)
-        finally:
-            db.session.close()
 
     @app.route('/cast', methods=["POST"])
     @requires_auth('post:cast')
@@ -324,18 +661,201 @@ def create_app(test_config=None):
             cast = Casting(actor_id=data['actor_id'],
                            movie_id=data['movie_id'])
             cast.insert()
-            return jsonify({"success": True, "cast": cast.format()}), 200
+            cast_graph.castings_added([(cast.actor_id, cast.movie_id)])
+            response_cache.invalidate(
+                'cast', f'actor:{cast.actor_id}', f'movie:{cast.movie_id}')
+            return json_response({"success": True, "cast": cast.format()}), 200
+        except Exception:
+            abort(400)
+
+    @app.route('/cast/bulk', methods=["POST"])
+    @requires_auth('post:cast')
+    def create_castings_bulk(jwt):
+        """ Returns status code 200 and json 
+        {"success": True, "summary": counts, "results": results}
+        where results holds the status (created, updated, exists,
+        not_found or invalid) and id of every item, in request order,
+        and counts the number of items per status.
+        Valid items are written in one transaction with multi-row
+        INSERTs of ?batch_size= rows
+        or appropriate status code indicating reason for failure
+
+        Keyword arguments: 
+        jwt -- json web token with permission
+        items -- json array (or NDJSON) of casting pairs
+        {"actor_id", "movie_id"}, pairs already cast are left as they are
+        """
+        items = bulk_items()
+        batch_size = batch_size_arg()
+        try:
+            results = insert_castings(items, batch_size)
+            db.session.commit()
+            created = [(item['actor_id'], item['movie_id'])
+                       for item, result in zip(items, results)
+                       if result['status'] == 'created']
+            if created:
+                cast_graph.castings_added(created)
+            response_cache.invalidate(
+                'cast', *created_cast_tags(items, results))
+            return json_response({
+                "success": True,
+                "summary": summary(results),
+                "results": results}), 200
         except Exception:
+            db.session.rollback()
+            abort(500)
+
+    # Search endpoint
+
+    @app.route('/search')
+    @requires_auth(any_of('get:actors', 'get:movies'))
+    @read_only
+    @conditional('Actor', 'Movie')
+    @response_cache.cached('actors', 'movies')
+    def search(jwt):
+        """ Returns status code 200 and json
+        {"success": True, "actors": actors, "movies": movies,
+        "next_cursor": cursor}
+        where actors and movies are one page of the actors whose name
+        and of the movies whose title contain ?q=, best match first,
+        and cursor is the value to pass as ?cursor= for the next page
+        (null on the last page),
+        or appropriate status code indicating
+        reason for failure
+
+        Keyword arguments:
+        jwt -- json web token with permission get:actors, get:movies
+        or both, only the permitted result types are searched
+        """
+        q = query_arg()
+        if q is None:
             abort(400)
-        finally:
-            db.session.close()
+        limit, offsets = search_args(q)
+        if 'type' in request.args:
+            check_permissions(
+                [SEARCHES[name][2] for name in offsets], jwt, g.permissions)
+        try:
+            results = {}
+            next_offsets = {}
+            for name, (model, column, permission) in SEARCHES.items():
+                if permission not in g.permissions:
+                    continue
+                results[name] = []
+                if name not in offsets:
+                    continue
+                items, next_offset = search_page(
+                    model, column, q, offsets[name], limit)
+                results[name] = [item.format() for item in items]
+                if next_offset is not None:
+                    next_offsets[name] = next_offset
+            next_cursor = encode_cursor({'q': q, 'offsets': next_offsets}) \
+                if next_offsets else None
+            return json_response({
+                "success": True,
+                **results,
+                "next_cursor": next_cursor}), 200
+        except Exception:
+            abort(500)
+
+    # Stats endpoint
+
+    @app.route('/stats')
+    @requires_auth('get:actors', 'get:movies')
+    @read_only
+    @conditional('Actor', 'Movie', 'Casting')
+    @response_cache.cached('actors', 'movies', 'cast')
+    def get_stats(jwt):
+        """ Returns status code 200 and json
+        {"success": True, "counts": counts,
+        "average_cast_size": cast_size,
+        "average_filmography_size": filmography_size,
+        "movies_per_year": years, "top_actors": actors,
+        "largest_casts": movies}
+        where counts holds the number of actors, movies and castings,
+        the averages are the number of castings per movie and per actor
+        (null without movies or actors), years lists {"year", "movies"}
+        in year order, actors the ?top= actors cast in most movies
+        {"id", "name", "movies"} and movies the ?top= movies with most
+        actors {"id", "title", "actors"}, all read from the summary
+        counters kept up to date by every write,
+        or appropriate status code indicating reason for failure
+
+        Keyword arguments:
+        jwt -- json web token with permission
+        """
+        top = top_arg()
+        try:
+            return json_response({"success": True, **stats_report(top)}), 200
+        except Exception:
+            abort(500)
+
+    # Debug endpoints
+
+    @app.route('/_debug/pool')
+    @requires_auth('get:debug')
+    def get_pool_stats(jwt):
+        """ Returns status code 200 and json
+        {"success": True, "pool": stats, "replicas": replicas}
+        where stats describes the database connection pool of the
+        worker answering: its size, the connections checked out and
+        in overflow, and how often and how long checkouts waited,
+        and replicas lists the health, lag and pool of each replica
+
+        Keyword arguments:
+        jwt -- json web token with permission
+        """
+        replicas = app.extensions['replicas']
+        return json_response({
+            "success": True,
+            "pool": pool_stats(db.engine.pool),
+            "replicas": replicas.stats() if replicas else []}), 200
+
+    @app.route('/_debug/profile')
+    @requires_auth('get:profile')
+    def get_profile(jwt):
+        """ Returns status code 200 and, as text, the collapsed stacks
+        ("outer;inner count" lines, ready for flamegraph.pl or speedscope)
+        sampled every ?interval_ms= from the other threads of the worker
+        answering during ?seconds=, with the number of samples in the
+        X-Profile-Samples header,
+        or status code 409 while another profile runs on the worker,
+        or appropriate status code indicating reason for failure
+
+        Keyword arguments:
+        jwt -- json web token with permission
+        """
+        seconds, interval = profile_args()
+        profiler = profile(seconds, interval)
+        if profiler is None:
+            abort(409)
+        response = app.response_class(profiler.collapsed(),
+                                      mimetype='text/plain')
+        response.headers['X-Profile-Samples'] = str(profiler.samples)
+        return response
+
+    @app.route('/metrics')
+    @requires_auth('get:metrics')
+    def get_metrics(jwt):
+        """ Returns status code 200 and, in the Prometheus text format,
+        the histograms of the latency, of the time spent in auth, SQL and
+        serialization and of the number of SQL statements of the requests
+        answered by this worker, per route, and the counters of its
+        connection pool and of its verified token cache
+        or appropriate status code indicating reason for failure
+
+        Keyword arguments:
+        jwt -- json web token with permission
+        """
+        return app.response_class(
+            exposition(pool_stats(db.engine.pool), token_cache.stats()),
+            mimetype=PROMETHEUS_MIMETYPE)
 
     # Error Handling
 
     @app.errorhandler(400)
     def unprocessable(error):
         """ error handling for bad request"""
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 400,
             "message": "Bad request"
@@ -344,16 +864,25 @@ def create_app(test_config=None):
     @app.errorhandler(404)
     def not_found(error):
         """ error handling for entity not found"""
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 404,
             "message": "Resource not found"
         }), 404
 
+    @app.errorhandler(409)
+    def conflict(error):
+        """ error handling for a request conflicting with one running"""
+        return json_response({
+            "success": False,
+            "error": 409,
+            "message": "Conflict"
+        }), 409
+
     @app.errorhandler(500)
     def not_found(error):
         """ error handling for server error"""
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 500,
             "message": "Server error"
@@ -362,7 +891,7 @@ def create_app(test_config=None):
     @app.errorhandler(AuthError)
     def auth_error(error):
         """ error handling for AuthError 401 or 403"""
-        return jsonify({
+        return json_response({
             'success': False,
             'error': error.status_code,
             'message': error.error['description']
@@ -1,14 +1,42 @@
-import json
-from flask import request, _request_ctx_stack
+from flask import request, g, _request_ctx_stack
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+from jwks import JWKSKeyStore, URLKeySource, FileKeySource
+from cache import LRUCache
+from metrics import timed
+import hashlib
 import os
 
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = os.environ['ALGORITHMS']
 API_AUDIENCE = os.environ['API_AUDIENCE']
+JWKS_FILE = os.environ.get('JWKS_FILE')
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 600))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', 300))
+
+
+'''
+Process-wide JWKS key store
+Reads the keys from JWKS_FILE when set, from the Auth0 tenant otherwise
+'''
+
+if JWKS_FILE:
+    key_source = FileKeySource(JWKS_FILE)
+else:
+    key_source = URLKeySource(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+key_store = JWKSKeyStore(key_source, default_ttl=JWKS_TTL)
+
+
+'''
+Verified token cache
+Decoded payloads of tokens that passed verification, keyed by the
+sha256 digest of the raw token and kept until the token expires
+(TOKEN_CACHE_TTL seconds at most)
+'''
+
+token_cache = LRUCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
 
 
 '''
@@ -59,13 +87,88 @@ def get_token_auth_header():
     return token
 
 
-def check_permissions(permission, payload):
-    """Raises an AuthError if the requested permission string
-    is not in the payload permissions array
+'''
+Permission requirements
+Compiled once when a view is decorated and evaluated against
+the frozen permission set of the token
+'''
+
+
+class PermissionRequirement:
+    """A set of permissions of which all (or any) must be granted,
+    optionally combined with nested requirements
+    Keyword arguments:
+    permissions: permission strings or nested requirements
+    require_all: True for all-of, False for any-of
+    """
+
+    def __init__(self, permissions, require_all=True):
+        self.permissions = frozenset(
+            p for p in permissions if isinstance(p, str))
+        self.requirements = tuple(
+            compile_permission(p) for p in permissions
+            if not isinstance(p, str))
+        self.require_all = require_all
+
+    def is_satisfied_by(self, granted):
+        """Returns True if the granted permission set meets the requirement
+        Keyword arguments:
+        granted: frozenset of the permissions in the token
+        """
+        if self.require_all:
+            return self.permissions <= granted and all(
+                r.is_satisfied_by(granted) for r in self.requirements)
+        return not self.permissions.isdisjoint(granted) or any(
+            r.is_satisfied_by(granted) for r in self.requirements)
+
+    def __repr__(self):
+        mode = 'all_of' if self.require_all else 'any_of'
+        items = sorted(self.permissions) + list(self.requirements)
+        return f'{mode}({", ".join(map(repr, items))})'
+
+
+def all_of(*permissions):
+    """Requirement met when every given permission is granted"""
+    return PermissionRequirement(permissions, require_all=True)
+
+
+def any_of(*permissions):
+    """Requirement met when at least one given permission is granted"""
+    return PermissionRequirement(permissions, require_all=False)
+
+
+def compile_permission(permission):
+    """Returns the PermissionRequirement for a permission string,
+    an iterable of permissions (all required) or a requirement
+    Keyword arguments:
+    permission: string permission (i.e. 'post:drink'), iterable or
+    requirement built with all_of / any_of
+    """
+    if isinstance(permission, PermissionRequirement):
+        return permission
+    if isinstance(permission, str):
+        return all_of(permission)
+    return all_of(*permission)
+
+
+def permission_set(payload):
+    """Returns the permissions of the decoded payload as a frozenset,
+    None if the payload has no permissions claim
+    """
+    if 'permissions' not in payload:
+        return None
+    return frozenset(payload['permissions'])
+
+
+def check_permissions(permission, payload, granted=None):
+    """Raises an AuthError if the requested permission requirement
+    is not met by the payload permissions array
     returns true otherwise
     Keyword arguments:
-    permission: string permission (i.e. 'post:drink')
+    permission: string permission (i.e. 'post:drink'), iterable
+    or requirement built with all_of / any_of
     payload: decoded jwt payload
+    granted: precomputed permission set of the payload (optional)
     """
     if 'permissions' not in payload:
         raise AuthError({
@@ -73,7 +176,9 @@ def check_permissions(permission, payload):
             'description': 'Permissions not included in JWT.'
         }, 400)
 
-    if permission not in payload['permissions']:
+    if granted is None:
+        granted = permission_set(payload)
+    if not compile_permission(permission).is_satisfied_by(granted):
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -88,8 +193,6 @@ def verify_decode_jwt(token):
     Keyword arguments:
     token: a json web token (string)
     """
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
     rsa_key = {}
     if 'kid' not in unverified_header:
@@ -98,15 +201,15 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    key = key_store.get_key(unverified_header['kid'])
+    if key is not None:
+        rsa_key = {
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key.get('use', 'sig'),
+            'n': key['n'],
+            'e': key['e']
+        }
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -142,19 +245,44 @@ def verify_decode_jwt(token):
     }, 400)
 
 
-def requires_auth(permission=''):
+def get_verified_payload(token):
+    """Returns the decoded payload of the token and its permission set,
+    from the verified token cache when the same token was verified
+    before, from verify_decode_jwt otherwise
+    Keyword arguments:
+    token: a json web token (string)
+    """
+    cache_key = hashlib.sha256(token.encode()).digest()
+    entry = token_cache.get(cache_key)
+    if entry is None:
+        payload = verify_decode_jwt(token)
+        entry = (payload, permission_set(payload))
+        token_cache.set(cache_key, entry, payload.get('exp'))
+    return entry
+
+
+def requires_auth(*permissions):
     """Gets the token, decodes the jwt, validate claims and permissions
     and returns
     the decorator which passes the decoded payload to the decorated method
     Keyword arguments:
-    permission: string permission (i.e. 'post:drink')
+    permissions: string permission (i.e. 'post:drink'), several
+    permissions which are all required, or a requirement built
+    with all_of / any_of
     """
+    if len(permissions) == 1:
+        requirement = compile_permission(permissions[0])
+    else:
+        requirement = compile_permission(permissions or '')
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with timed('auth'):
+                token = get_token_auth_header()
+                payload, granted = get_verified_payload(token)
+                check_permissions(requirement, payload, granted)
+            g.permissions = granted
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,420 @@
+'''
+API benchmark
+Seeds a database with --castings castings (with the fixtures of
+benchmarks/fixtures.py), then sends --requests requests, after --warmup
+ones, to every route of app.py with a locally minted token granting
+every permission, and reports per route the throughput and the mean,
+p50, p99 and max latency in milliseconds. Two targets:
+    client    the Flask test client, in this process, one request at a time
+    gunicorn  gunicorn app:app started on a free port, sent --concurrency
+              requests at a time over keep-alive HTTP connections
+The results are written as JSON to --output, for benchmarks/compare.py:
+
+    python benchmarks/api.py --castings 100000 --output before.json
+    git checkout my-branch
+    python benchmarks/api.py --castings 100000 --output after.json
+    python benchmarks/compare.py before.json after.json
+
+The database is a scratch SQLite file unless --database-url is given;
+its tables are emptied first, which --wipe has to confirm. The response
+cache is off (RESPONSE_CACHE_SIZE=0) unless set in the environment;
+set TOKEN_CACHE_SIZE=0 to time the full token verification of every
+request.
+'''
+
+import argparse
+import datetime
+import http.client
+import itertools
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fixtures import Volumes, benchmark_environment, \
+    seed_app  # noqa: E402
+
+
+BULK_SIZE = 100
+TARGETS = ('client', 'gunicorn')
+
+
+def ids(volumes, i, pick, count=10):
+    return [pick(i * count + j) for j in range(count)]
+
+
+def ids_arg(values):
+    return ','.join(str(value) for value in values)
+
+
+'''
+Routes
+One request factory per route of app.py, returning the (path, json body)
+of the i-th request of the route for the seeded volumes. Reads come
+first and deletes last so that writes do not remove rows reads expect.
+'''
+
+ROUTES = [
+    ('GET', '/actors', lambda v, i: (
+        f'/actors?after_id={v.actor(i)}', None)),
+    ('GET', '/actors/<int:id>/movies', lambda v, i: (
+        f'/actors/{v.actor(i)}/movies', None)),
+    ('GET', '/actors/movies', lambda v, i: (
+        f'/actors/movies?ids={ids_arg(ids(v, i, v.actor))}', None)),
+    ('POST', '/actors/movies', lambda v, i: (
+        '/actors/movies', {'ids': ids(v, i, v.actor)})),
+    ('GET', '/actors/<int:id>/costars', lambda v, i: (
+        f'/actors/{v.actor(i)}/costars', None)),
+    ('GET', '/actors/<int:source>/path/<int:target>', lambda v, i: (
+        f'/actors/{v.actor(i)}/path/{v.actor(i + 1)}', None)),
+    ('GET', '/movies', lambda v, i: (
+        f'/movies?after_id={v.movie(i)}', None)),
+    ('GET', '/movies/<int:id>/actors', lambda v, i: (
+        f'/movies/{v.movie(i)}/actors', None)),
+    ('GET', '/movies/actors', lambda v, i: (
+        f'/movies/actors?ids={ids_arg(ids(v, i, v.movie))}', None)),
+    ('POST', '/movies/actors', lambda v, i: (
+        '/movies/actors', {'ids': ids(v, i, v.movie)})),
+    ('GET', '/cast', lambda v, i: (
+        f'/cast?after_id={1 + i * 7919 % v.castings}', None)),
+    ('GET', '/search', lambda v, i: (
+        f'/search?q={("garcia", "midnight", "ada", "storm")[i % 4]}', None)),
+    ('GET', '/stats', lambda v, i: ('/stats', None)),
+    ('GET', '/_debug/pool', lambda v, i: ('/_debug/pool', None)),
+    ('GET', '/metrics', lambda v, i: ('/metrics', None)),
+    ('POST', '/actors', lambda v, i: ('/actors', {
+        'name': f'Benchmark Actor {i}', 'age': 20 + i % 60,
+        'gender': 'female'})),
+    ('POST', '/actors/bulk', lambda v, i: ('/actors/bulk', [
+        {'name': f'Benchmark Actor {i}.{j}', 'age': 20 + j % 60,
+         'gender': 'male'} for j in range(BULK_SIZE)])),
+    ('PATCH', '/actors/<int:id>', lambda v, i: (
+        f'/actors/{v.actor(i)}', {'age': 20 + i % 60})),
+    ('POST', '/movies', lambda v, i: ('/movies', {
+        'title': f'Benchmark Movie {i}', 'release_date': '2001-01-01'})),
+    ('POST', '/movies/bulk', lambda v, i: ('/movies/bulk', [
+        {'title': f'Benchmark Movie {i}.{j}',
+         'release_date': f'{1950 + j % 70}-06-01'}
+        for j in range(BULK_SIZE)])),
+    ('PATCH', '/movies/<int:id>', lambda v, i: (
+        f'/movies/{v.movie(i)}', {'release_date': f'{1950 + i % 70}-03-01'})),
+    ('POST', '/cast', lambda v, i: ('/cast', {
+        'actor_id': v.actor(i), 'movie_id': v.blank_movie(i)})),
+    ('POST', '/cast/bulk', lambda v, i: ('/cast/bulk', [
+        {'actor_id': v.actor(i * BULK_SIZE + j),
+         'movie_id': v.blank_movie(i)} for j in range(BULK_SIZE)])),
+    ('DELETE', '/actors/<int:id>', lambda v, i: (
+        f'/actors/{v.spare_actor(i)}', None)),
+    ('DELETE', '/movies/<int:id>', lambda v, i: (
+        f'/movies/{v.spare_movie(i)}', None)),
+]
+
+SKIPPED = {
+    ('GET', '/_debug/profile'): 'holds the worker for ?seconds=',
+}
+
+
+def unbenchmarked_routes(app):
+    """Returns the 'METHOD rule' of the app routes neither in ROUTES
+    nor in SKIPPED"""
+    covered = {(method, rule) for method, rule, _ in ROUTES} | set(SKIPPED)
+    missing = []
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint == 'static':
+            continue
+        for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+            if (method, rule.rule) not in covered:
+                missing.append(f'{method} {rule.rule}')
+    return missing
+
+
+# Measurements
+
+
+def percentile(ordered, q):
+    """Nearest-rank percentile of the sorted values"""
+    if not ordered:
+        return None
+    return ordered[max(int(q * len(ordered) + 0.999999) - 1, 0)]
+
+
+def summarize(target, route, latencies, statuses, elapsed):
+    ordered = sorted(latencies)
+    ms = (lambda value: None if value is None else round(value * 1000, 3))
+    return {
+        'target': target,
+        'route': route,
+        'requests': len(ordered),
+        'errors': sum(count for status, count in statuses.items()
+                      if not 200 <= status < 300),
+        'statuses': {str(status): count
+                     for status, count in sorted(statuses.items())},
+        'throughput': round(len(ordered) / elapsed, 2) if elapsed else None,
+        'mean_ms': ms(sum(ordered) / len(ordered)) if ordered else None,
+        'p50_ms': ms(percentile(ordered, 0.5)),
+        'p99_ms': ms(percentile(ordered, 0.99)),
+        'max_ms': ms(ordered[-1]) if ordered else None}
+
+
+def print_result(result):
+    errors = f'  {result["errors"]} errors {result["statuses"]}' \
+        if result['errors'] else ''
+    print(f'{result["target"]:<9} {result["route"]:<45} '
+          f'{result["throughput"]:>9.1f} {result["p50_ms"]:>9.2f} '
+          f'{result["p99_ms"]:>9.2f}{errors}', flush=True)
+
+
+def run_client(app, volumes, headers, args, indexes):
+    client = app.test_client()
+    results = []
+    for method, rule, factory in ROUTES:
+        route = f'{method} {rule}'
+        latencies = []
+        statuses = Counter()
+        elapsed = 0.0
+        for n in range(args.warmup + args.requests):
+            path, body = factory(volumes, next(indexes[route]))
+            started = time.perf_counter()
+            response = client.open(path, method=method, headers=headers,
+                                   json=body)
+            response.get_data()
+            duration = time.perf_counter() - started
+            if n >= args.warmup:
+                latencies.append(duration)
+                statuses[response.status_code] += 1
+                elapsed += duration
+        results.append(summarize('client', route, latencies, statuses,
+                                 elapsed))
+        print_result(results[-1])
+    return results
+
+
+class HTTPClient:
+    """Keep-alive HTTP connection to the server, reopened when the
+    server closes it (sync workers close every connection)"""
+
+    def __init__(self, port, headers):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                     timeout=300)
+        self.headers = headers
+
+    def request(self, method, path, body):
+        """Returns the status of the response, 0 on connection errors"""
+        data = None if body is None else json.dumps(body)
+        try:
+            self.connection.request(method, path, body=data,
+                                    headers=self.headers)
+            response = self.connection.getresponse()
+            response.read()
+            if response.will_close:
+                self.connection.close()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            return 0
+
+    def close(self):
+        self.connection.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(port, headers, options):
+    """Starts gunicorn app:app on the port and returns its process once
+    it answers
+    Keyword arguments:
+    port: local port to bind
+    headers: headers of the readiness requests, with the token
+    options: other gunicorn command line options
+    """
+    command = [sys.executable, '-c',
+               'from gunicorn.app.wsgiapp import run; run()', 'app:app',
+               '--bind', f'127.0.0.1:{port}',
+               '--timeout', '300', '--log-level', 'warning', *options]
+    server = subprocess.Popen(command, cwd=ROOT, env=os.environ.copy())
+    client = HTTPClient(port, headers)
+    deadline = time.monotonic() + 60
+    while client.request('GET', '/_debug/pool', None) != 200:
+        if server.poll() is not None or time.monotonic() > deadline:
+            stop_gunicorn(server)
+            sys.exit('gunicorn did not start')
+        time.sleep(0.2)
+    client.close()
+    return server
+
+
+def stop_gunicorn(server):
+    server.terminate()
+    try:
+        server.wait(30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def run_gunicorn(volumes, headers, args, indexes):
+    port = free_port()
+    server = start_gunicorn(port, headers, [
+        '--workers', str(args.workers), '--worker-class', args.worker_class,
+        '--threads', str(args.threads)])
+    results = []
+    try:
+        for method, rule, factory in ROUTES:
+            route = f'{method} {rule}'
+            client = HTTPClient(port, headers)
+            for _ in range(args.warmup):
+                client.request(method,
+                               *factory(volumes, next(indexes[route])))
+            client.close()
+
+            latencies = []
+            statuses = Counter()
+            lock = threading.Lock()
+            remaining = itertools.count(args.requests, -1)
+
+            def send():
+                client = HTTPClient(port, headers)
+                while next(remaining) > 0:
+                    path, body = factory(volumes, next(indexes[route]))
+                    started = time.perf_counter()
+                    status = client.request(method, path, body)
+                    duration = time.perf_counter() - started
+                    with lock:
+                        latencies.append(duration)
+                        statuses[status] += 1
+                client.close()
+
+            threads = [threading.Thread(target=send)
+                       for _ in range(args.concurrency)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            results.append(summarize('gunicorn', route, latencies, statuses,
+                                     elapsed))
+            print_result(results[-1])
+    finally:
+        stop_gunicorn(server)
+    return results
+
+
+def git_revision():
+    """Returns the commit of the tree benchmarked, with a -dirty suffix
+    when it has uncommitted changes"""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            text=True, stderr=subprocess.DEVNULL).strip()
+        dirty = subprocess.run(
+            ['git', 'diff', '--quiet', 'HEAD', '--', '*.py'],
+            cwd=ROOT, stderr=subprocess.DEVNULL).returncode != 0
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--castings', type=int, default=100000,
+                        help='castings seeded, e.g. 1000, 100000, 1000000')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='measured requests per route and target')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='unmeasured requests sent first per route')
+    parser.add_argument('--target', choices=TARGETS + ('both',),
+                        default='both')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='requests in flight against gunicorn')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--worker-class', default='sync')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--database-url',
+                        help='database to seed, a scratch SQLite file '
+                             'when not given')
+    parser.add_argument('--wipe', action='store_true',
+                        help='confirm that the tables of --database-url '
+                             'may be emptied')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed of the generated data')
+    parser.add_argument('--output', help='JSON results file')
+    args = parser.parse_args()
+    if args.database_url and not args.wipe:
+        parser.error('seeding empties the tables of --database-url, '
+                     'pass --wipe to confirm')
+    targets = TARGETS if args.target == 'both' else (args.target,)
+
+    scratch = tempfile.TemporaryDirectory()
+    headers = {'Content-Type': 'application/json',
+               'Authorization': benchmark_environment(
+                   args.database_url or 'sqlite:///' +
+                   os.path.join(scratch.name, 'benchmark.sqlite'))}
+
+    from app import app
+    from models import db
+
+    missing = unbenchmarked_routes(app)
+    if missing:
+        sys.exit('routes missing from benchmarks/api.py ROUTES: ' +
+                 ', '.join(missing))
+
+    # every target consumes its own spare rows
+    volumes = Volumes(args.castings,
+                      (args.warmup + args.requests) * len(targets))
+    seed_seconds = seed_app(app, volumes, args.seed)
+    print(f'seeded {volumes.as_dict()} in {seed_seconds:.1f}s', flush=True)
+
+    print(f'{"target":<9} {"route":<45} {"req/s":>9} {"p50 ms":>9} '
+          f'{"p99 ms":>9}')
+    indexes = {f'{method} {rule}': itertools.count()
+               for method, rule, _ in ROUTES}
+    results = []
+    for target in targets:
+        if target == 'client':
+            results += run_client(app, volumes, headers, args, indexes)
+        else:
+            results += run_gunicorn(volumes, headers, args, indexes)
+
+    report = {
+        'meta': {
+            'commit': git_revision(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': db.engine.dialect.name,
+            'volumes': volumes.as_dict(),
+            'seed_seconds': round(seed_seconds, 1),
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'concurrency': args.concurrency,
+            'gunicorn': {'workers': args.workers,
+                         'worker_class': args.worker_class,
+                         'threads': args.threads},
+            'environment': {name: os.environ.get(name) for name in (
+                'RESPONSE_CACHE_SIZE', 'TOKEN_CACHE_SIZE', 'DB_POOL_SIZE',
+                'DB_MAX_OVERFLOW')},
+            'skipped': {f'{method} {rule}': reason
+                        for (method, rule), reason in SKIPPED.items()}},
+        'results': results}
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=2)
+            out.write('\n')
+    scratch.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+'''
+Benchmark comparison
+Lines up two result files of benchmarks/api.py route by route and
+prints the change of throughput and of the p50 and p99 latencies.
+Routes whose p50 or p99 grew by more than --threshold percent, or
+that answer with errors they did not have, are flagged as regressions
+and make the command exit with status 1.
+
+    python benchmarks/compare.py before.json after.json --threshold 10
+'''
+
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path) as result_file:
+        report = json.load(result_file)
+    return report['meta'], {(result['target'], result['route']): result
+                            for result in report['results']}
+
+
+def change(before, after):
+    """Returns the relative change in percent, None when undefined"""
+    if not before or after is None:
+        return None
+    return (after - before) / before * 100
+
+
+def percent(value):
+    return f'{value:+7.1f}%' if value is not None else '       -'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='latency growth, in percent, flagged '
+                             'as a regression')
+    args = parser.parse_args()
+
+    before_meta, before = load(args.before)
+    after_meta, after = load(args.after)
+    print(f'before {before_meta["commit"]} {before_meta["volumes"]}')
+    print(f'after  {after_meta["commit"]} {after_meta["volumes"]}')
+    if before_meta['volumes'] != after_meta['volumes'] or \
+            before_meta['database'] != after_meta['database']:
+        print('warning: the runs seeded different databases')
+
+    print(f'{"target":<9} {"route":<45} {"req/s":>8} {"p50":>8} '
+          f'{"p99":>8}')
+    regressions = []
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        p50 = change(old['p50_ms'], new['p50_ms'])
+        p99 = change(old['p99_ms'], new['p99_ms'])
+        flags = []
+        if any(value is not None and value > args.threshold
+               for value in (p50, p99)):
+            flags.append('slower')
+        if new['errors'] > old['errors']:
+            flags.append(f'{new["errors"]} errors')
+        if flags:
+            regressions.append(key)
+        print(f'{key[0]:<9} {key[1]:<45} '
+              f'{percent(change(old["throughput"], new["throughput"]))} '
+              f'{percent(p50)} {percent(p99)}  {", ".join(flags)}')
+    for key in sorted(before.keys() ^ after.keys()):
+        side = 'before' if key in before else 'after'
+        print(f'{key[0]:<9} {key[1]:<45} only {side}')
+
+    if regressions:
+        print(f'{len(regressions)} regressions above {args.threshold}%')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
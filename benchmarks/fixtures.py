@@ -0,0 +1,242 @@
+'''
+Benchmark fixtures
+A local signing key published as a JWKS file (read by auth.py through
+JWKS_FILE instead of the Auth0 tenant), RS256 tokens minted with it
+for the roles of the README, and a seeded database of a given number
+of castings, shared by the benchmark scripts.
+
+Printing the environment lets test_app.py run without Auth0:
+
+    eval "$(python benchmarks/fixtures.py)"
+'''
+
+import argparse
+import base64
+import datetime
+import io
+import json
+import os
+import random
+import tempfile
+import time
+
+import rsa
+from jose import jwt
+
+
+AUTH0_DOMAIN = 'benchmark.local'
+API_AUDIENCE = 'casting-agency'
+KEY_ID = 'benchmark'
+KEY_DIR = os.path.join(tempfile.gettempdir(), 'casting-agency-keys')
+
+ROLES = {
+    'assistant': ['get:actors', 'get:movies', 'get:cast'],
+    'director': ['get:actors', 'get:movies', 'get:cast', 'post:actors',
+                 'patch:actors', 'patch:movies', 'delete:actors'],
+    'producer': ['get:actors', 'get:movies', 'get:cast', 'post:actors',
+                 'patch:actors', 'patch:movies', 'delete:actors',
+                 'post:movies', 'delete:movies', 'post:cast'],
+}
+# every permission the routes check, debug endpoints included
+ALL_PERMISSIONS = ROLES['producer'] + ['get:debug', 'get:profile',
+                                       'get:metrics']
+
+FIRST_NAMES = ('Ada', 'Bruno', 'Carla', 'Dmitri', 'Elena', 'Farid', 'Grace',
+               'Hiro', 'Ines', 'Jonas', 'Keiko', 'Luis', 'Maya', 'Nadia',
+               'Omar', 'Priya', 'Quentin', 'Rosa', 'Sven', 'Tariq')
+LAST_NAMES = ('Abbott', 'Brennan', 'Castillo', 'Dubois', 'Eriksen', 'Fischer',
+              'Garcia', 'Hughes', 'Ivanova', 'Jensen', 'Kowalski', 'Lindqvist',
+              'Moreau', 'Nakamura', 'Okafor', 'Petrov', 'Quinn', 'Rossi',
+              'Schmidt', 'Tanaka')
+TITLE_WORDS = ('Silent', 'Crimson', 'Last', 'Northern', 'Broken', 'Golden',
+               'Midnight', 'River', 'Empire', 'Garden', 'Storm', 'Mirror',
+               'Harbor', 'Winter', 'Shadow', 'Echo', 'Station', 'Orchard')
+
+CAST_SIZE = 10
+FILMOGRAPHY_SIZE = 4
+
+
+def b64_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def make_keys(directory):
+    """Returns the (jwks path, private key PEM) of the signing key kept
+    in directory, generating the key and its JWKS file the first time"""
+    os.makedirs(directory, exist_ok=True)
+    key_path = os.path.join(directory, 'key.pem')
+    jwks_path = os.path.join(directory, 'jwks.json')
+    if not os.path.exists(key_path) or not os.path.exists(jwks_path):
+        public, private = rsa.newkeys(2048)
+        with open(key_path, 'wb') as key_file:
+            key_file.write(private.save_pkcs1())
+        with open(jwks_path, 'w') as jwks_file:
+            json.dump({'keys': [{
+                'kty': 'RSA', 'kid': KEY_ID, 'use': 'sig', 'alg': 'RS256',
+                'n': b64_int(public.n), 'e': b64_int(public.e)}]}, jwks_file)
+    with open(key_path) as key_file:
+        return jwks_path, key_file.read()
+
+
+def mint_token(private_key, permissions, ttl=86400):
+    """Returns an RS256 access token granting the permissions,
+    valid for ttl seconds and accepted by auth.py under auth_env()"""
+    now = int(time.time())
+    return jwt.encode({
+        'iss': f'https://{AUTH0_DOMAIN}/',
+        'sub': 'benchmark|local',
+        'aud': API_AUDIENCE,
+        'iat': now,
+        'exp': now + ttl,
+        'permissions': list(permissions)},
+        private_key, algorithm='RS256', headers={'kid': KEY_ID})
+
+
+def auth_env(jwks_path):
+    """Returns the environment variables making auth.py verify tokens
+    against the local JWKS file"""
+    return {'AUTH0_DOMAIN': AUTH0_DOMAIN, 'API_AUDIENCE': API_AUDIENCE,
+            'ALGORITHMS': 'RS256', 'JWKS_FILE': jwks_path}
+
+
+def benchmark_environment(database_url):
+    """Points the app, before it is imported, at database_url and at the
+    local key, with the response cache off unless RESPONSE_CACHE_SIZE is
+    set, and returns the Authorization header value of a token granting
+    every permission"""
+    jwks_path, private_key = make_keys(KEY_DIR)
+    os.environ.update(auth_env(jwks_path))
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('RESPONSE_CACHE_SIZE', '0')
+    return 'Bearer ' + mint_token(private_key, ALL_PERMISSIONS)
+
+
+# Data
+
+
+class Volumes:
+    """Row counts of a seeded database. Actors, movies and castings are
+    numbered from 1; the reserved rows come after them and are never
+    cast, so that write benchmarks can create castings for the blank
+    movies and delete the spare actors and movies
+    Keyword arguments:
+    castings: number of castings, CAST_SIZE per movie
+    reserve: number of blank movies, spare movies and spare actors
+    """
+
+    def __init__(self, castings, reserve):
+        self.movies = max(castings // CAST_SIZE, 1)
+        self.castings = self.movies * CAST_SIZE
+        self.actors = max(self.castings // FILMOGRAPHY_SIZE, CAST_SIZE)
+        self.reserve = reserve
+
+    def blank_movie(self, i):
+        return self.movies + 1 + i % self.reserve
+
+    def spare_movie(self, i):
+        return self.movies + self.reserve + 1 + i % self.reserve
+
+    def spare_actor(self, i):
+        return self.actors + 1 + i % self.reserve
+
+    def actor(self, i):
+        """Returns the i-th actor id of a sequence spread over the table"""
+        return 1 + i * 7919 % self.actors
+
+    def movie(self, i):
+        return 1 + i * 7919 % self.movies
+
+    def as_dict(self):
+        return {'actors': self.actors, 'movies': self.movies,
+                'castings': self.castings, 'reserve': self.reserve}
+
+
+def csv_file(header, rows):
+    out = io.StringIO()
+    out.write(','.join(header) + '\n')
+    for row in rows:
+        out.write(','.join(str(value) for value in row) + '\n')
+    out.seek(0)
+    return out
+
+
+def actor_rows(rng, first, count):
+    for id in range(first, first + count):
+        yield (id, f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {id}',
+               rng.randint(18, 90), rng.choice(('female', 'male')))
+
+
+def movie_rows(rng, first, count):
+    start = datetime.date(1930, 1, 1)
+    for id in range(first, first + count):
+        title = ' '.join(rng.sample(TITLE_WORDS, 2))
+        yield (id, f'{title} {id}',
+               start + datetime.timedelta(days=rng.randrange(33000)))
+
+
+def casting_rows(rng, volumes):
+    """Yields CAST_SIZE distinct actors per movie, drawn with a skew
+    towards the low ids so that some actors have long filmographies"""
+    id = 0
+    for movie_id in range(1, volumes.movies + 1):
+        cast = set()
+        while len(cast) < CAST_SIZE:
+            cast.add(1 + int(volumes.actors * rng.random() ** 2))
+        for actor_id in sorted(cast):
+            id += 1
+            yield id, movie_id, actor_id
+
+
+def seed(volumes, random_seed=0):
+    """Empties the tables and loads the volumes, generated from
+    random_seed, with transfer.import_table (COPY on PostgreSQL).
+    Needs an app context"""
+    from models import Actor, Movie, Casting
+    from transfer import empty_tables, import_table
+
+    rng = random.Random(random_seed)
+    empty_tables([Actor, Movie])
+    import_table(Actor, csv_file(
+        ('id', 'name', 'age', 'gender'),
+        actor_rows(rng, 1, volumes.actors + volumes.reserve)))
+    import_table(Movie, csv_file(
+        ('id', 'title', 'release_date'),
+        movie_rows(rng, 1, volumes.movies + 2 * volumes.reserve)))
+    import_table(Casting, csv_file(
+        ('id', 'movie_id', 'actor_id'), casting_rows(rng, volumes)))
+
+
+def seed_app(app, volumes, random_seed=0):
+    """Seeds the database of the app, closes its connections so that
+    forked servers do not share them, and returns the seconds it took"""
+    from models import db
+
+    started = time.perf_counter()
+    with app.app_context():
+        seed(volumes, random_seed)
+        db.session.remove()
+        db.engine.dispose()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Prints the exports making test_app.py and the app '
+                    'accept locally minted tokens')
+    parser.add_argument('--dir', default=KEY_DIR,
+                        help='directory of the signing key and JWKS file')
+    parser.add_argument('--ttl', type=int, default=86400,
+                        help='token lifetime in seconds')
+    args = parser.parse_args()
+    jwks_path, private_key = make_keys(args.dir)
+    env = auth_env(os.path.abspath(jwks_path))
+    for role in ('producer', 'director', 'assistant'):
+        env[f'JWT_{role.upper()}'] = 'Bearer ' + mint_token(
+            private_key, ROLES[role], args.ttl)
+    for name, value in env.items():
+        print(f"export {name}='{value}'")
+
+
+if __name__ == '__main__':
+    main()
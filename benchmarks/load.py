@@ -0,0 +1,407 @@
+'''
+Load test
+Compares gunicorn worker models under a mixed read/write workload.
+For each worker class of --worker-classes it starts gunicorn app:app
+on a database seeded like benchmarks/api.py, then drives it with an
+asyncio client keeping --concurrency-levels requests in flight, one
+level after the other for --step-seconds each. Every client sends its
+next request as soon as the previous one is answered, picking a write
+(POST /actors, PATCH /movies, POST /cast/bulk...) --write-percent of
+the time and a read (listings, filmographies, search, stats...)
+otherwise, built with the request factories of benchmarks/api.py.
+
+For every level it reports the throughput, the p50/p99/max latency,
+the errors and the contention of the SQLAlchemy pools of the workers:
+checkouts that waited for a connection, the time they waited and the
+timeouts, read from GET /_debug/pool before and after the level. Per
+configuration it reports the saturation throughput (the best level)
+and the smallest level reaching 95% of it, the knee past which more
+clients only add latency:
+
+    python benchmarks/load.py --database-url postgresql://localhost/ca_load \\
+        --wipe --workers 4 --output load.json
+
+gevent and eventlet are not in requirements.txt; their worker classes
+are skipped unless installed. Pool counters exist for PostgreSQL only,
+SQLite has no connection queue.
+'''
+
+import argparse
+import asyncio
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import random
+import tempfile
+from collections import Counter
+
+from api import ROUTES, percentile, free_port, start_gunicorn, \
+    stop_gunicorn, git_revision
+from fixtures import Volumes, benchmark_environment, seed_app
+
+
+READS = {
+    'GET /actors': 15,
+    'GET /movies': 15,
+    'GET /actors/<int:id>/movies': 10,
+    'GET /movies/<int:id>/actors': 10,
+    'GET /actors/movies': 5,
+    'GET /cast': 5,
+    'GET /search': 10,
+    'GET /stats': 5,
+    'GET /actors/<int:id>/costars': 5,
+    'GET /actors/<int:source>/path/<int:target>': 2,
+}
+# writes that can repeat without running out of rows: no deletes,
+# castings go through the bulk route which skips existing pairs
+WRITES = {
+    'POST /actors': 4,
+    'PATCH /actors/<int:id>': 4,
+    'POST /movies': 3,
+    'PATCH /movies/<int:id>': 3,
+    'POST /cast/bulk': 1,
+}
+# blank movies receiving the castings of POST /cast/bulk
+RESERVE = 1000
+# an async worker serves this many connections at most
+WORKER_CONNECTIONS = 100
+KNEE = 0.95
+
+FACTORIES = {f'{method} {rule}': (method, factory)
+             for method, rule, factory in ROUTES}
+
+
+class Connection:
+    """Keep-alive HTTP/1.1 connection of one asyncio client, reopened
+    after the server closes it (sync workers close every connection)"""
+
+    def __init__(self, port, authorization, timeout):
+        self.port = port
+        self.authorization = authorization
+        self.timeout = timeout
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body):
+        """Returns the status of the response, 0 when the connection
+        failed or the response took longer than the timeout"""
+        try:
+            return await asyncio.wait_for(
+                self._request(method, path, body), self.timeout)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError,
+                ValueError, IndexError):
+            self.close()
+            return 0
+
+    async def _request(self, method, path, body):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                '127.0.0.1', self.port)
+        data = b'' if body is None else json.dumps(body).encode()
+        self.writer.write(
+            f'{method} {path} HTTP/1.1\r\n'
+            f'Host: 127.0.0.1:{self.port}\r\n'
+            f'Authorization: {self.authorization}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Content-Length: {len(data)}\r\n\r\n'.encode() + data)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+        if 'content-length' in headers:
+            await self.reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            await self.reader.read()
+            headers['connection'] = 'close'
+        if headers.get('connection') == 'close':
+            self.close()
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+def pick_request(rng, volumes, write_percent):
+    """Returns the (kind, method, path, body) of a random request of the
+    mix, kind being read or write"""
+    kind, weights = ('write', WRITES) \
+        if rng.random() * 100 < write_percent else ('read', READS)
+    route = rng.choices(list(weights), list(weights.values()))[0]
+    method, factory = FACTORIES[route]
+    return (kind, method, *factory(volumes, rng.randrange(1 << 30)))
+
+
+async def client(port, authorization, args, volumes, rng, deadline,
+                 samples):
+    connection = Connection(port, authorization, args.timeout)
+    loop = asyncio.get_running_loop()
+    while loop.time() < deadline:
+        kind, method, path, body = pick_request(rng, volumes,
+                                                args.write_percent)
+        started = loop.time()
+        status = await connection.request(method, path, body)
+        samples.append((kind, loop.time() - started, status))
+    connection.close()
+
+
+async def run_level(port, authorization, args, volumes, concurrency, seed):
+    """Returns the (kind, seconds, status) samples and the seconds of
+    concurrency clients sending requests for args.step_seconds"""
+    loop = asyncio.get_running_loop()
+    samples = []
+    started = loop.time()
+    deadline = started + args.step_seconds
+    await asyncio.gather(*[
+        client(port, authorization, args, volumes,
+               random.Random(seed * 1000003 + n), deadline, samples)
+        for n in range(concurrency)])
+    return samples, loop.time() - started
+
+
+async def pool_snapshot(port, authorization, workers):
+    """Returns the pool counters of the workers by pid, asking
+    GET /_debug/pool on new connections until every worker answered
+    or 20 attempts per worker"""
+    pools = {}
+    for _ in range(20 * workers):
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            break
+        writer.write(
+            f'GET /_debug/pool HTTP/1.1\r\nHost: 127.0.0.1\r\n'
+            f'Authorization: {authorization}\r\n'
+            f'Connection: close\r\n\r\n'.encode())
+        try:
+            response = await asyncio.wait_for(reader.read(), 10)
+            pool = json.loads(response.partition(b'\r\n\r\n')[2])['pool']
+            pools[pool['pid']] = pool
+        except (OSError, asyncio.TimeoutError, ValueError, KeyError):
+            pass
+        finally:
+            writer.close()
+        if len(pools) >= workers:
+            break
+    return pools
+
+
+def pool_contention(before, after):
+    """Sums the change of the pool counters of the workers seen in both
+    snapshots, None without a queue pool"""
+    pids = [pid for pid in after
+            if pid in before and 'checkouts' in after[pid]]
+    if not pids:
+        return None
+    total = {name: sum(after[pid][name] - before[pid][name] for pid in pids)
+             for name in ('checkouts', 'waits', 'wait_seconds', 'timeouts')}
+    total['wait_seconds'] = round(total['wait_seconds'], 3)
+    total['waits_percent'] = round(
+        total['waits'] / total['checkouts'] * 100, 1) \
+        if total['checkouts'] else 0.0
+    total['max_wait_seconds'] = max(after[pid]['max_wait_seconds']
+                                    for pid in pids)
+    total['workers_seen'] = len(pids)
+    return total
+
+
+def level_report(concurrency, samples, elapsed, pool):
+    ms = (lambda value: None if value is None else round(value * 1000, 3))
+    latencies = sorted(seconds for _, seconds, _ in samples)
+    by_kind = {kind: sorted(seconds for k, seconds, _ in samples if k == kind)
+               for kind in ('read', 'write')}
+    statuses = Counter(status for _, _, status in samples)
+    return {
+        'concurrency': concurrency,
+        'requests': len(samples),
+        'throughput': round(len(samples) / elapsed, 2),
+        'p50_ms': ms(percentile(latencies, 0.5)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'max_ms': ms(latencies[-1]) if latencies else None,
+        'read_p99_ms': ms(percentile(by_kind['read'], 0.99)),
+        'write_p99_ms': ms(percentile(by_kind['write'], 0.99)),
+        'errors': sum(count for status, count in statuses.items()
+                      if not 200 <= status < 300),
+        'statuses': {str(status): count
+                     for status, count in sorted(statuses.items())},
+        'pool': pool}
+
+
+def saturation(levels):
+    """Returns the summary of a configuration: its best throughput and
+    the first level reaching KNEE of it"""
+    best = max(levels, key=lambda level: level['throughput'])
+    knee = next(level for level in levels
+                if level['throughput'] >= KNEE * best['throughput'])
+    return {'throughput': best['throughput'],
+            'concurrency': best['concurrency'],
+            'p99_ms': best['p99_ms'],
+            'knee_concurrency': knee['concurrency'],
+            'knee_p99_ms': knee['p99_ms'],
+            'errors': sum(level['errors'] for level in levels)}
+
+
+def print_level(level):
+    pool = level['pool']
+    contention = f'{pool["waits_percent"]:>6.1f}% {pool["wait_seconds"]:>8.2f}' \
+        f' {pool["timeouts"]:>5}' if pool else f'{"-":>7} {"-":>8} {"-":>5}'
+    print(f'{level["concurrency"]:>6} {level["throughput"]:>9.1f} '
+          f'{level["p50_ms"]:>9.1f} {level["p99_ms"]:>9.1f} '
+          f'{level["errors"]:>7} {contention}', flush=True)
+
+
+async def run_configuration(worker_class, args, volumes, authorization):
+    options = ['--workers', str(args.workers), '--worker-class', worker_class]
+    if worker_class == 'gthread':
+        options += ['--threads', str(args.threads)]
+    elif worker_class in ('gevent', 'eventlet'):
+        options += ['--worker-connections', str(args.worker_connections)]
+    port = free_port()
+    headers = {'Authorization': authorization}
+    server = await asyncio.to_thread(start_gunicorn, port, headers, options)
+    levels = []
+    try:
+        print(f'\n{worker_class} ({" ".join(options)})')
+        print(f'{"conc":>6} {"req/s":>9} {"p50 ms":>9} {"p99 ms":>9} '
+              f'{"errors":>7} {"waits":>7} {"wait s":>8} {"tmout":>5}')
+        for n, concurrency in enumerate(args.concurrency_levels):
+            before = await pool_snapshot(port, authorization, args.workers)
+            samples, elapsed = await run_level(
+                port, authorization, args, volumes, concurrency,
+                args.seed * 1000 + n)
+            after = await pool_snapshot(port, authorization, args.workers)
+            levels.append(level_report(concurrency, samples, elapsed,
+                                       pool_contention(before, after)))
+            print_level(levels[-1])
+    finally:
+        await asyncio.to_thread(stop_gunicorn, server)
+    return {'worker_class': worker_class, 'options': options,
+            'saturation': saturation(levels), 'levels': levels}
+
+
+def available(worker_class):
+    """Returns None when gunicorn can run the worker class, the reason
+    it cannot otherwise"""
+    if worker_class in ('gevent', 'eventlet') and \
+            importlib.util.find_spec(worker_class) is None:
+        return f'{worker_class} is not installed'
+    return None
+
+
+def integers(value):
+    return [int(item) for item in value.split(',')]
+
+
+async def main_async(args, volumes, authorization):
+    configurations = []
+    skipped = {}
+    for worker_class in args.worker_classes.split(','):
+        reason = available(worker_class)
+        if reason:
+            skipped[worker_class] = reason
+            print(f'\n{worker_class} skipped: {reason}')
+            continue
+        configurations.append(await run_configuration(
+            worker_class, args, volumes, authorization))
+    return configurations, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--worker-classes',
+                        default='sync,gthread,gevent,eventlet',
+                        help='comma separated gunicorn worker classes')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads per gthread worker')
+    parser.add_argument('--worker-connections', type=int,
+                        default=WORKER_CONNECTIONS,
+                        help='connections per gevent or eventlet worker')
+    parser.add_argument('--concurrency-levels', type=integers,
+                        default=[1, 2, 4, 8, 16, 32, 64],
+                        help='comma separated clients in flight per level')
+    parser.add_argument('--step-seconds', type=float, default=10)
+    parser.add_argument('--write-percent', type=float, default=15)
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds after which a request counts as '
+                             'an error')
+    parser.add_argument('--castings', type=int, default=100000)
+    parser.add_argument('--database-url',
+                        help='database to seed, a scratch SQLite file '
+                             'when not given')
+    parser.add_argument('--wipe', action='store_true',
+                        help='confirm that the tables of --database-url '
+                             'may be emptied')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON results file')
+    args = parser.parse_args()
+    if args.database_url and not args.wipe:
+        parser.error('seeding empties the tables of --database-url, '
+                     'pass --wipe to confirm')
+
+    scratch = tempfile.TemporaryDirectory()
+    authorization = benchmark_environment(
+        args.database_url or
+        'sqlite:///' + os.path.join(scratch.name, 'load.sqlite'))
+
+    from app import app
+    from models import db
+
+    volumes = Volumes(args.castings, RESERVE)
+    seed_seconds = seed_app(app, volumes, args.seed)
+    print(f'seeded {volumes.as_dict()} in {seed_seconds:.1f}s', flush=True)
+
+    configurations, skipped = asyncio.run(
+        main_async(args, volumes, authorization))
+
+    print(f'\n{"worker class":<14} {"max req/s":>10} {"at conc":>8} '
+          f'{"p99 ms":>9} {"knee":>6} {"knee p99":>9} {"errors":>7}')
+    for configuration in configurations:
+        summary = configuration['saturation']
+        print(f'{configuration["worker_class"]:<14} '
+              f'{summary["throughput"]:>10.1f} {summary["concurrency"]:>8} '
+              f'{summary["p99_ms"]:>9.1f} {summary["knee_concurrency"]:>6} '
+              f'{summary["knee_p99_ms"]:>9.1f} {summary["errors"]:>7}')
+
+    report = {
+        'meta': {
+            'commit': git_revision(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'database': db.engine.dialect.name,
+            'volumes': volumes.as_dict(),
+            'workers': args.workers,
+            'step_seconds': args.step_seconds,
+            'write_percent': args.write_percent,
+            'reads': READS,
+            'writes': WRITES,
+            'environment': {name: os.environ.get(name) for name in (
+                'RESPONSE_CACHE_SIZE', 'TOKEN_CACHE_SIZE', 'DB_POOL_SIZE',
+                'DB_MAX_OVERFLOW', 'DB_POOL_TIMEOUT')},
+            'skipped': skipped},
+        'configurations': configurations}
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=2)
+            out.write('\n')
+    scratch.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+'''
+Serialization microbenchmark
+Times one listing of --rows movies and actors read from a scratch
+SQLite database, serialized three ways:
+    format+jsonify  ORM instances, Model.format() and the stdlib json
+                    settings of flask.jsonify (the former listing path)
+    tuples+stdlib   column tuples, serializers.records and the stdlib
+                    fallback of serializers.dumps
+    tuples+orjson   the same with orjson (skipped when not installed)
+Each path reports the best of --repeat runs of loading the rows and of
+encoding them, in milliseconds.
+
+    python benchmarks/serialization.py --rows 100000
+'''
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from flask import Flask  # noqa: E402
+import serializers  # noqa: E402
+from models import setup_db, db, Actor, Movie  # noqa: E402
+from serializers import dumps, model_columns, records  # noqa: E402
+
+
+def seed(rows):
+    """Fills the scratch tables with rows actors and rows movies"""
+    start = datetime.date(1950, 1, 1)
+    db.session.execute(Actor.__table__.insert(), [
+        {'name': f'Actor {i}', 'age': 20 + i % 60,
+         'gender': 'female' if i % 2 else 'male'} for i in range(rows)])
+    db.session.execute(Movie.__table__.insert(), [
+        {'title': f'Movie {i}',
+         'release_date': start + datetime.timedelta(days=i % 25000)}
+        for i in range(rows)])
+    db.session.commit()
+
+
+def best(repeat, run):
+    """Returns the best (load ms, encode ms) of repeat calls of run,
+    which returns its own (load, encode) seconds"""
+    times = [run() for _ in range(repeat)]
+    return tuple(min(t[i] for t in times) * 1000 for i in (0, 1))
+
+
+def format_jsonify(model, key):
+    db.session.remove()
+    started = time.perf_counter()
+    items = model.query.order_by(model.id).all()
+    loaded = time.perf_counter()
+    json.dumps({'success': True, key: [item.format() for item in items]},
+               sort_keys=True, separators=(',', ':')).encode()
+    return loaded - started, time.perf_counter() - loaded
+
+
+def tuples(model, key):
+    db.session.remove()
+    columns = model_columns(model)
+    started = time.perf_counter()
+    rows = model.query.with_entities(*columns).order_by(model.id).all()
+    loaded = time.perf_counter()
+    dumps({'success': True, key: records(rows, columns)})
+    return loaded - started, time.perf_counter() - loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    with tempfile.TemporaryDirectory() as scratch:
+        with app.app_context():
+            setup_db(app, 'sqlite:///' + os.path.join(scratch, 'bench.sqlite'),
+                     replica_paths=[])
+            seed(args.rows)
+            orjson = serializers.orjson
+            paths = [('format+jsonify', format_jsonify),
+                     ('tuples+stdlib', tuples)]
+            if orjson is not None:
+                paths.append(('tuples+orjson', tuples))
+
+            print(f'{args.rows} rows, best of {args.repeat}')
+            print(f'{"listing":<8} {"path":<15} {"load":>8} {"encode":>8} '
+                  f'{"total":>8} {"speedup":>8}')
+            for model, key in ((Movie, 'movies'), (Actor, 'actors')):
+                baseline = None
+                for name, run in paths:
+                    serializers.orjson = orjson if name.endswith('orjson') \
+                        else None
+                    load, encode = best(args.repeat, lambda: run(model, key))
+                    total = load + encode
+                    baseline = baseline or total
+                    print(f'{key:<8} {name:<15} {load:8.1f} {encode:8.1f} '
+                          f'{total:8.1f} {baseline / total:7.2f}x')
+            serializers.orjson = orjson
+            db.session.remove()
+            db.engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+import datetime
+import json
+import os
+from flask import request, abort
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from models import db, Actor, Movie, Casting, bump_versions, count_stats, \
+    row_deltas, release_date_deltas
+
+
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 1000))
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 50000))
+
+
+'''
+Bulk writes
+Arrays of actors, movies or castings validated in one pass and
+written with multi-row INSERTs inside a single transaction
+'''
+
+
+def bulk_items():
+    """Returns the list of items sent as a json array or as NDJSON
+    (Content-Type: application/x-ndjson),
+    aborts with 400 when the body is not a list of at most
+    BULK_MAX_ITEMS items
+    """
+    try:
+        if request.mimetype == 'application/x-ndjson':
+            items = [json.loads(line)
+                     for line in request.get_data(as_text=True).splitlines()
+                     if line.strip()]
+        else:
+            items = request.get_json()
+    except ValueError:
+        abort(400)
+    if not isinstance(items, list) or not items or \
+            len(items) > BULK_MAX_ITEMS:
+        abort(400)
+    return items
+
+
+def batch_size_arg():
+    """Returns the ?batch_size= query parameter, BULK_BATCH_SIZE by default,
+    aborts with 400 when it is not a positive integer
+    """
+    try:
+        batch_size = int(request.args.get('batch_size', BULK_BATCH_SIZE))
+    except ValueError:
+        abort(400)
+    if batch_size < 1:
+        abort(400)
+    return batch_size
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_text(value):
+    return isinstance(value, str) and value.strip() != ''
+
+
+def parse_date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def validate_actor(item):
+    """Returns the (row, error) tuple for one actor item"""
+    row = {}
+    if 'name' in item:
+        if not is_text(item['name']):
+            return None, 'name must be a non empty string'
+        row['name'] = item['name']
+    if 'age' in item:
+        if not is_int(item['age']) or item['age'] < 0:
+            return None, 'age must be a non negative integer'
+        row['age'] = item['age']
+    if 'gender' in item:
+        if not is_text(item['gender']):
+            return None, 'gender must be a non empty string'
+        row['gender'] = item['gender']
+    return row, None
+
+
+def validate_movie(item):
+    """Returns the (row, error) tuple for one movie item"""
+    row = {}
+    if 'title' in item:
+        if not is_text(item['title']):
+            return None, 'title must be a non empty string'
+        row['title'] = item['title']
+    if 'release_date' in item:
+        release_date = parse_date(item['release_date'])
+        if release_date is None:
+            return None, 'release_date must be a YYYY-MM-DD date'
+        row['release_date'] = release_date
+    return row, None
+
+
+def chunks(rows, size):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def existing_ids(column, ids, batch_size):
+    """Returns the subset of ids present in the column,
+    queried with one IN per batch"""
+    found = set()
+    ids = list(set(ids))
+    for batch in chunks(ids, batch_size):
+        found.update(
+            r[0] for r in db.session.query(column).filter(column.in_(batch)))
+    return found
+
+
+def moved_release_dates(rows, batch_size):
+    """Returns the (old, new) release dates of the movie updates
+    changing it, old dates read with one IN per batch"""
+    new_dates = {row['id']: row['release_date'] for row in rows
+                 if 'release_date' in row}
+    changes = []
+    for batch in chunks(list(new_dates), batch_size):
+        rows = db.session.query(Movie.id, Movie.release_date) \
+            .filter(Movie.id.in_(batch))
+        changes.extend((old, new_dates[id]) for id, old in rows)
+    return changes
+
+
+NEXT_IDS = text(
+    "SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+    'FROM generate_series(1, :count)')
+
+
+def insert_rows(model, rows, batch_size):
+    """Inserts the rows with one multi-row INSERT per batch and returns
+    their new ids, in order
+    Keyword arguments:
+    model: mapped class of the table
+    rows: list of column dicts
+    batch_size: number of rows per INSERT statement
+    """
+    table = model.__table__
+    ids = []
+    for batch in chunks(rows, batch_size):
+        if db.session.bind.dialect.name == 'postgresql':
+            # RETURNING does not keep the order of a multi-row VALUES,
+            # the ids are drawn from the sequence first and inserted
+            # with their rows
+            batch_ids = [r[0] for r in db.session.execute(
+                NEXT_IDS, {'table': f'"{table.name}"', 'count': len(batch)})]
+            db.session.execute(table.insert().values(
+                [dict(row, id=id) for row, id in zip(batch, batch_ids)]))
+            ids.extend(batch_ids)
+        else:
+            db.session.bulk_insert_mappings(model, batch, return_defaults=True)
+            ids.extend(row['id'] for row in batch)
+    return ids
+
+
+def upsert(model, items, validate, required, batch_size):
+    """Validates the items, inserts the ones without id and updates the
+    ones with an id, and returns the list of per item results.
+    The caller commits.
+    Keyword arguments:
+    model: Actor or Movie
+    items: decoded request items
+    validate: function returning the (row, error) tuple of an item
+    required: columns an item without id must provide
+    batch_size: number of rows per statement
+    """
+    results = [None] * len(items)
+    inserts, updates = [], []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = {'status': 'invalid',
+                              'error': 'item must be an object'}
+            continue
+        row, error = validate(item)
+        if error is None and 'id' in item:
+            if not is_int(item['id']) or not row:
+                error = 'updates need an integer id and a field to change'
+        elif error is None:
+            missing = [c for c in required if c not in row]
+            if missing:
+                error = f'missing {", ".join(missing)}'
+        if error is not None:
+            results[index] = {'status': 'invalid', 'error': error}
+        elif 'id' in item:
+            updates.append((index, dict(row, id=item['id'])))
+        else:
+            inserts.append((index, row))
+
+    found = existing_ids(model.id, [row['id'] for _, row in updates],
+                         batch_size)
+    updates_found = []
+    for index, row in updates:
+        if row['id'] in found:
+            updates_found.append(row)
+            results[index] = {'status': 'updated', 'id': row['id']}
+        else:
+            results[index] = {'status': 'not_found', 'id': row['id']}
+    if model is Movie:
+        count_stats(release_date_deltas(
+            moved_release_dates(updates_found, batch_size)))
+    for batch in chunks(updates_found, batch_size):
+        db.session.bulk_update_mappings(model, batch)
+
+    rows = [row for _, row in inserts]
+    new_ids = insert_rows(model, rows, batch_size)
+    for (index, _), id in zip(inserts, new_ids):
+        results[index] = {'status': 'created', 'id': id}
+    count_stats(row_deltas(model, rows))
+    if inserts or updates_found:
+        bump_versions(model.__tablename__)
+    return results
+
+
+def upsert_actors(items, batch_size):
+    return upsert(Actor, items, validate_actor,
+                  ('name', 'age', 'gender'), batch_size)
+
+
+def upsert_movies(items, batch_size):
+    return upsert(Movie, items, validate_movie,
+                  ('title', 'release_date'), batch_size)
+
+
+def insert_castings(items, batch_size):
+    """Validates the casting items and inserts the new pairs,
+    pairs already cast (or repeated in the request) are reported
+    as existing, pairs referencing unknown actors or movies as not_found.
+    Returns the list of per item results. The caller commits.
+    """
+    results = [None] * len(items)
+    pairs = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not is_int(item.get('actor_id')) \
+                or not is_int(item.get('movie_id')):
+            results[index] = {'status': 'invalid',
+                              'error': 'actor_id and movie_id must be integers'}
+            continue
+        pairs.append((index, (item['actor_id'], item['movie_id'])))
+
+    actors = existing_ids(Actor.id, [p[0] for _, p in pairs], batch_size)
+    movies = existing_ids(Movie.id, [p[1] for _, p in pairs], batch_size)
+    known = {}
+    for batch in chunks(list(actors), batch_size):
+        rows = db.session.query(
+            Casting.actor_id, Casting.movie_id, Casting.id) \
+            .filter(Casting.actor_id.in_(batch))
+        known.update(((a, m), id) for a, m, id in rows)
+
+    inserts = []
+    first_index = {}
+    for index, pair in pairs:
+        if pair[0] not in actors or pair[1] not in movies:
+            results[index] = {'status': 'not_found',
+                              'error': 'unknown actor_id or movie_id'}
+        elif pair in known:
+            results[index] = {'status': 'exists', 'id': known[pair]}
+        elif pair in first_index:
+            results[index] = {'status': 'exists', 'duplicate_of': first_index[pair]}
+        else:
+            first_index[pair] = index
+            inserts.append((index, {'actor_id': pair[0], 'movie_id': pair[1]}))
+
+    new_ids = insert_new_castings([row for _, row in inserts], batch_size)
+    rows = []
+    for index, row in inserts:
+        pair = (row['actor_id'], row['movie_id'])
+        if pair in new_ids:
+            rows.append(row)
+            results[index] = {'status': 'created', 'id': new_ids[pair]}
+        else:
+            # cast by a concurrent request since it was looked up
+            results[index] = {'status': 'exists'}
+    count_stats(row_deltas(Casting, rows))
+    if rows:
+        bump_versions('Casting')
+    return results
+
+
+def insert_new_castings(rows, batch_size):
+    """Inserts the castings, skipping the pairs uq_casting_actor_movie
+    already holds, and returns the {(actor_id, movie_id): id} dict of
+    the rows actually inserted
+    Keyword arguments:
+    rows: list of actor_id / movie_id dicts
+    batch_size: number of rows per INSERT statement
+    """
+    table = Casting.__table__
+    new_ids = {}
+    if db.session.bind.dialect.name == 'postgresql':
+        for batch in chunks(rows, batch_size):
+            result = db.session.execute(
+                pg_insert(table).values(batch)
+                .on_conflict_do_nothing(index_elements=['actor_id', 'movie_id'])
+                .returning(table.c.actor_id, table.c.movie_id, table.c.id))
+            new_ids.update(((a, m), id) for a, m, id in result)
+        return new_ids
+    # SQLite serializes writers, a row at a time keeps the new ids
+    insert = table.insert().prefix_with('OR IGNORE')
+    for row in rows:
+        result = db.session.execute(insert, row)
+        if result.rowcount:
+            new_ids[(row['actor_id'], row['movie_id'])] = \
+                result.lastrowid
+    return new_ids
+
+
+def summary(results):
+    """Returns the count of results per status"""
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    return counts
@@ -0,0 +1,321 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, g, current_app
+from listing import wants_stream
+
+
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 30))
+
+
+'''
+LRUCache
+A bounded, thread-safe least recently used cache whose entries
+expire after a per-entry deadline
+'''
+
+
+class LRUCache:
+    """Maps keys to values, evicting the least recently used entry once
+    maxsize is reached and dropping entries past their expiry time
+    Keyword arguments:
+    maxsize: maximum number of entries, 0 or less disables the cache
+    ttl: default lifetime of an entry in seconds (None for no limit)
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the value stored under key, default if the key is
+        missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires_at=None):
+        """Stores value under key until expires_at (epoch seconds),
+        capped to the cache ttl
+        """
+        if self.maxsize <= 0:
+            return
+        if self.ttl is not None:
+            deadline = time.time() + self.ttl
+            expires_at = deadline if expires_at is None \
+                else min(expires_at, deadline)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """Removes key from the cache, returns True if it was present"""
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the cache counters as a dict"""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+'''
+Response cache backends
+A backend stores values under string keys together with a set of tags;
+invalidating a tag drops every entry stored with it. Callers take a
+snapshot of the tags before reading the data to cache and pass it to
+set, so a value read before an invalidation is never stored after it.
+'''
+
+
+class CacheBackend:
+    """Interface of the response cache storage"""
+
+    def get(self, key):
+        """Returns the value stored under key, None when missing"""
+        raise NotImplementedError
+
+    def snapshot(self, tags):
+        """Returns an opaque token describing the current state of tags"""
+        raise NotImplementedError
+
+    def set(self, key, value, tags, ttl, snapshot):
+        """Stores value under key for ttl seconds, tagged with tags,
+        unless one of the tags was invalidated since snapshot was taken"""
+        raise NotImplementedError
+
+    def invalidate(self, tags):
+        """Drops every entry stored with one of the tags"""
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class LocalBackend(CacheBackend):
+    """In-process backend: an LRUCache plus an index of keys per tag"""
+
+    def __init__(self, maxsize=1024):
+        self.entries = LRUCache(maxsize=maxsize)
+        self._tags = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def snapshot(self, tags):
+        with self._lock:
+            return [self._versions.get(tag, 0) for tag in tags]
+
+    def set(self, key, value, tags, ttl, snapshot):
+        with self._lock:
+            if [self._versions.get(tag, 0) for tag in tags] != snapshot:
+                return
+            self.entries.set(key, value, time.time() + ttl)
+            for tag in tags:
+                keys = self._tags.setdefault(tag, set())
+                keys.add(key)
+                if len(keys) > 2 * self.entries.maxsize:
+                    # forget keys the LRU already evicted
+                    keys.intersection_update(
+                        [k for k in keys if k in self.entries])
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+                for key in self._tags.pop(tag, ()):
+                    self.entries.delete(key)
+
+    def stats(self):
+        return self.entries.stats()
+
+
+class DictStore:
+    """Thread-safe in-memory stand-in for a shared key-value store
+    client (get / get_many / set with ttl / incr), used in tests
+    and development
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires_at = self._values.get(key, (None, None))
+            if expires_at is not None and expires_at <= time.time():
+                del self._values[key]
+                return None
+            return value
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ttl=None):
+        expires_at = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._values[key] = (value, expires_at)
+
+    def incr(self, key):
+        with self._lock:
+            value, expires_at = self._values.get(key, (0, None))
+            self._values[key] = (value + 1, expires_at)
+            return value + 1
+
+
+class KeyValueBackend(CacheBackend):
+    """Backend over a key-value store shared by every worker
+    (any client with get / get_many / set(key, value, ttl) / incr).
+    Each tag has a version number in the store; entries remember the
+    versions of their tags when stored and are ignored once one of
+    them was bumped by invalidate, so no key listing is needed.
+    Keyword arguments:
+    store: key-value store client
+    prefix: prefix of every key written to the store
+    """
+
+    def __init__(self, store, prefix='response-cache:'):
+        self.store = store
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def snapshot(self, tags):
+        versions = self.store.get_many(
+            [self.prefix + 'tag:' + tag for tag in tags])
+        return [version or 0 for version in versions]
+
+    def get(self, key):
+        entry = self.store.get(self.prefix + key)
+        if entry is not None:
+            value, tags, versions = entry
+            if self.snapshot(tags) == versions:
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key, value, tags, ttl, snapshot):
+        self.store.set(self.prefix + key, (value, list(tags), snapshot), ttl)
+
+    def invalidate(self, tags):
+        for tag in tags:
+            self.store.incr(self.prefix + 'tag:' + tag)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+'''
+ResponseCache
+Caches the successful responses of GET views, keyed by path, query
+arguments, the permission set of the caller and, under conditional(),
+the versions of the tables the view reads. Requests negotiating an
+NDJSON stream bypass it.
+'''
+
+
+class ResponseCache:
+    """Decorates read views and invalidates their entries by tag.
+    A backend of None disables caching.
+    Keyword arguments:
+    backend: CacheBackend storing the responses
+    ttl: lifetime of an entry in seconds
+    """
+
+    def __init__(self, backend, ttl=RESPONSE_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+
+    def key(self):
+        """Returns the cache key of the current request"""
+        raw = json.dumps([
+            request.path,
+            sorted(request.args.items(multi=True)),
+            sorted(g.get('permissions') or ()),
+            g.get('table_versions')])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def cached(self, *tags):
+        """Returns a decorator caching the responses of a view.
+        Keyword arguments:
+        tags: tag strings, formatted with the view arguments
+        (i.e. 'actor:{id}'), or functions of the view arguments
+        returning a list of tags
+        """
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if request.method != 'GET' or self.backend is None or \
+                        wants_stream():
+                    return f(*args, **kwargs)
+                resolved = []
+                for tag in tags:
+                    if callable(tag):
+                        resolved.extend(tag(**kwargs))
+                    else:
+                        resolved.append(tag.format(**kwargs))
+                key = self.key()
+                entry = self.backend.get(key)
+                if entry is not None:
+                    data, mimetype = entry
+                    response = current_app.response_class(
+                        data, status=200, mimetype=mimetype)
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+                snapshot = self.backend.snapshot(resolved)
+                response = current_app.make_response(f(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    self.backend.set(key, (response.get_data(), response.mimetype),
+                                     resolved, self.ttl, snapshot)
+                    response.headers['X-Cache'] = 'MISS'
+                return response
+
+            return wrapper
+        return cached_decorator
+
+    def invalidate(self, *tags):
+        """Drops the cached responses stored with any of the tags"""
+        if self.backend is not None and tags:
+            self.backend.invalidate(tags)
@@ -0,0 +1,73 @@
+import datetime
+import hashlib
+import json
+from functools import wraps
+from flask import request, current_app, g
+from models import table_versions
+from listing import wants_stream
+
+
+'''
+Conditional GET
+Strong ETags and Last-Modified dates derived from the versions of the
+tables a view reads and from the permissions of the caller, so a
+matching If-None-Match or If-Modified-Since is answered with 304 before
+any row is loaded. The versions are left in g.table_versions for the
+response cache key: a write made by any worker bumps them and misses
+the per-worker caches.
+'''
+
+
+def conditional(*tables):
+    """Returns a decorator answering conditional GET requests
+    of a view reading the given tables
+    Keyword arguments:
+    tables: names of the tables the response is built from
+    """
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return f(*args, **kwargs)
+            versions = table_versions(*tables)
+            g.table_versions = [versions.get(t, (0,))[0] for t in tables]
+            raw = json.dumps([
+                request.path,
+                sorted(request.args.items(multi=True)),
+                wants_stream(),
+                sorted(g.get('permissions') or ()),
+                g.table_versions])
+            etag = hashlib.sha1(raw.encode()).hexdigest()
+            dates = [updated_at for _, updated_at in versions.values()]
+            last_modified = max(dates).replace(microsecond=0) \
+                if dates else None
+            # HTTP dates have whole seconds: a write later in the current
+            # second would not move Last-Modified, so none is sent and
+            # If-Modified-Since is ignored until the second is over
+            if last_modified is not None and last_modified >= \
+                    datetime.datetime.utcnow().replace(microsecond=0):
+                last_modified = None
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = last_modified is not None and \
+                    request.if_modified_since is not None and \
+                    last_modified <= request.if_modified_since.replace(
+                        tzinfo=None)
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(f(*args, **kwargs))
+            # the body depends on the negotiated format and the token
+            response.vary.add('Accept')
+            response.vary.add('Authorization')
+            if response.status_code not in (200, 304):
+                return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+
+        return wrapper
+    return conditional_decorator
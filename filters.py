@@ -0,0 +1,121 @@
+import datetime
+import os
+from flask import request, abort
+from models import Actor, Movie
+
+
+SEARCH_MIN_LENGTH = int(os.environ.get('SEARCH_MIN_LENGTH', 3))
+
+
+'''
+Listing filters
+Query parameters of the actor and movie listings compiled into
+WHERE clauses on indexed columns, and the columns they can be sorted by
+'''
+
+
+ACTOR_SORT_COLUMNS = {
+    'id': Actor.id,
+    'name': Actor.name,
+    'age': Actor.age,
+    'gender': Actor.gender}
+
+MOVIE_SORT_COLUMNS = {
+    'id': Movie.id,
+    'title': Movie.title,
+    'release_date': Movie.release_date}
+
+
+def int_arg(name):
+    """Returns the integer query parameter name, None when missing,
+    aborts with 400 when it is not an integer
+    """
+    if name not in request.args:
+        return None
+    try:
+        return int(request.args[name])
+    except ValueError:
+        abort(400)
+
+
+def date_arg(name):
+    """Returns the YYYY-MM-DD query parameter name, None when missing,
+    aborts with 400 when it is not a date
+    """
+    if name not in request.args:
+        return None
+    try:
+        return datetime.date.fromisoformat(request.args[name])
+    except ValueError:
+        abort(400)
+
+
+def query_arg():
+    """Returns the ?q= search text, None when missing,
+    aborts with 400 when it is shorter than SEARCH_MIN_LENGTH
+    """
+    q = request.args.get('q', '').strip()
+    if not q:
+        return None
+    if len(q) < SEARCH_MIN_LENGTH:
+        abort(400)
+    return q
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def contains_clause(column, q):
+    """Returns the case insensitive substring match of q on column,
+    served by the pg_trgm index of the column on PostgreSQL"""
+    return column.ilike('%' + escape_like(q) + '%', escape='\\')
+
+
+def actor_filters():
+    """Returns the list of WHERE clauses requested with
+    min_age, max_age, gender (one value or a comma separated list)
+    and q (text contained in the name)
+    """
+    clauses = []
+    q = query_arg()
+    if q is not None:
+        clauses.append(contains_clause(Actor.name, q))
+    min_age = int_arg('min_age')
+    if min_age is not None:
+        clauses.append(Actor.age >= min_age)
+    max_age = int_arg('max_age')
+    if max_age is not None:
+        clauses.append(Actor.age <= max_age)
+    if request.args.get('gender'):
+        genders = [g for g in request.args['gender'].split(',') if g]
+        clauses.append(Actor.gender.in_(genders))
+    return clauses
+
+
+def movie_filters():
+    """Returns the list of WHERE clauses requested with year,
+    released_after, released_before (dates excluded), title_prefix
+    and q (text contained in the title)
+    """
+    clauses = []
+    q = query_arg()
+    if q is not None:
+        clauses.append(contains_clause(Movie.title, q))
+    year = int_arg('year')
+    if year is not None:
+        if not 1 <= year < 9999:
+            abort(400)
+        # a range on the column instead of extract() keeps the index usable
+        clauses.append(Movie.release_date >= datetime.date(year, 1, 1))
+        clauses.append(Movie.release_date < datetime.date(year + 1, 1, 1))
+    released_after = date_arg('released_after')
+    if released_after is not None:
+        clauses.append(Movie.release_date > released_after)
+    released_before = date_arg('released_before')
+    if released_before is not None:
+        clauses.append(Movie.release_date < released_before)
+    if request.args.get('title_prefix'):
+        pattern = escape_like(request.args['title_prefix']) + '%'
+        clauses.append(Movie.title.like(pattern, escape='\\'))
+    return clauses
@@ -0,0 +1,158 @@
+import threading
+from array import array
+from collections import Counter
+from models import db, Casting, table_versions
+
+
+'''
+Co-star graph
+The Casting table held in memory as two adjacency maps of compact
+integer arrays (actor to movies, movie to actors). Writes of this
+process update it in place; a Casting version bumped by any other
+writer makes the next read rebuild it.
+'''
+
+
+def casting_version():
+    return table_versions('Casting').get('Casting', (0,))[0]
+
+
+class CastGraph:
+    """Bipartite actor / movie graph answering co-star and
+    shortest path queries without SQL"""
+
+    def __init__(self):
+        self.movies_of = {}
+        self.actors_of = {}
+        self.version = None
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    # Maintenance
+
+    def refresh(self):
+        """Rebuilds the graph from the Casting table if a write
+        it did not apply changed the table since it was built"""
+        version = casting_version()
+        if version == self.version:
+            return
+        with self._build_lock:
+            if version == self.version:
+                return
+            movies_of, actors_of = {}, {}
+            rows = db.session.query(Casting.actor_id, Casting.movie_id) \
+                .yield_per(10000)
+            for actor_id, movie_id in rows:
+                movies_of.setdefault(actor_id, array('i')).append(movie_id)
+                actors_of.setdefault(movie_id, array('i')).append(actor_id)
+            with self._lock:
+                self.movies_of, self.actors_of = movies_of, actors_of
+                self.version = version
+
+    def apply(self, change, *args):
+        """Applies change(*args) once the write bumping the Casting
+        version was committed, or marks the graph stale when other
+        writes happened since it was last brought up to date"""
+        version = casting_version()
+        with self._lock:
+            if self.version is not None and version == self.version + 1:
+                change(*args)
+                self.version = version
+            else:
+                self.version = None
+
+    def _add(self, pairs):
+        # the version is read before the rows on rebuild, so a pair
+        # may already be there
+        for actor_id, movie_id in pairs:
+            movie_ids = self.movies_of.setdefault(actor_id, array('i'))
+            if movie_id not in movie_ids:
+                movie_ids.append(movie_id)
+                self.actors_of.setdefault(movie_id, array('i')) \
+                    .append(actor_id)
+
+    def _remove_actor(self, actor_id):
+        for movie_id in self.movies_of.pop(actor_id, ()):
+            self.actors_of[movie_id].remove(actor_id)
+
+    def _remove_movie(self, movie_id):
+        for actor_id in self.actors_of.pop(movie_id, ()):
+            self.movies_of[actor_id].remove(movie_id)
+
+    def castings_added(self, pairs):
+        self.apply(self._add, pairs)
+
+    def actor_removed(self, actor_id):
+        self.apply(self._remove_actor, actor_id)
+
+    def movie_removed(self, movie_id):
+        self.apply(self._remove_movie, movie_id)
+
+    # Queries
+
+    def costars(self, actor_id):
+        """Returns the list of (actor id, shared movie count) of the
+        actors cast with actor_id, most shared movies first"""
+        self.refresh()
+        counts = Counter()
+        with self._lock:
+            for movie_id in self.movies_of.get(actor_id, ()):
+                counts.update(self.actors_of[movie_id])
+        counts.pop(actor_id, None)
+        return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+    def shortest_path(self, source, target, max_degrees=None):
+        """Returns the (actor ids, movie ids) of a shortest chain of
+        castings from source to target, movie_ids[i] linking actor_ids[i]
+        and actor_ids[i + 1], None when there is none within max_degrees.
+        Searches from both ends, expanding the smaller frontier first.
+        """
+        self.refresh()
+        if source == target:
+            return [source], []
+        with self._lock:
+            parents = ({source: None}, {target: None})
+            frontiers = ([source], [target])
+            seen_movies = (set(), set())
+            degrees = 0
+            while frontiers[0] and frontiers[1]:
+                if max_degrees is not None and degrees >= max_degrees:
+                    return None
+                side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+                found, other_side = parents[side], parents[1 - side]
+                next_frontier = []
+                for actor_id in frontiers[side]:
+                    for movie_id in self.movies_of.get(actor_id, ()):
+                        if movie_id in seen_movies[side]:
+                            continue
+                        seen_movies[side].add(movie_id)
+                        for other in self.actors_of[movie_id]:
+                            if other in found:
+                                continue
+                            found[other] = (actor_id, movie_id)
+                            if other in other_side:
+                                return self._join(parents, other)
+                            next_frontier.append(other)
+                if side == 0:
+                    frontiers = (next_frontier, frontiers[1])
+                else:
+                    frontiers = (frontiers[0], next_frontier)
+                degrees += 1
+            return None
+
+    def _join(self, parents, meeting):
+        actor_ids, movie_ids = [meeting], []
+        node = meeting
+        while parents[0][node] is not None:
+            node, movie_id = parents[0][node]
+            actor_ids.insert(0, node)
+            movie_ids.insert(0, movie_id)
+        node = meeting
+        while parents[1][node] is not None:
+            node, movie_id = parents[1][node]
+            actor_ids.append(node)
+            movie_ids.append(movie_id)
+        return actor_ids, movie_ids
+
+
+cast_graph = CastGraph()
@@ -0,0 +1,142 @@
+import json
+import re
+import threading
+import time
+from urllib.request import urlopen
+
+
+'''
+JWKS key store
+A process-wide cache of the signing keys published by the identity
+provider, indexed by key id (kid)
+'''
+
+
+MAX_AGE_RE = re.compile(r'(?:^|,)\s*(?:s-)?max-age\s*=\s*"?(\d+)"?', re.I)
+
+
+def parse_max_age(cache_control):
+    """Returns the max-age in seconds of a Cache-Control header value,
+    0 when the response must not be cached, None if no directive is set
+    Keyword arguments:
+    cache_control: Cache-Control header value (string or None)
+    """
+    if not cache_control:
+        return None
+    directives = cache_control.lower()
+    if 'no-store' in directives or 'no-cache' in directives:
+        return 0
+    match = MAX_AGE_RE.search(directives)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+class URLKeySource:
+    """Fetches a JWKS document over http(s) and reports the max-age
+    advertised in its Cache-Control header
+    """
+
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self):
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+            max_age = parse_max_age(response.headers.get('Cache-Control'))
+        return jwks, max_age
+
+    def __repr__(self):
+        return f'<URLKeySource {self.url}>'
+
+
+class FileKeySource:
+    """Reads a JWKS document from a local file,
+    used by tests and benchmarks to run without the network
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self):
+        with open(self.path) as jwks_file:
+            return json.load(jwks_file), None
+
+    def __repr__(self):
+        return f'<FileKeySource {self.path}>'
+
+
+class JWKSKeyStore:
+    """Caches the keys of a JWKS document by kid.
+
+    Keys are refreshed when their ttl (Cache-Control max-age clamped to
+    [min_ttl, max_ttl], default_ttl when absent) runs out or when an
+    unknown kid is requested, at most once every min_ttl seconds.
+    Refreshes are single-flight: concurrent callers wait for the request
+    in progress instead of issuing their own. If a refresh fails the
+    previously fetched keys keep being served.
+
+    Keyword arguments:
+    source: callable returning a (jwks dict, max_age or None) tuple
+    default_ttl: seconds to keep keys when the source sets no max-age
+    min_ttl: lower bound on the ttl and on the interval between refreshes
+    max_ttl: upper bound on the ttl
+    """
+
+    def __init__(self, source, default_ttl=600, min_ttl=30, max_ttl=86400):
+        self.source = source
+        self.default_ttl = default_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self._keys = {}
+        self._expires_at = 0.0
+        self._last_attempt = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def set_source(self, source):
+        """Replaces the key source and drops every cached key"""
+        with self._lock:
+            self.source = source
+            self._keys = {}
+            self._expires_at = 0.0
+            self._last_attempt = None
+            self._generation += 1
+
+    def get_key(self, kid):
+        """Returns the jwk dict for the given kid, or None if the key
+        is unknown even after a refresh
+        Keyword arguments:
+        kid: key id taken from the token header
+        """
+        key = self._keys.get(kid)
+        if key is not None and time.monotonic() < self._expires_at:
+            return key
+        self._refresh(self._generation)
+        return self._keys.get(kid)
+
+    def _refresh(self, seen_generation):
+        with self._lock:
+            # another caller refreshed while this one was waiting
+            if self._generation != seen_generation:
+                return
+            now = time.monotonic()
+            if self._last_attempt is not None and \
+                    now - self._last_attempt < self.min_ttl and \
+                    now < self._expires_at:
+                return
+            self._last_attempt = now
+            try:
+                jwks, max_age = self.source()
+                keys = {key['kid']: key for key in jwks['keys']
+                        if 'kid' in key}
+            except Exception:
+                # keep serving the stale keys, retry after min_ttl
+                self._expires_at = max(self._expires_at, now + self.min_ttl)
+                return
+            ttl = self.default_ttl if max_age is None else max_age
+            ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+            self._keys = keys
+            self._expires_at = now + ttl
+            self._generation += 1
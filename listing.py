@@ -0,0 +1,274 @@
+import base64
+import datetime
+import json
+import os
+from flask import request, abort, Response, stream_with_context
+from sqlalchemy import and_, or_, tuple_, literal
+from serializers import dumps
+
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 1000))
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+'''
+Keyset pagination
+Pages are read in sort order starting after the sort values of the
+last item of the previous page (its id by default), so every page
+costs one index range scan no matter how deep into the table it is
+'''
+
+
+def encode_cursor(values):
+    """Returns an opaque cursor string for the given dict"""
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor):
+    """Returns the dict encoded in the cursor string,
+    raises ValueError if the cursor is malformed
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except Exception:
+        raise ValueError('malformed cursor')
+    if not isinstance(values, dict):
+        raise ValueError('malformed cursor')
+    return values
+
+
+def sort_arg(columns, id_column):
+    """Returns the ordering requested with ?sort=-age,name as a list of
+    (column, descending) pairs, ended by the id column to break ties,
+    aborts with 400 on unknown or repeated columns
+    Keyword arguments:
+    columns: dict of the sortable columns by name
+    id_column: primary key column
+    """
+    order = []
+    names = set()
+    for name in request.args.get('sort', '').split(','):
+        if not name:
+            continue
+        descending = name.startswith('-')
+        name = name[1:] if descending else name
+        if name not in columns or name in names:
+            abort(400)
+        names.add(name)
+        order.append((columns[name], descending))
+    if id_column.key not in names:
+        order.append((id_column, False))
+    return order
+
+
+def fields_arg(columns):
+    """Returns the columns requested with ?fields=id,name, in request
+    order after the id column which is always returned, every column
+    by default, aborts with 400 on unknown columns
+    Keyword arguments:
+    columns: columns of the model, id first
+    """
+    by_name = {column.key: column for column in columns}
+    names = [name for name in request.args.get('fields', '').split(',')
+             if name]
+    if not names:
+        return list(columns)
+    if any(name not in by_name for name in names):
+        abort(400)
+    names = dict.fromkeys([columns[0].key] + names)
+    return [by_name[name] for name in names]
+
+
+def with_sort_columns(fields, order):
+    """Returns the fields followed by the sort columns they miss, which
+    the cursor needs; records() leaves these trailing values out"""
+    names = {column.key for column in fields}
+    return fields + [column for column, _ in order
+                     if column.key not in names]
+
+
+def sort_key(order):
+    return ','.join(('-' if descending else '') + column.key
+                    for column, descending in order)
+
+
+def is_id_order(order):
+    return sort_key(order) == 'id'
+
+
+def cursor_values(cursor, order):
+    """Returns the sort values stored in a decoded cursor,
+    raises ValueError if the cursor was built for another ordering
+    """
+    if is_id_order(order):
+        return [int(cursor['id'])]
+    if cursor.get('sort') != sort_key(order) or \
+            len(cursor.get('after') or ()) != len(order):
+        raise ValueError('cursor of another sort order')
+    values = []
+    for (column, _), value in zip(order, cursor['after']):
+        python_type = column.type.python_type
+        if python_type is datetime.date:
+            value = datetime.date.fromisoformat(value)
+        elif not isinstance(value, python_type):
+            raise ValueError('malformed cursor')
+        values.append(value)
+    return values
+
+
+def page_args(order):
+    """Returns the (limit, after) tuple requested with the limit and
+    cursor or after_id query parameters, after being the sort values of
+    the last item of the previous page (None for the first page),
+    aborts with 400 when they are invalid
+    Keyword arguments:
+    order: list of (column, descending) pairs, as returned by sort_arg
+    """
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        if 'cursor' in request.args:
+            after = cursor_values(
+                decode_cursor(request.args['cursor']), order)
+        elif 'after_id' in request.args and is_id_order(order):
+            after = [int(request.args['after_id'])]
+        elif 'after_id' in request.args:
+            raise ValueError('after_id needs the default sort order')
+        else:
+            after = None
+    except (ValueError, KeyError, TypeError):
+        abort(400)
+    if limit < 1:
+        abort(400)
+    return min(limit, MAX_PAGE_SIZE), after
+
+
+def order_by(order):
+    return [column.desc() if descending else column
+            for column, descending in order]
+
+
+def after_clause(order, values):
+    """Returns the WHERE clause selecting the rows sorted after values"""
+    directions = {descending for _, descending in order}
+    if len(directions) == 1:
+        # one row value comparison, served by a composite index range scan
+        columns = tuple_(*[column for column, _ in order])
+        bound = tuple_(*[literal(v) for v in values])
+        return columns < bound if directions.pop() else columns > bound
+    clauses = []
+    for index, (column, descending) in enumerate(order):
+        equal = [c == v for (c, _), v in zip(order[:index], values)]
+        beyond = column < values[index] if descending \
+            else column > values[index]
+        clauses.append(and_(*equal, beyond))
+    # the bound on the first column lets an index on it limit the scan
+    first, descending = order[0]
+    bound = first <= values[0] if descending else first >= values[0]
+    return and_(bound, or_(*clauses))
+
+
+def paginate(query, order, limit, after):
+    """Returns the (items, next_cursor) tuple for one page of the query,
+    next_cursor is None on the last page
+    Keyword arguments:
+    query: SQLAlchemy query to paginate
+    order: list of (column, descending) pairs the pages are sorted by
+    limit: page size
+    after: sort values of the last item of the previous page, or None
+    """
+    if after is not None:
+        query = query.filter(after_clause(order, after))
+    items = query.order_by(*order_by(order)).limit(limit + 1).all()
+    if len(items) <= limit:
+        return items, None
+    items = items[:limit]
+    if is_id_order(order):
+        return items, encode_cursor({'id': items[-1].id})
+    values = [getattr(items[-1], column.key) for column, _ in order]
+    return items, encode_cursor({
+        'sort': sort_key(order),
+        'after': [v.isoformat() if isinstance(v, datetime.date) else v
+                  for v in values]})
+
+
+def offset_args():
+    """Returns the (limit, offset) tuple of a ranked listing, requested
+    with the limit and cursor query parameters,
+    aborts with 400 when they are invalid
+    """
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        offset = 0
+        if 'cursor' in request.args:
+            offset = int(decode_cursor(request.args['cursor'])['offset'])
+    except (ValueError, KeyError, TypeError):
+        abort(400)
+    if limit < 1 or offset < 0:
+        abort(400)
+    return min(limit, MAX_PAGE_SIZE), offset
+
+
+def id_list_arg():
+    """Returns the list of distinct ids requested with ?ids=1,2,3
+    or a json body {"ids": [1, 2, 3]}, in request order,
+    aborts with 400 when the list is empty, invalid or longer
+    than MAX_PAGE_SIZE
+    """
+    try:
+        if request.method == 'POST':
+            ids = (request.get_json() or {})['ids']
+        else:
+            ids = request.args['ids'].split(',')
+        ids = list(dict.fromkeys(int(id) for id in ids))
+    except (ValueError, KeyError, TypeError):
+        abort(400)
+    if not ids or len(ids) > MAX_PAGE_SIZE:
+        abort(400)
+    return ids
+
+
+'''
+NDJSON streaming
+Full listings written one row per line while the rows are fetched
+from a server-side cursor, so memory use does not grow with the table
+'''
+
+
+def wants_stream():
+    """Returns True if the request asks for the whole listing as NDJSON,
+    with ?stream=1 or an Accept: application/x-ndjson header
+    """
+    if request.args.get('stream', '').lower() in ('1', 'true'):
+        return True
+    best = request.accept_mimetypes.best_match(
+        ['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def stream_ndjson(query, order, columns):
+    """Returns a streamed response with one json object per line
+    for every row of the query, in sort order, written in chunks of
+    STREAM_BATCH_SIZE lines
+    Keyword arguments:
+    query: SQLAlchemy query of the column tuples
+    order: list of (column, descending) pairs the rows are sorted by
+    columns: columns written, the first ones selected by the query
+    """
+    names = [column.key for column in columns]
+
+    def generate():
+        rows = query.order_by(*order_by(order)).yield_per(STREAM_BATCH_SIZE)
+        lines = []
+        for row in rows:
+            lines.append(dumps(dict(zip(names, row))))
+            if len(lines) == STREAM_BATCH_SIZE:
+                yield b'\n'.join(lines) + b'\n'
+                lines = []
+        if lines:
+            yield b'\n'.join(lines) + b'\n'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
@@ -1,8 +1,12 @@
-from flask_script import Manager
+import os
+import sys
+from flask_script import Manager, Command
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from models import db, refresh_stats
+from transfer import TABLES, FORMATS, export_table, import_table, \
+    empty_tables
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +14,77 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+def table_files(table, fmt, path):
+    """Returns the (name, model, file path) tuples of the tables to move,
+    a single table uses path as file ('-' for stdout/stdin),
+    all tables use path as the directory of actors.<fmt>, movies.<fmt>
+    and cast.<fmt>, in foreign key order"""
+    if table == 'all':
+        return [(name, model, os.path.join(path, f'{name}.{fmt}'))
+                for name, model in TABLES.items()]
+    return [(table, TABLES[table], path)]
+
+
+@manager.option('-t', '--table', dest='table', default='all',
+                choices=['all'] + list(TABLES), help='table to export')
+@manager.option('-f', '--format', dest='fmt', default='csv',
+                choices=FORMATS, help='file format')
+@manager.option('-o', '--output', dest='path', default='-',
+                help='output file, or directory when exporting all tables')
+def export_data(table, fmt, path):
+    """Exports tables as CSV or NDJSON (COPY TO STDOUT on PostgreSQL)"""
+    if table == 'all' and path != '-':
+        os.makedirs(path, exist_ok=True)
+    elif table == 'all':
+        path = '.'
+    for name, model, file_path in table_files(table, fmt, path):
+        if file_path == '-':
+            count = export_table(model, sys.stdout, fmt)
+        else:
+            with open(file_path, 'w', newline='') as out:
+                count = export_table(model, out, fmt)
+        print(f'{name}: {count} rows exported', file=sys.stderr)
+
+
+@manager.option('-t', '--table', dest='table', default='all',
+                choices=['all'] + list(TABLES), help='table to import')
+@manager.option('-f', '--format', dest='fmt', default='csv',
+                choices=FORMATS, help='file format')
+@manager.option('-i', '--input', dest='path', default='-',
+                help='input file, or directory when importing all tables')
+@manager.option('--replace', dest='replace', action='store_true',
+                help='empty the tables before importing')
+def import_data(table, fmt, path, replace):
+    """Imports tables from CSV or NDJSON (COPY FROM STDIN on PostgreSQL)"""
+    if table == 'all' and path == '-':
+        path = '.'
+    files = table_files(table, fmt, path)
+    if replace and table == 'all':
+        # emptied together up front so that a cascade from actors or
+        # movies does not remove freshly imported castings
+        empty_tables(TABLES.values())
+        replace = False
+    for name, model, file_path in files:
+        if file_path == '-':
+            read, inserted = import_table(model, sys.stdin, fmt, replace)
+        else:
+            with open(file_path, newline='') as source:
+                read, inserted = import_table(model, source, fmt, replace)
+        print(f'{name}: {read} rows read, {inserted} inserted',
+              file=sys.stderr)
+
+
+class RebuildStats(Command):
+    """Rebuilds the summary counters of /stats from the tables,
+    to run on a schedule if writes bypassing the API change them"""
+
+    def run(self):
+        refresh_stats()
+        print('summary counters rebuilt', file=sys.stderr)
+
+
+manager.add_command('rebuild_stats', RebuildStats())
+
+
 if __name__ == '__main__':
     manager.run()
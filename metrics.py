@@ -0,0 +1,222 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import request, g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+'''
+Request instrumentation
+Every request accumulates in g the seconds spent in each phase
+(auth, db, serialize) and its number of SQL statements. The totals go
+back to the client in a Server-Timing header and into per route
+histograms exposed in the Prometheus text format. The histograms are
+kept per worker process.
+'''
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class Histogram:
+    """Cumulative histogram of one series per combination of label values
+    Keyword arguments:
+    name: metric name
+    description: HELP text
+    labels: label names
+    buckets: increasing upper bounds, +Inf is implied
+    """
+
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = \
+                    [[0] * len(self.buckets), 0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def exposition(self):
+        """Returns the lines of the histogram in the text format"""
+        lines = [f'# HELP {self.name} {self.description}',
+                 f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, list(counts), total, count)
+                            for labels, (counts, total, count)
+                            in self._series.items())
+        for label_values, counts, total, count in series:
+            labels = ','.join(f'{name}="{escape_label(value)}"'
+                              for name, value in zip(self.labels, label_values))
+            prefix = labels + ',' if labels else ''
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} '
+                             f'{cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {count}')
+        return lines
+
+
+request_seconds = Histogram(
+    'http_request_duration_seconds', 'Time to answer a request.',
+    ('method', 'route', 'status'), LATENCY_BUCKETS)
+phase_seconds = Histogram(
+    'http_request_phase_seconds',
+    'Time a request spent verifying its token (auth), running SQL (db) '
+    'and encoding its response (serialize).',
+    ('method', 'route', 'phase'), LATENCY_BUCKETS)
+request_queries = Histogram(
+    'http_request_queries', 'SQL statements run by a request.',
+    ('method', 'route'), QUERY_COUNT_BUCKETS)
+
+HISTOGRAMS = (request_seconds, phase_seconds, request_queries)
+PHASES = ('auth', 'db', 'serialize')
+
+
+def add_timing(phase, seconds):
+    """Adds seconds to the phase of the current request, if any"""
+    if has_request_context() and 'timings' in g:
+        g.timings[phase] = g.timings.get(phase, 0) + seconds
+
+
+@contextmanager
+def timed(phase):
+    """Context manager adding the time spent in its block to the phase
+    of the current request"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(phase, time.perf_counter() - started)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    started = getattr(context, 'query_started', None)
+    if started is not None and has_request_context() and 'timings' in g:
+        g.timings['db'] = g.timings.get('db', 0) + \
+            time.perf_counter() - started
+        g.queries += 1
+
+
+def route_label():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def server_timing(timings, queries, total):
+    """Returns the Server-Timing header value, durations in ms"""
+    entries = []
+    for phase in PHASES:
+        if phase in timings or phase == 'db':
+            entry = f'{phase};dur={timings.get(phase, 0) * 1000:.2f}'
+            if phase == 'db':
+                entry += f';desc="{queries} queries"'
+            entries.append(entry)
+    entries.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(entries)
+
+
+def setup_metrics(app):
+    """Times every request of the app and counts its SQL statements,
+    listening to the statements of every engine, replicas included"""
+    if not event.contains(Engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+    @app.before_request
+    def start_timing():
+        g.request_started = time.perf_counter()
+        g.timings = {}
+        g.queries = 0
+
+    @app.after_request
+    def record_timing(response):
+        if 'request_started' not in g:
+            return response
+        total = time.perf_counter() - g.request_started
+        response.headers['Server-Timing'] = \
+            server_timing(g.timings, g.queries, total)
+        route = route_label()
+        request_seconds.observe(
+            total, request.method, route, response.status_code)
+        for phase, seconds in g.timings.items():
+            phase_seconds.observe(seconds, request.method, route, phase)
+        request_queries.observe(g.queries, request.method, route)
+        return response
+
+
+def gauge_lines(name, description, value, kind='gauge'):
+    return [f'# HELP {name} {description}', f'# TYPE {name} {kind}',
+            f'{name} {value}']
+
+
+def exposition(pool=None, token_cache=None):
+    """Returns the histograms, the counters of the connection pool
+    given as a pool_stats dict and those of the verified token cache
+    given as an LRUCache.stats() dict, in the Prometheus text format"""
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.exposition())
+    if pool is not None and 'checkouts' in pool:
+        lines += gauge_lines('db_pool_checked_out',
+                             'Connections in use.', pool['checked_out'])
+        lines += gauge_lines('db_pool_overflow',
+                             'Connections open beyond the pool size.',
+                             pool['overflow'])
+        lines += gauge_lines('db_pool_checkouts_total',
+                             'Connections handed out.',
+                             pool['checkouts'], 'counter')
+        lines += gauge_lines('db_pool_waits_total',
+                             'Checkouts that waited for a free connection.',
+                             pool['waits'], 'counter')
+        lines += gauge_lines('db_pool_wait_seconds_total',
+                             'Time checkouts spent waiting.',
+                             pool['wait_seconds'], 'counter')
+        lines += gauge_lines('db_pool_timeouts_total',
+                             'Checkouts that gave up waiting.',
+                             pool['timeouts'], 'counter')
+    if token_cache is not None:
+        lines += gauge_lines('auth_token_cache_size',
+                             'Verified tokens cached.', token_cache['size'])
+        lines += gauge_lines('auth_token_cache_hits_total',
+                             'Tokens found in the cache, signature check '
+                             'skipped.', token_cache['hits'], 'counter')
+        lines += gauge_lines('auth_token_cache_misses_total',
+                             'Tokens verified because they were not cached.',
+                             token_cache['misses'], 'counter')
+        lines += gauge_lines('auth_token_cache_evictions_total',
+                             'Tokens dropped to make room for others.',
+                             token_cache['evictions'], 'counter')
+    lines += gauge_lines('process_id', 'Worker process answering.',
+                         os.getpid())
+    return '\n'.join(lines) + '\n'
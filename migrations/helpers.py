@@ -0,0 +1,16 @@
+'''
+Migration helpers
+Shared by the revisions building indexes with CREATE INDEX CONCURRENTLY
+'''
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def drop_invalid_index(bind, name):
+    """Drops what a failed CREATE INDEX CONCURRENTLY left behind"""
+    invalid = bind.execute(sa.text(
+        'SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid '
+        'WHERE c.relname = :name AND NOT i.indisvalid'), name=name).scalar()
+    if invalid:
+        op.execute(f'DROP INDEX CONCURRENTLY {name}')
@@ -0,0 +1,47 @@
+"""Trigram indexes for the actor name and movie title search
+
+Revision ID: 3e12ca03461b
+Revises: 598d3656aa8a
+Create Date: 2026-10-18 14:03:52.114960
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from migrations.helpers import drop_invalid_index
+
+
+# revision identifiers, used by Alembic.
+revision = '3e12ca03461b'
+down_revision = '598d3656aa8a'
+branch_labels = None
+depends_on = None
+
+
+# (name, table, column); other databases search an in-memory index
+INDEXES = [
+    ('ix_actor_name_trgm', 'Actor', 'name'),
+    ('ix_movie_title_trgm', 'Movie', 'title'),
+]
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    with op.get_context().autocommit_block():
+        for name, table, column in INDEXES:
+            drop_invalid_index(bind, name)
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} '
+                       f'ON "{table}" USING gin ({column} gin_trgm_ops)')
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+
+    with op.get_context().autocommit_block():
+        for name, _, _ in INDEXES:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
@@ -0,0 +1,65 @@
+"""Indexes for the actor and movie listing filters
+
+Revision ID: 598d3656aa8a
+Revises: c93ba90795e5
+Create Date: 2026-10-18 11:40:06.527831
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from migrations.helpers import drop_invalid_index
+
+
+# revision identifiers, used by Alembic.
+revision = '598d3656aa8a'
+down_revision = 'c93ba90795e5'
+branch_labels = None
+depends_on = None
+
+
+# (name, table, columns); the id column makes the sorted keyset
+# pages an index range scan
+INDEXES = [
+    ('ix_actor_age', 'Actor', ['age', 'id']),
+    ('ix_actor_gender', 'Actor', ['gender', 'id']),
+    ('ix_movie_release_date', 'Movie', ['release_date', 'id']),
+    ('ix_movie_title_pattern', 'Movie', ['title']),
+]
+
+# title_prefix LIKE 'abc%' only uses a pattern ops index outside
+# the C collation
+PG_OPS = {'ix_movie_title_pattern': {'title': 'varchar_pattern_ops'}}
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    existing = {i['name'] for table in ('Actor', 'Movie')
+                for i in inspector.get_indexes(table)}
+
+    if bind.dialect.name != 'postgresql':
+        for name, table, columns in INDEXES:
+            if name not in existing:
+                op.create_index(name, table, columns)
+        return
+
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            drop_invalid_index(bind, name)
+            ops = PG_OPS.get(name, {})
+            column_list = ', '.join(
+                f'{c} {ops[c]}' if c in ops else c for c in columns)
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} '
+                       f'ON "{table}" ({column_list})')
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        for name, table, _ in INDEXES:
+            op.drop_index(name, table)
+        return
+
+    with op.get_context().autocommit_block():
+        for name, _, _ in INDEXES:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
@@ -0,0 +1,71 @@
+"""Summary counters of /stats
+
+Revision ID: 96c7c31db5de
+Revises: cb031b1ce653
+Create Date: 2026-10-18 15:34:47.861203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '96c7c31db5de'
+down_revision = 'cb031b1ce653'
+branch_labels = None
+depends_on = None
+
+
+RANKING = 'ix_stat_counter_ranking'
+
+counters = sa.table('StatCounter', sa.column('metric', sa.String),
+                    sa.column('key', sa.Integer), sa.column('value', sa.Integer))
+actors = sa.table('Actor', sa.column('id'))
+movies = sa.table('Movie', sa.column('id'), sa.column('release_date'))
+castings = sa.table('Casting', sa.column('id'), sa.column('actor_id'),
+                    sa.column('movie_id'))
+
+
+def aggregates():
+    """The INSERT ... SELECT sources of every counter,
+    as models.refresh_stats builds them"""
+    year = sa.cast(sa.func.extract('year', movies.c.release_date), sa.Integer)
+    return [
+        sa.select([sa.literal('actors'), sa.literal(0), sa.func.count()])
+        .select_from(actors),
+        sa.select([sa.literal('movies'), sa.literal(0), sa.func.count()])
+        .select_from(movies),
+        sa.select([sa.literal('castings'), sa.literal(0), sa.func.count()])
+        .select_from(castings),
+        sa.select([sa.literal('movies_per_year'), year, sa.func.count()])
+        .group_by(year),
+        sa.select([sa.literal('actor_movies'), castings.c.actor_id,
+                   sa.func.count()]).group_by(castings.c.actor_id),
+        sa.select([sa.literal('movie_actors'), castings.c.movie_id,
+                   sa.func.count()]).group_by(castings.c.movie_id)]
+
+
+def upgrade():
+    bind = op.get_bind()
+    # databases started before this revision got the table from create_all
+    if 'StatCounter' not in sa.inspect(bind).get_table_names():
+        op.create_table(
+            'StatCounter',
+            sa.Column('metric', sa.String(32), primary_key=True),
+            sa.Column('key', sa.Integer(), primary_key=True,
+                      autoincrement=False),
+            sa.Column('value', sa.Integer(), nullable=False))
+        op.create_index(RANKING, 'StatCounter',
+                        ['metric', sa.text('value DESC'), 'key'])
+
+    # recount even existing counters, the casting indexes revision
+    # deleted duplicated castings they still include
+    op.execute(counters.delete())
+    for aggregate in aggregates():
+        op.execute(counters.insert().from_select(
+            ['metric', 'key', 'value'], aggregate))
+
+
+def downgrade():
+    op.drop_index(RANKING, 'StatCounter')
+    op.drop_table('StatCounter')
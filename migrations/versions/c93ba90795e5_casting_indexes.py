@@ -0,0 +1,77 @@
+"""Casting indexes and unique actor / movie pairs
+
+Revision ID: c93ba90795e5
+Revises:
+Create Date: 2026-10-18 09:12:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from migrations.helpers import drop_invalid_index
+
+
+# revision identifiers, used by Alembic.
+revision = 'c93ba90795e5'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+UNIQUE = 'uq_casting_actor_movie'
+BY_MOVIE = 'ix_casting_movie_actor'
+
+
+def index_names(bind):
+    inspector = sa.inspect(bind)
+    names = {i['name'] for i in inspector.get_indexes('Casting')}
+    names.update(c['name'] for c in inspector.get_unique_constraints('Casting'))
+    return names
+
+
+def upgrade():
+    bind = op.get_bind()
+    # keep the first casting of every duplicated pair
+    op.execute(
+        'DELETE FROM "Casting" WHERE id IN ('
+        'SELECT c.id FROM "Casting" c JOIN "Casting" d '
+        'ON d.actor_id = c.actor_id AND d.movie_id = c.movie_id '
+        'AND d.id < c.id)')
+    existing = index_names(bind)
+
+    if bind.dialect.name != 'postgresql':
+        if UNIQUE not in existing:
+            op.create_index(UNIQUE, 'Casting', ['actor_id', 'movie_id'],
+                            unique=True)
+        if BY_MOVIE not in existing:
+            op.create_index(BY_MOVIE, 'Casting', ['movie_id', 'actor_id'])
+        return
+
+    # CONCURRENTLY builds the indexes without blocking writes,
+    # it cannot run inside the migration transaction
+    with op.get_context().autocommit_block():
+        for name in (UNIQUE, BY_MOVIE):
+            drop_invalid_index(bind, name)
+        op.execute(
+            f'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {UNIQUE} '
+            'ON "Casting" (actor_id, movie_id)')
+        op.execute(
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {BY_MOVIE} '
+            'ON "Casting" (movie_id, actor_id)')
+    unique_constraints = {
+        c['name'] for c in sa.inspect(bind).get_unique_constraints('Casting')}
+    if UNIQUE not in unique_constraints:
+        # only takes a short lock, the index is already built
+        op.execute(f'ALTER TABLE "Casting" ADD CONSTRAINT {UNIQUE} '
+                   f'UNIQUE USING INDEX {UNIQUE}')
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        op.drop_index(BY_MOVIE, 'Casting')
+        op.drop_index(UNIQUE, 'Casting')
+        return
+
+    op.execute(f'ALTER TABLE "Casting" DROP CONSTRAINT IF EXISTS {UNIQUE}')
+    with op.get_context().autocommit_block():
+        op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {BY_MOVIE}')
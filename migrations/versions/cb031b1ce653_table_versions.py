@@ -0,0 +1,48 @@
+"""Version counters of the Actor, Movie and Casting tables
+
+Revision ID: cb031b1ce653
+Revises: 3e12ca03461b
+Create Date: 2026-10-18 15:21:09.402518
+
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'cb031b1ce653'
+down_revision = '3e12ca03461b'
+branch_labels = None
+depends_on = None
+
+
+# tables whose ETags and cached responses follow a version row
+VERSIONED_TABLES = ('Actor', 'Movie', 'Casting')
+
+
+def upgrade():
+    bind = op.get_bind()
+    # databases started before this revision got the table from create_all
+    if 'TableVersion' not in sa.inspect(bind).get_table_names():
+        op.create_table(
+            'TableVersion',
+            sa.Column('table_name', sa.String(64), primary_key=True),
+            sa.Column('version', sa.Integer(), nullable=False),
+            sa.Column('updated_at', sa.DateTime(), nullable=False))
+
+    versions = sa.table('TableVersion',
+                        sa.column('table_name', sa.String),
+                        sa.column('version', sa.Integer),
+                        sa.column('updated_at', sa.DateTime))
+    existing = {r[0] for r in bind.execute(sa.select([versions.c.table_name]))}
+    now = datetime.datetime.utcnow()
+    rows = [{'table_name': table, 'version': 0, 'updated_at': now}
+            for table in VERSIONED_TABLES if table not in existing]
+    if rows:
+        op.bulk_insert(versions, rows)
+
+
+def downgrade():
+    op.drop_table('TableVersion')
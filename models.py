@@ -1,33 +1,130 @@
-from sqlalchemy import Column, String, Integer, Date, Table, ForeignKey, create_engine
+from sqlalchemy import Column, String, Integer, Date, DateTime, Table, ForeignKey, create_engine, \
+    Index, UniqueConstraint, DDL, event, func, literal, select, text, cast
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import column_property, attributes
+from collections import Counter
+from pool import engine_options
+from replicas import RoutingSQLAlchemy, ReplicaSet
+from slow_queries import slow_query_log
+import datetime
 import json
 import os
 
 database_path = os.environ['DATABASE_URL']
-db = SQLAlchemy()
+replica_paths = [url.strip() for url in
+                 os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                 if url.strip()]
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    with the pool settings of pool.engine_options
+    and the read replicas of replica_paths;
+    the session is removed by the teardown_appcontext hook
+    Flask-SQLAlchemy registers, so views don't close it;
+    the slow statements of all engines go to the slow query log
+    when SLOW_QUERY_MS is set
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path,
+             replica_paths=replica_paths, **options):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        database_path, **options)
+    if app.extensions.get('replicas') is not None:
+        app.extensions['replicas'].dispose()
+    app.extensions['replicas'] = \
+        ReplicaSet(replica_paths) if replica_paths else None
     db.app = app
     db.init_app(app)
+    if slow_query_log.threshold_ms:
+        slow_query_log.watch(db.engine)
+        for replica in getattr(app.extensions['replicas'], 'replicas', ()):
+            slow_query_log.watch(replica.engine)
     db.create_all()
+    init_versions()
+    init_stats()
+
+
+'''
+Table versions
+One row per table whose version is bumped in the same transaction as
+every write to the table, so read endpoints can build ETags without
+loading any row
+'''
+
+
+class TableVersion(db.Model):
+    __tablename__ = 'TableVersion'
+
+    table_name = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False,
+                        default=datetime.datetime.utcnow)
+
+
+VERSIONED_TABLES = ('Actor', 'Movie', 'Casting')
+
+
+def init_versions():
+    """Creates the missing version rows"""
+    existing = {r[0] for r in db.session.query(TableVersion.table_name)}
+    for table in VERSIONED_TABLES:
+        if table not in existing:
+            db.session.add(TableVersion(table_name=table, version=0))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # created by another worker in the meantime
+        db.session.rollback()
+
+
+def bump_versions(*tables):
+    """Increments the version of the tables in the current transaction,
+    the caller commits"""
+    db.session.query(TableVersion) \
+        .filter(TableVersion.table_name.in_(tables)) \
+        .update({TableVersion.version: TableVersion.version + 1,
+                 TableVersion.updated_at: datetime.datetime.utcnow()},
+                synchronize_session=False)
+
+
+def table_versions(*tables):
+    """Returns a dict mapping each table to its (version, updated_at)"""
+    rows = db.session.query(
+        TableVersion.table_name, TableVersion.version, TableVersion.updated_at) \
+        .filter(TableVersion.table_name.in_(tables))
+    return {name: (version, updated_at) for name, version, updated_at in rows}
+
+
+def group_related(rows):
+    """Groups the (id, label, related label) rows of an outer JOIN
+    into a dict mapping id to (label, list of related labels)"""
+    grouped = {}
+    for id, label, related in rows:
+        entry = grouped.setdefault(id, (label, []))
+        if related is not None:
+            entry[1].append(related)
+    return grouped
 
 
 class Movie(db.Model):
     """Movie have title and release date"""
     __tablename__ = 'Movie'
+    __table_args__ = (
+        Index('ix_movie_release_date', 'release_date', 'id'),
+        Index('ix_movie_title_pattern', 'title',
+              postgresql_ops={'title': 'varchar_pattern_ops'}))
 
     id = Column(Integer, primary_key=True)
     title = Column(String(120), nullable=False)
-    release_date = Column(Date, nullable=False)
+    # the year counters need the previous date of an updated movie
+    release_date = column_property(Column(Date, nullable=False),
+                                   active_history=True)
     actors = db.relationship('Casting',
                              backref='movie',
                              lazy=True,
@@ -42,13 +139,16 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_versions('Movie')
         db.session.commit()
 
     def update(self):
+        bump_versions('Movie')
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        bump_versions('Movie', 'Casting')
         db.session.commit()
 
     def format(self):
@@ -62,7 +162,24 @@ class Movie(db.Model):
             'id': self.id,
             'title': self.title,
             'release_date': self.release_date.strftime('%Y-%m-%d'),
-            'actors': [actor.format()['actor_id'] for actor in self.actors]}
+            'actors': [cast.actor_id for cast in self.actors]}
+
+    @classmethod
+    def cast_lists(cls, movie_ids):
+        """Returns a dict mapping each existing movie id to its
+        (title, actor names) tuple, read with one JOIN through Casting"""
+        rows = db.session.query(cls.id, cls.title, Actor.name) \
+            .outerjoin(Casting, Casting.movie_id == cls.id) \
+            .outerjoin(Actor, Actor.id == Casting.actor_id) \
+            .filter(cls.id.in_(movie_ids)) \
+            .order_by(cls.id, Actor.id).all()
+        return group_related(rows)
+
+    @classmethod
+    def cast_list(cls, movie_id):
+        """Returns the (title, actor names) tuple of the movie,
+        None if the movie does not exist"""
+        return cls.cast_lists([movie_id]).get(movie_id)
 
     def __repr__(self):
         return f'<Movie {self.format()}>'
@@ -71,6 +188,9 @@ class Movie(db.Model):
 class Actor(db.Model):
     """Actor have name, age and gender"""
     __tablename__ = 'Actor'
+    __table_args__ = (
+        Index('ix_actor_age', 'age', 'id'),
+        Index('ix_actor_gender', 'gender', 'id'))
 
     id = Column(Integer, primary_key=True)
     name = Column(String(120), nullable=False)
@@ -89,13 +209,16 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_versions('Actor')
         db.session.commit()
 
     def update(self):
+        bump_versions('Actor')
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        bump_versions('Actor', 'Casting')
         db.session.commit()
 
     def format(self):
@@ -111,14 +234,40 @@ class Actor(db.Model):
             'name': self.name,
             'age': self.age,
             'gender': self.gender,
-            'movies': [movie.format()['movie_id'] for movie in self.movies]}
+            'movies': [cast.movie_id for cast in self.movies]}
+
+    @classmethod
+    def filmographies(cls, actor_ids):
+        """Returns a dict mapping each existing actor id to its
+        (name, movie titles) tuple, read with one JOIN through Casting"""
+        rows = db.session.query(cls.id, cls.name, Movie.title) \
+            .outerjoin(Casting, Casting.actor_id == cls.id) \
+            .outerjoin(Movie, Movie.id == Casting.movie_id) \
+            .filter(cls.id.in_(actor_ids)) \
+            .order_by(cls.id, Movie.id).all()
+        return group_related(rows)
+
+    @classmethod
+    def filmography(cls, actor_id):
+        """Returns the (name, movie titles) tuple of the actor,
+        None if the actor does not exist"""
+        return cls.filmographies([actor_id]).get(actor_id)
 
     def __repr__(self):
         return f'<Actor {self.format()}>'
 
 
 class Casting(db.Model):
+    """Casting pairs an actor with a movie, at most once.
+    The unique index on (actor_id, movie_id) serves the lookups by actor,
+    the (movie_id, actor_id) index the lookups by movie; both also back
+    the cascading deletes of actors and movies
+    """
     __tablename__ = 'Casting'
+    __table_args__ = (
+        UniqueConstraint('actor_id', 'movie_id',
+                         name='uq_casting_actor_movie'),
+        Index('ix_casting_movie_actor', 'movie_id', 'actor_id'))
 
     id = Column(Integer, primary_key=True)
     actor_id = Column(Integer, ForeignKey('Actor.id'), nullable=False)
@@ -130,6 +279,7 @@ class Casting(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_versions('Casting')
         db.session.commit()
 
     def format(self):
@@ -140,3 +290,173 @@ class Casting(db.Model):
 
     def __repr__(self):
         return f'<Casting {self.format()}>'
+
+
+'''
+Trigram indexes
+GIN indexes of the searched columns, created with the tables on
+PostgreSQL (existing databases get them from the migrations)
+'''
+
+event.listen(db.metadata, 'before_create', DDL(
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+for table, column in ((Actor.__table__, 'name'), (Movie.__table__, 'title')):
+    event.listen(table, 'after_create', DDL(
+        f'CREATE INDEX IF NOT EXISTS ix_{table.name.lower()}_{column}_trgm '
+        f'ON "{table.name}" USING gin ({column} gin_trgm_ops)'
+    ).execute_if(dialect='postgresql'))
+
+
+'''
+Summary counters
+Aggregates of the tables kept as (metric, key, value) rows and updated
+in the transaction of every write, so reports never scan the tables:
+    actors, movies, castings  row counts (key 0)
+    movies_per_year           movies released each year (key year)
+    actor_movies              movies of each actor (key actor id)
+    movie_actors              actors of each movie (key movie id)
+Writes through the session are counted by the before_flush listener,
+bulk writes call count_stats themselves.
+'''
+
+
+class StatCounter(db.Model):
+    __tablename__ = 'StatCounter'
+
+    metric = Column(String(32), primary_key=True)
+    key = Column(Integer, primary_key=True, autoincrement=False)
+    value = Column(Integer, nullable=False, default=0)
+
+
+# highest values first, ties by key, for the rankings of the reports
+Index('ix_stat_counter_ranking', StatCounter.metric,
+      StatCounter.value.desc(), StatCounter.key)
+
+
+# adds to the counter, creating it when missing
+UPSERT_COUNTER = text(
+    'INSERT INTO "StatCounter" (metric, key, value) '
+    'VALUES (:metric, :key, :value) '
+    'ON CONFLICT (metric, key) '
+    'DO UPDATE SET value = "StatCounter".value + excluded.value')
+
+DELETE_EMPTY_COUNTER = text(
+    'DELETE FROM "StatCounter" '
+    'WHERE metric = :metric AND key = :key AND value = 0')
+
+
+def release_year(value):
+    """Returns the year of a release date, a date or a YYYY-MM-DD string,
+    raises ValueError for anything else"""
+    if isinstance(value, datetime.date):
+        return value.year
+    if isinstance(value, str):
+        return datetime.date.fromisoformat(value).year
+    raise ValueError(f'release date expected, got {value!r}')
+
+
+def row_deltas(model, rows, sign=1):
+    """Returns the Counter of the (metric, key) changes made by
+    inserting rows, or by deleting them when sign is -1
+    Keyword arguments:
+    model: Actor, Movie or Casting
+    rows: list of column dicts
+    sign: 1 or -1
+    """
+    deltas = Counter()
+    if not rows:
+        return deltas
+    if model is Actor:
+        deltas[('actors', 0)] += sign * len(rows)
+    elif model is Movie:
+        deltas[('movies', 0)] += sign * len(rows)
+        for row in rows:
+            deltas[('movies_per_year', release_year(row['release_date']))] \
+                += sign
+    elif model is Casting:
+        deltas[('castings', 0)] += sign * len(rows)
+        for row in rows:
+            deltas[('actor_movies', row['actor_id'])] += sign
+            deltas[('movie_actors', row['movie_id'])] += sign
+    return deltas
+
+
+def release_date_deltas(changes):
+    """Returns the Counter of the movies_per_year changes made by moving
+    movies from one release date to another
+    Keyword arguments:
+    changes: iterable of (old release date, new release date) tuples
+    """
+    deltas = Counter()
+    for old, new in changes:
+        deltas[('movies_per_year', release_year(old))] -= 1
+        deltas[('movies_per_year', release_year(new))] += 1
+    return deltas
+
+
+def count_stats(deltas):
+    """Adds the Counter of (metric, key) changes to the summary counters
+    in the current transaction, the caller commits"""
+    # a fixed order keeps concurrent writers from deadlocking
+    params = [{'metric': metric, 'key': key, 'value': value}
+              for (metric, key), value in sorted(deltas.items()) if value]
+    if not params:
+        return
+    db.session.execute(UPSERT_COUNTER, params)
+    decreased = [p for p in params if p['value'] < 0]
+    if decreased:
+        db.session.execute(DELETE_EMPTY_COUNTER, decreased)
+
+
+@event.listens_for(db.session, 'before_flush')
+def count_flushed(session, flush_context, instances):
+    """Counts the actors, movies and castings the flush inserts or
+    deletes, cascades included, and the movies changing year"""
+    deltas = Counter()
+    for sign, objects in ((1, session.new), (-1, session.deleted)):
+        for model in (Actor, Movie, Casting):
+            rows = [{c.key: getattr(obj, c.key) for c in model.__table__.c}
+                    for obj in objects if isinstance(obj, model)]
+            deltas.update(row_deltas(model, rows, sign))
+    changes = []
+    for obj in session.dirty:
+        if isinstance(obj, Movie) and obj not in session.deleted:
+            added, _, deleted = attributes.get_history(obj, 'release_date')
+            if added and deleted:
+                changes.append((deleted[0], added[0]))
+    deltas.update(release_date_deltas(changes))
+    count_stats(deltas)
+
+
+def refresh_stats():
+    """Rebuilds every summary counter from the tables and commits"""
+    if db.session.bind.dialect.name == 'postgresql':
+        # writers wait for the rebuild instead of adding to counters
+        # it is about to replace
+        db.session.execute(
+            'LOCK TABLE "StatCounter" IN SHARE ROW EXCLUSIVE MODE')
+    db.session.query(StatCounter).delete(synchronize_session=False)
+    year = cast(func.extract('year', Movie.release_date), Integer)
+    aggregates = [
+        select([literal('actors'), literal(0), func.count()])
+        .select_from(Actor.__table__),
+        select([literal('movies'), literal(0), func.count()])
+        .select_from(Movie.__table__),
+        select([literal('castings'), literal(0), func.count()])
+        .select_from(Casting.__table__),
+        select([literal('movies_per_year'), year, func.count()])
+        .group_by(year),
+        select([literal('actor_movies'), Casting.actor_id, func.count()])
+        .group_by(Casting.actor_id),
+        select([literal('movie_actors'), Casting.movie_id, func.count()])
+        .group_by(Casting.movie_id)]
+    for aggregate in aggregates:
+        db.session.execute(StatCounter.__table__.insert().from_select(
+            ['metric', 'key', 'value'], aggregate))
+    db.session.commit()
+
+
+def init_stats():
+    """Builds the summary counters of a database that has none yet"""
+    if db.session.query(StatCounter.metric).first() is None:
+        refresh_stats()
@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get(
+    'DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+
+
+'''
+Connection pool
+Engine options read from the environment and a QueuePool counting
+how often, and for how long, a request had to wait for a connection
+'''
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool keeping checkout and wait counters.
+    A checkout waits when every pooled connection is in use and the
+    overflow is exhausted; the counters restart when the pool is
+    recreated after a disconnect.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self._stats_lock = threading.Lock()
+        self._nested = threading.local()
+
+    def _do_get(self):
+        # QueuePool._do_get calls itself again when it loses a race,
+        # only the outermost call is counted
+        if getattr(self._nested, 'active', False):
+            return super()._do_get()
+        self._nested.active = True
+        will_wait = self._pool.empty() and self._max_overflow > -1 \
+            and self._overflow >= self._max_overflow
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            self._nested.active = False
+            elapsed = time.monotonic() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                if will_wait:
+                    self.waits += 1
+                    self.wait_seconds += elapsed
+                    self.max_wait_seconds = max(
+                        self.max_wait_seconds, elapsed)
+
+
+def engine_options(database_path, **overrides):
+    """Returns the SQLALCHEMY_ENGINE_OPTIONS for the database
+    Keyword arguments:
+    database_path: database url
+    overrides: engine options replacing the ones read from the environment
+    """
+    options = {'pool_pre_ping': DB_POOL_PRE_PING,
+               'pool_recycle': DB_POOL_RECYCLE}
+    if not database_path.startswith('sqlite'):
+        # sqlite gets a NullPool or a SingletonThreadPool which
+        # do not take a size
+        options.update({
+            'poolclass': InstrumentedQueuePool,
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT})
+    if DB_STATEMENT_TIMEOUT and database_path.startswith('postgres'):
+        options['connect_args'] = {
+            'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'}
+    options.update(overrides)
+    return options
+
+
+def pool_stats(pool):
+    """Returns the state and the counters of the connection pool as a dict"""
+    stats = {'pool': type(pool).__name__, 'pid': os.getpid()}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'max_overflow': pool._max_overflow,
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0)})
+    if isinstance(pool, InstrumentedQueuePool):
+        with pool._stats_lock:
+            stats.update({
+                'checkouts': pool.checkouts,
+                'waits': pool.waits,
+                'wait_seconds': round(pool.wait_seconds, 6),
+                'max_wait_seconds': round(pool.max_wait_seconds, 6),
+                'timeouts': pool.timeouts})
+    return stats
@@ -0,0 +1,104 @@
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from flask import request, abort
+
+
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', 30))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 10))
+
+
+'''
+Sampling profiler
+Reads the stack of every other thread of the worker with
+sys._current_frames() at a fixed interval and counts the identical
+stacks, written as collapsed stacks ("outer;inner count" lines) that
+flamegraph.pl and speedscope read as is. Only one profile runs per
+worker at a time.
+'''
+
+profiling = threading.Lock()
+
+
+class SamplingProfiler:
+    """Collapsed stack counts of the threads of the process, the thread
+    running the profiler excluded
+    Keyword arguments:
+    interval: seconds between two samples
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._labels = {}
+
+    def label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = \
+                f'{code.co_name} ({os.path.basename(code.co_filename)}' \
+                f':{code.co_firstlineno})'
+        return label
+
+    def sample(self, ignored):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id in ignored:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self.label(frame.f_code))
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[';'.join(stack)] += 1
+        self.samples += 1
+
+    def run(self, seconds):
+        """Samples the other threads for seconds, in the calling thread"""
+        ignored = {threading.get_ident()}
+        next_sample = time.monotonic()
+        deadline = next_sample + seconds
+        while next_sample < deadline:
+            self.sample(ignored)
+            next_sample += self.interval
+            time.sleep(max(next_sample - time.monotonic(), 0))
+
+    def collapsed(self):
+        """Returns the collapsed stacks, most sampled first"""
+        return ''.join(f'{stack} {count}\n'
+                       for stack, count in self.stacks.most_common())
+
+
+def profile_args():
+    """Returns the (seconds, interval) of the profile requested with
+    ?seconds= (default 10, at most PROFILE_MAX_SECONDS) and
+    ?interval_ms= (default PROFILE_INTERVAL_MS, at least 1),
+    aborts with 400 when they are not finite or out of range
+    """
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval_ms = float(request.args.get('interval_ms',
+                                             PROFILE_INTERVAL_MS))
+    except ValueError:
+        abort(400)
+    if not math.isfinite(seconds) or not math.isfinite(interval_ms):
+        abort(400)
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or interval_ms < 1:
+        abort(400)
+    return seconds, interval_ms / 1000
+
+
+def profile(seconds, interval):
+    """Returns the SamplingProfiler of the worker profiled for seconds,
+    None when another profile is already running"""
+    if not profiling.acquire(blocking=False):
+        return None
+    try:
+        profiler = SamplingProfiler(interval)
+        profiler.run(seconds)
+        return profiler
+    finally:
+        profiling.release()
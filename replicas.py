@@ -0,0 +1,186 @@
+import itertools
+import os
+import threading
+import time
+from functools import wraps
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql.expression import Select, CompoundSelect
+from pool import engine_options, pool_stats
+
+
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 30))
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 10))
+REPLICA_CONNECT_TIMEOUT = int(os.environ.get('REPLICA_CONNECT_TIMEOUT', 2))
+
+
+'''
+Read replicas
+Views marked read_only send their SELECTs to one of the replicas
+configured in DATABASE_REPLICA_URLS, picked round-robin among the
+healthy ones whose replication lag is under REPLICA_MAX_LAG seconds.
+Writes, and every query following a write in the same request,
+go to the primary.
+'''
+
+
+# lag of a streaming replica, 0 when it replayed everything it received
+PG_LAG_QUERY = (
+    'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() '
+    'THEN 0 ELSE COALESCE(EXTRACT(EPOCH FROM '
+    'now() - pg_last_xact_replay_timestamp()), 0) END')
+
+
+class Replica:
+    """Engine of one replica with its health and lag, checked at most
+    once per check_interval seconds in a background thread. Requests
+    read the result of the last check and never wait for one; the
+    replica is not used before its first check succeeded
+    Keyword arguments:
+    url: database url of the replica
+    check_interval: seconds between two health checks
+    """
+
+    def __init__(self, url, check_interval=REPLICA_CHECK_INTERVAL):
+        options = engine_options(url)
+        if url.startswith('postgres'):
+            # the health check runs in a request thread, an unreachable
+            # replica must not hold it for the whole TCP timeout
+            options['connect_args'] = dict(
+                options.get('connect_args', {}),
+                connect_timeout=REPLICA_CONNECT_TIMEOUT)
+        self.engine = create_engine(url, **options)
+        self.check_interval = check_interval
+        self.healthy = False
+        self.lag = 0.0
+        self.checked_at = None
+        self._lock = threading.Lock()
+        event.listen(self.engine, 'handle_error', self.on_error)
+
+    def on_error(self, context):
+        if context.is_disconnect:
+            self.healthy = False
+            self.checked_at = time.monotonic()
+
+    def check(self):
+        """Runs the health check, unless another thread is running it"""
+        if not self._lock.acquire(blocking=False):
+            return
+        self._run_check()
+
+    def refresh(self):
+        """Starts the health check in a background thread,
+        unless another thread is running it"""
+        if not self._lock.acquire(blocking=False):
+            return
+        threading.Thread(target=self._run_check, daemon=True).start()
+
+    def _run_check(self):
+        """Runs the health check and releases the lock the caller holds"""
+        try:
+            with self.engine.connect() as connection:
+                if self.engine.dialect.name == 'postgresql':
+                    self.lag = float(connection.scalar(PG_LAG_QUERY))
+                else:
+                    connection.scalar('SELECT 1')
+            self.healthy = True
+        except SQLAlchemyError:
+            self.healthy = False
+        finally:
+            self.checked_at = time.monotonic()
+            self._lock.release()
+
+    def is_usable(self, max_lag):
+        """Returns True when the replica was up and at most max_lag
+        seconds behind the primary (any lag when max_lag is 0) at its
+        last check, refreshing a check older than check_interval"""
+        if self.checked_at is None or \
+                time.monotonic() - self.checked_at >= self.check_interval:
+            self.refresh()
+        return self.healthy and (not max_lag or self.lag <= max_lag)
+
+    def stats(self):
+        return {
+            'host': self.engine.url.host,
+            'database': self.engine.url.database,
+            'healthy': self.healthy,
+            'lag_seconds': self.lag,
+            'pool': pool_stats(self.engine.pool)}
+
+
+class ReplicaSet:
+    """Round-robin over the usable replicas
+    Keyword arguments:
+    urls: database urls of the replicas
+    max_lag: maximum replication lag in seconds, 0 for no limit
+    check_interval: seconds between two health checks of a replica
+    """
+
+    def __init__(self, urls, max_lag=REPLICA_MAX_LAG,
+                 check_interval=REPLICA_CHECK_INTERVAL):
+        self.replicas = [Replica(url, check_interval) for url in urls]
+        self.max_lag = max_lag
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def choose(self):
+        """Returns the engine of the next usable replica,
+        None when every replica is down or lagging"""
+        with self._lock:
+            start = next(self._turn)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if replica.is_usable(self.max_lag):
+                return replica.engine
+        return None
+
+    def stats(self):
+        return [replica.stats() for replica in self.replicas]
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+
+def read_only(f):
+    """Marks a view whose queries may be answered by a replica"""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        g.read_only = True
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def is_read(clause):
+    return isinstance(clause, (Select, CompoundSelect))
+
+
+class RoutingSession(SignallingSession):
+    """Session sending the SELECTs of read_only views to a replica,
+    the same one for the whole request, and everything else to the
+    primary. Once a request flushed or ran a write statement its
+    following reads stay on the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if not has_app_context():
+            return super().get_bind(mapper, clause)
+        if self._flushing or (clause is not None and not is_read(clause)):
+            g.wrote_primary = True
+            return super().get_bind(mapper, clause)
+        replicas = self.app.extensions.get('replicas')
+        if replicas is None or clause is None or not g.get('read_only') \
+                or g.get('wrote_primary'):
+            return super().get_bind(mapper, clause)
+        if 'replica' not in g:
+            g.replica = replicas.choose()
+        return g.replica or super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension whose sessions are RoutingSessions"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,164 @@
+import threading
+from array import array
+from flask import request, abort
+from sqlalchemy import func, or_
+from models import db, table_versions, Actor, Movie
+from filters import contains_clause
+from listing import decode_cursor, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+
+
+'''
+Search
+Ranked substring search over a text column. PostgreSQL answers from the
+pg_trgm GIN index of the column (matching typos too, ranked by word
+similarity); other databases use an in-memory TrigramIndex rebuilt when
+the version of the table changes.
+'''
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TrigramIndex:
+    """Maps every trigram of the lowercased texts to the compact array of
+    the positions of the texts containing it, so a substring query only
+    checks the texts sharing its two rarest trigrams. Texts are
+    numbered shortest first, so walking a posting in order meets the
+    best matches first and can stop after the requested page
+    Keyword arguments:
+    rows: iterable of (id, text) tuples
+    """
+
+    def __init__(self, rows):
+        rows = sorted(((text.lower(), id) for id, text in rows),
+                      key=lambda row: (len(row[0]), row[1]))
+        self.ids = array('i', [id for _, id in rows])
+        self.texts = [text for text, _ in rows]
+        self.postings = {}
+        for position, text in enumerate(self.texts):
+            for trigram in trigrams(text):
+                posting = self.postings.get(trigram)
+                if posting is None:
+                    posting = self.postings[trigram] = array('i')
+                posting.append(position)
+
+    def search(self, q, limit):
+        """Returns the ids of the first limit texts containing q,
+        shortest texts first. Queries shorter than a trigram, allowed
+        when SEARCH_MIN_LENGTH is under 3, check every text
+        """
+        q = q.lower()
+        postings = [self.postings.get(t) for t in trigrams(q)]
+        if not postings:
+            candidates = range(len(self.texts))
+        elif not all(postings):
+            return []
+        else:
+            postings.sort(key=len)
+            candidates = postings[0]
+        if len(candidates) > 1000 and len(postings) > 1:
+            # set intersections run in C, cheaper than checking every text
+            candidates = sorted(set(candidates).intersection(postings[1]))
+        matches = []
+        for position in candidates:
+            if q in self.texts[position]:
+                matches.append(self.ids[position])
+                if len(matches) == limit:
+                    break
+        return matches
+
+
+class FallbackIndexes:
+    """TrigramIndex of each searched column, rebuilt on first use after
+    a write bumped the version of its table"""
+
+    def __init__(self):
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def get(self, model, column):
+        table = model.__tablename__
+        version = table_versions(table).get(table, (0,))[0]
+        entry = self._indexes.get(column.key, (None, None))
+        if entry[0] != version:
+            with self._lock:
+                entry = self._indexes.get(column.key, (None, None))
+                if entry[0] != version:
+                    rows = db.session.query(model.id, column) \
+                        .yield_per(10000)
+                    entry = (version, TrigramIndex(rows))
+                    self._indexes[column.key] = entry
+        return entry[1]
+
+
+fallback_indexes = FallbackIndexes()
+
+
+def search_page(model, column, q, offset, limit):
+    """Returns the (items, next_offset) tuple for one page of the rows
+    whose column matches q, best match first, next_offset is None
+    on the last page
+    Keyword arguments:
+    model: Actor or Movie
+    column: text column searched
+    q: search text
+    offset: number of matches skipped
+    limit: page size
+    """
+    dialect = db.engine.dialect
+    if dialect.name == 'postgresql':
+        # word similarity over the threshold catches misspellings,
+        # the % of the operator is doubled for the psycopg2 paramstyle
+        similar = column.op(
+            '%%>' if dialect.paramstyle in ('format', 'pyformat') else '%>')
+        score = func.word_similarity(q, column)
+        items = model.query \
+            .filter(or_(contains_clause(column, q), similar(q))) \
+            .order_by(score.desc(), model.id) \
+            .offset(offset).limit(limit + 1).all()
+    else:
+        ids = fallback_indexes.get(model, column) \
+            .search(q, offset + limit + 1)[offset:]
+        found = {item.id: item
+                 for item in model.query.filter(model.id.in_(ids))}
+        items = [found[id] for id in ids if id in found]
+    if len(items) <= limit:
+        return items, None
+    return items[:limit], offset + limit
+
+
+# searched column and permission needed, by result type
+SEARCHES = {
+    'actors': (Actor, Actor.name, 'get:actors'),
+    'movies': (Movie, Movie.title, 'get:movies')}
+
+
+def search_args(q):
+    """Returns the (limit, offsets) tuple of a search page, offsets
+    mapping each result type still to search to the number of results
+    already returned: the ?type= list (every type by default) at offset
+    0 on the first page, the types left in the ?cursor= on the next ones.
+    Aborts with 400 when the parameters are invalid
+    Keyword arguments:
+    q: search text, the cursor must have been returned for it
+    """
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        if 'cursor' in request.args:
+            cursor = decode_cursor(request.args['cursor'])
+            if cursor.get('q') != q:
+                raise ValueError('cursor of another search')
+            offsets = {name: int(offset)
+                       for name, offset in cursor['offsets'].items()}
+        else:
+            offsets = dict.fromkeys(
+                request.args.get('type', ','.join(SEARCHES)).split(','), 0)
+        if not set(offsets) <= set(SEARCHES) or \
+                any(offset < 0 for offset in offsets.values()):
+            raise ValueError('unknown result type')
+    except (ValueError, KeyError, TypeError, AttributeError):
+        abort(400)
+    if limit < 1:
+        abort(400)
+    return min(limit, MAX_PAGE_SIZE), offsets
@@ -0,0 +1,60 @@
+import datetime
+import json
+from flask import current_app
+from metrics import timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+'''
+Serialization
+Responses are encoded with orjson when it is installed and with the
+standard json module otherwise; both write dates as YYYY-MM-DD.
+Listings select plain column tuples instead of ORM instances and turn
+them into dicts with a single zip per row, skipping Model.format()
+'''
+
+
+def encode_default(value):
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+_encoder = json.JSONEncoder(separators=(',', ':'), default=encode_default)
+
+
+def dumps(value):
+    """Returns the JSON encoding of value as bytes"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return _encoder.encode(value).encode()
+
+
+def json_response(value):
+    """Returns an application/json response of value,
+    the faster replacement of flask.jsonify"""
+    with timed('serialize'):
+        body = dumps(value)
+    return current_app.response_class(body, mimetype='application/json')
+
+
+def model_columns(model):
+    """Returns the mapped columns of the model, in table order"""
+    return [getattr(model, column.key) for column in model.__table__.columns]
+
+
+def records(rows, columns):
+    """Returns the list of dicts of the row tuples, keyed by column name
+    Keyword arguments:
+    rows: tuples of column values, as returned by
+    query.with_entities(*columns)
+    columns: columns of the dicts, the first ones selected by the query,
+    values selected after them are left out
+    """
+    names = [column.key for column in columns]
+    with timed('serialize'):
+        return [dict(zip(names, row)) for row in rows]
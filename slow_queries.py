@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from flask import request, has_request_context
+from sqlalchemy import event
+
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 0))
+SLOW_QUERY_SAMPLE = float(os.environ.get('SLOW_QUERY_SAMPLE', 1))
+SLOW_QUERY_EXPLAIN_SAMPLE = float(
+    os.environ.get('SLOW_QUERY_EXPLAIN_SAMPLE', 0))
+SLOW_QUERY_MAX_PER_MINUTE = int(
+    os.environ.get('SLOW_QUERY_MAX_PER_MINUTE', 60))
+SLOW_QUERY_PARAMS_LENGTH = int(os.environ.get('SLOW_QUERY_PARAMS_LENGTH', 1000))
+
+logger = logging.getLogger('slow_queries')
+
+
+'''
+Slow query log
+Statements running longer than SLOW_QUERY_MS (0 disables the log) are
+logged as one json line with their bound parameters and the route that
+ran them. A SLOW_QUERY_SAMPLE fraction of the slow statements is kept,
+at most SLOW_QUERY_MAX_PER_MINUTE per worker, and on PostgreSQL a
+SLOW_QUERY_EXPLAIN_SAMPLE fraction of the logged SELECTs is run again
+under EXPLAIN (ANALYZE, BUFFERS) to log the plan with them.
+'''
+
+
+class SlowQueryLog:
+    """Cursor event listeners logging the slow statements of the
+    engines they watch
+    Keyword arguments:
+    threshold_ms: duration from which a statement is slow
+    sample: fraction of the slow statements logged
+    explain_sample: fraction of the logged PostgreSQL SELECTs explained
+    max_per_minute: cap on the statements logged per minute
+    """
+
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, sample=SLOW_QUERY_SAMPLE,
+                 explain_sample=SLOW_QUERY_EXPLAIN_SAMPLE,
+                 max_per_minute=SLOW_QUERY_MAX_PER_MINUTE):
+        self.threshold_ms = threshold_ms
+        self.sample = sample
+        self.explain_sample = explain_sample
+        self.max_per_minute = max_per_minute
+        self.logged = 0
+        self.dropped = 0
+        self._minute = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def watch(self, engine):
+        """Starts logging the slow statements of the engine"""
+        if not event.contains(engine, 'after_cursor_execute', self.after):
+            event.listen(engine, 'before_cursor_execute', self.before)
+            event.listen(engine, 'after_cursor_execute', self.after)
+
+    def before(self, conn, cursor, statement, parameters, context,
+               executemany):
+        if context is not None:
+            context.slow_query_started = time.perf_counter()
+
+    def after(self, conn, cursor, statement, parameters, context,
+              executemany):
+        started = getattr(context, 'slow_query_started', None)
+        if started is None:
+            return
+        duration_ms = (time.perf_counter() - started) * 1000
+        if duration_ms < self.threshold_ms or \
+                random.random() >= self.sample or not self._admit():
+            return
+        entry = {
+            'duration_ms': round(duration_ms, 3),
+            'statement': statement,
+            'parameters': repr(parameters)[:SLOW_QUERY_PARAMS_LENGTH],
+            'executemany': executemany,
+            'database': repr(conn.engine.url)}
+        if has_request_context():
+            entry['method'] = request.method
+            entry['route'] = request.url_rule.rule \
+                if request.url_rule else request.path
+        if conn.dialect.name == 'postgresql' and not executemany and \
+                statement.lstrip()[:6].upper() == 'SELECT' and \
+                random.random() < self.explain_sample:
+            entry['plan'] = self.explain(conn, statement, parameters)
+        logger.warning(json.dumps(entry, default=str))
+
+    def _admit(self):
+        """Returns False once max_per_minute statements were logged
+        in the current minute"""
+        minute = int(time.monotonic() // 60)
+        with self._lock:
+            if minute != self._minute:
+                self._minute = minute
+                self._count = 0
+            if self._count >= self.max_per_minute:
+                self.dropped += 1
+                return False
+            self._count += 1
+            self.logged += 1
+            return True
+
+    def explain(self, conn, statement, parameters):
+        """Returns the plan lines of the statement run again under
+        EXPLAIN (ANALYZE, BUFFERS), or the error preventing it.
+        Runs on a raw cursor inside a savepoint, so that neither the
+        cursor events nor a failure reach the transaction of the request
+        """
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute('SAVEPOINT slow_query_explain')
+            try:
+                cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + statement,
+                               parameters)
+                plan = [row[0] for row in cursor.fetchall()]
+                cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+                return plan
+            except Exception as error:
+                cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+                return [f'EXPLAIN failed: {error}']
+        finally:
+            cursor.close()
+
+
+slow_query_log = SlowQueryLog()
@@ -0,0 +1,70 @@
+import os
+from flask import abort
+from models import db, StatCounter, Actor, Movie
+from filters import int_arg
+from listing import MAX_PAGE_SIZE
+
+
+STATS_TOP = int(os.environ.get('STATS_TOP', 10))
+
+
+'''
+Stats
+Reports read from the summary counters of models.StatCounter, a handful
+of primary key and index lookups whatever the size of the tables
+'''
+
+
+def top_arg():
+    """Returns the ?top= length of the rankings, STATS_TOP by default,
+    aborts with 400 when it is not a positive integer
+    """
+    top = int_arg('top')
+    if top is None:
+        return STATS_TOP
+    if top < 1:
+        abort(400)
+    return min(top, MAX_PAGE_SIZE)
+
+
+def average(total, count):
+    return round(total / count, 2) if count else None
+
+
+def ranking(metric, model, label, top):
+    """Returns the (id, label, value) tuples of the top highest counters
+    of metric, keyed by ids of model, ties by id"""
+    return db.session.query(StatCounter.key, label, StatCounter.value) \
+        .join(model, model.id == StatCounter.key) \
+        .filter(StatCounter.metric == metric) \
+        .order_by(StatCounter.value.desc(), StatCounter.key) \
+        .limit(top).all()
+
+
+def stats_report(top):
+    """Returns the dict of the table counts, average cast and
+    filmography sizes, movies per year and the top rankings of
+    the actors with most movies and of the movies with most actors
+    Keyword arguments:
+    top: length of the rankings
+    """
+    counts = dict.fromkeys(('actors', 'movies', 'castings'), 0)
+    counts.update(db.session.query(StatCounter.metric, StatCounter.value)
+                  .filter(StatCounter.metric.in_(counts),
+                          StatCounter.key == 0))
+    years = db.session.query(StatCounter.key, StatCounter.value) \
+        .filter(StatCounter.metric == 'movies_per_year') \
+        .order_by(StatCounter.key)
+    return {
+        'counts': counts,
+        'average_cast_size': average(counts['castings'], counts['movies']),
+        'average_filmography_size':
+            average(counts['castings'], counts['actors']),
+        'movies_per_year': [{'year': year, 'movies': movies}
+                            for year, movies in years],
+        'top_actors': [
+            {'id': id, 'name': name, 'movies': movies} for id, name, movies
+            in ranking('actor_movies', Actor, Actor.name, top)],
+        'largest_casts': [
+            {'id': id, 'title': title, 'actors': actors} for id, title, actors
+            in ranking('movie_actors', Movie, Movie.title, top)]}
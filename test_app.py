@@ -1,9 +1,22 @@
 import os
+import tempfile
+import threading
 import unittest
 import json
+from unittest import mock
+from flask import Flask, g
 from flask_sqlalchemy import SQLAlchemy
 from app import create_app
-from models import setup_db, Actor, Movie, Casting
+from models import setup_db, db, Actor, Movie, Casting
+from jwks import JWKSKeyStore, FileKeySource, parse_max_age
+from auth import token_cache
+from cache import LRUCache
+from metrics import exposition
+from bulk import insert_new_castings
+from profiler import profile_args
+from replicas import Replica
+from search import TrigramIndex
+from werkzeug.exceptions import BadRequest
 import datetime
 
 JWT_PRODUCER = os.environ['JWT_PRODUCER']
@@ -78,6 +91,118 @@ class CastingAgencyAPITestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['actors']))
 
+    def test_get_actors_page(self):
+        """Pass GET/actors one page at a time"""
+        res = self.client().get('/actors?limit=1', headers=self.headers_producer)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertTrue(data['next_cursor'])
+
+        res = self.client().get('/actors?limit=1&cursor=' + data['next_cursor'],
+                                headers=self.headers_producer)
+        next_data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(next_data['actors'][0]['id'], data['actors'][0]['id'])
+
+    def test_get_actors_filtered_and_sorted(self):
+        """Pass GET/actors filtered by age, oldest first"""
+        res = self.client().get('/actors?max_age=60&sort=-age,name',
+                                headers=self.headers_producer)
+        data = json.loads(res.data)
+        ages = [actor['age'] for actor in data['actors']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(all(age <= 60 for age in ages))
+        self.assertEqual(ages, sorted(ages, reverse=True))
+
+    def test_400_unknown_sort_column_requesting_movies(self):
+        """Fail GET/movies sorted by a column that is not sortable"""
+        res = self.client().get('/movies?sort=budget',
+                                headers=self.headers_producer)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_actors_with_fields(self):
+        """Pass GET/actors returning only the requested columns"""
+        res = self.client().get('/actors?fields=name&sort=-age',
+                                headers=self.headers_producer)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(data['actors']))
+        for actor in data['actors']:
+            self.assertEqual(set(actor), {'id', 'name'})
+
+    def test_400_unknown_field_requesting_movies(self):
+        """Fail GET/movies projected on a column movies don't have"""
+        res = self.client().get('/movies?fields=title,budget',
+                                headers=self.headers_producer)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_search_actors_and_movies(self):
+        """Pass GET/search by part of a name"""
+        res = self.client().get('/search?q=theron',
+                                headers=self.headers_producer)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIn(3, [a['id'] for a in data['actors']])
+        self.assertEqual(data['movies'], [])
+
+    def test_trigram_index_short_query(self):
+        """Pass queries shorter than a trigram matched by substring"""
+        index = TrigramIndex([(1, 'Al Pacino'), (2, 'Keanu Reeves'),
+                              (3, 'Charlize Theron')])
+
+        self.assertEqual(index.search('e', 10), [2, 3])
+        self.assertEqual(index.search('x', 10), [])
+        self.assertEqual(index.search('eev', 10), [2])
+
+    def test_400_search_query_too_short(self):
+        """Fail GET/search with a one letter query"""
+        res = self.client().get('/search?q=a', headers=self.headers_producer)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_stream_actors(self):
+        """Pass GET/actors streamed as NDJSON"""
+        res = self.client().get('/actors?stream=1', headers=self.headers_producer)
+        rows = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(len(rows))
+        self.assertTrue(all('name' in row for row in rows))
+
+    def test_400_invalid_page_limit_requesting_actors(self):
+        """Fail GET/actors with a non positive page size"""
+        res = self.client().get('/actors?limit=0', headers=self.headers_producer)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad request')
+
+    def test_400_adding_existing_cast(self):
+        """Fail POST/cast with a pair already cast"""
+        res = self.client().post('/cast', json={'actor_id': 1, 'movie_id': 1},
+                                 headers=self.headers_producer)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
     def test_404_requesting_actors(self):
         """Fail GET/actors with malformed endpoint url"""
         res = self.client().get('/actors', headers={})
@@ -105,6 +230,26 @@ class CastingAgencyAPITestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Resource not found')
 
+    def test_get_actors_movies(self):
+        """Pass GET/actors/movies for several actors"""
+        res = self.client().get('/actors/movies?ids=1,2,9999',
+                                headers=self.headers_director)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([a['actor_id'] for a in data['actors']], [1, 2])
+        self.assertEqual(data['not_found'], [9999])
+
+    def test_400_if_no_ids_provided_requesting_actors_movies(self):
+        """Fail GET/actors/movies without ids"""
+        res = self.client().get('/actors/movies', headers=self.headers_director)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Bad request')
+
     def test_add_new_actor(self):
         """Pass POST/actors to create a new actor"""
         res = self.client().post('/actors', json=self.new_actor,
@@ -144,6 +289,56 @@ class CastingAgencyAPITestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Resource not found')
 
+    def test_patch_actor_invalidates_cached_actors(self):
+        """Pass GET/actors after PATCH/actors/<id> returns the update"""
+        self.client().get('/actors', headers=self.headers_producer)
+        res = self.client().get('/actors', headers=self.headers_producer)
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+
+        self.client().patch('/actors/1', json=self.update_actor,
+                            headers=self.headers_producer)
+        res = self.client().get('/actors?limit=1000', headers=self.headers_producer)
+        data = json.loads(res.data)
+        actor = [a for a in data['actors'] if a['id'] == 1][0]
+
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(actor['name'], self.update_actor['name'])
+
+    def test_post_actor_invalidates_cached_not_found(self):
+        """Pass GET/actors/movies finding an actor created after a cached
+        response listed its id as not found"""
+        res = self.client().post('/actors', json=self.new_actor,
+                                 headers=self.headers_producer)
+        next_id = json.loads(res.data)['actor']['id'] + 1
+        url = f'/actors/movies?ids={next_id}'
+        self.client().get(url, headers=self.headers_producer)
+        res = self.client().get(url, headers=self.headers_producer)
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+        self.assertEqual(json.loads(res.data)['not_found'], [next_id])
+
+        res = self.client().post('/actors', json=self.new_actor,
+                                 headers=self.headers_producer)
+        self.assertEqual(json.loads(res.data)['actor']['id'], next_id)
+        res = self.client().get(url, headers=self.headers_producer)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(data['not_found'], [])
+
+    def test_stream_actors_after_cached_page(self):
+        """Pass GET/actors as NDJSON when the JSON page is cached"""
+        for _ in range(2):
+            res = self.client().get('/actors?limit=2',
+                                    headers=self.headers_producer)
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+
+        res = self.client().get('/actors?limit=2', headers=dict(
+            self.headers_producer, Accept='application/x-ndjson'))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertNotIn('X-Cache', res.headers)
+
     def test_delete_actor(self):
         """Pass DELETE/actors/<id> to delete an actor"""
         res = self.client().delete('/actors/4', headers=self.headers_producer)
@@ -176,6 +371,68 @@ class CastingAgencyAPITestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['movies']))
 
+    def test_304_requesting_unchanged_movies(self):
+        """Pass GET/movies with the ETag of the previous response"""
+        res = self.client().get('/movies', headers=self.headers_assistant)
+        etag = res.headers['ETag']
+
+        res = self.client().get('/movies', headers=dict(
+            self.headers_assistant, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_write_by_another_worker_misses_cached_response(self):
+        """Pass GET/actors on one app instance returning the update made
+        through another one, under the ETag the other one answers 304"""
+        other = create_app()
+        setup_db(other, self.database_path)
+        url = '/actors?limit=1000'
+        for _ in range(2):
+            res = self.client().get(url, headers=self.headers_producer)
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+
+        other.test_client().patch('/actors/2', json={'age': 56},
+                                  headers=self.headers_producer)
+        res = self.client().get(url, headers=self.headers_producer)
+        actor = [a for a in json.loads(res.data)['actors'] if a['id'] == 2][0]
+
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(actor['age'], 56)
+        res = other.test_client().get(url, headers=dict(
+            self.headers_producer, **{'If-None-Match': res.headers['ETag']}))
+        self.assertEqual(res.status_code, 304)
+
+    def test_no_last_modified_within_the_second_of_a_write(self):
+        """Pass If-Modified-Since ignored while a later write in the
+        same second could not move Last-Modified"""
+        res = self.client().patch('/actors/2', json={'age': 57},
+                                  headers=self.headers_producer)
+        self.assertEqual(res.status_code, 200)
+        future = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+
+        with mock.patch('conditional.datetime') as clock:
+            clock.datetime.utcnow.return_value = \
+                datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+            res = self.client().get('/actors', headers=dict(
+                self.headers_producer,
+                **{'If-Modified-Since': future.strftime(
+                    '%a, %d %b %Y %H:%M:%S GMT')}))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(res.last_modified)
+
+    def test_etag_varies_with_permissions(self):
+        """Pass GET/search with an ETag per permission set"""
+        etags = []
+        for headers in (self.headers_assistant, self.headers_producer):
+            res = self.client().get('/search?q=theron', headers=headers)
+            etags.append(res.headers['ETag'])
+            self.assertIn('Authorization', res.headers['Vary'])
+            self.assertIn('Accept', res.headers['Vary'])
+
+        self.assertNotEqual(etags[0], etags[1])
+
     def test_404_requesting_movies(self):
         """Fail GET/movies with malformed endpoint url"""
         res = self.client().get('/movies/', headers=self.headers_assistant)
@@ -203,6 +460,85 @@ class CastingAgencyAPITestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Resource not found')
 
+    def test_get_movies_actors(self):
+        """Pass POST/movies/actors for several movies"""
+        ids = []
+        for title in ('Heat', 'Insomnia'):
+            res = self.client().post('/movies', json={
+                'title': title, 'release_date': '1995-12-15'},
+                headers=self.headers_producer)
+            ids.append(json.loads(res.data)['movie']['id'])
+
+        res = self.client().post('/movies/actors', json={'ids': ids},
+                                 headers=self.headers_assistant)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([m['movie_id'] for m in data['movies']], ids)
+        self.assertEqual([m['movie'] for m in data['movies']],
+                         ['Heat', 'Insomnia'])
+
+    def test_get_actor_costars(self):
+        """Pass GET/actors/<id>/costars ranked by shared movies"""
+        res = self.client().get('/actors/2/costars',
+                                headers=self.headers_assistant)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIn(1, [actor['id'] for actor in data['costars']])
+
+    def test_get_actors_path(self):
+        """Pass GET/actors/<id>/path/<id> between two co-stars"""
+        res = self.client().get('/actors/1/path/3',
+                                headers=self.headers_assistant)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['degrees'], 1)
+        self.assertEqual([actor['id'] for actor in data['actors']], [1, 3])
+
+    def test_server_timing_header(self):
+        """Pass GET/actors with its timings in the Server-Timing header"""
+        res = self.client().get('/actors', headers=self.headers_producer)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('db;dur=', res.headers['Server-Timing'])
+        self.assertIn('total;dur=', res.headers['Server-Timing'])
+
+    def test_lru_cache_disabled_at_size_zero(self):
+        """Pass nothing stored nor evicted by a cache of maxsize 0"""
+        cache = LRUCache(maxsize=0)
+        cache.set('token', {'sub': 'a'})
+
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(cache.stats()['evictions'], 0)
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_metrics_exposition_counts_token_cache(self):
+        """Pass token cache hits exported in the Prometheus format"""
+        for _ in range(2):
+            self.client().get('/actors', headers=self.headers_producer)
+        hits = token_cache.stats()['hits']
+        text = exposition(token_cache=token_cache.stats())
+
+        self.assertGreater(hits, 0)
+        self.assertIn(f'auth_token_cache_hits_total {hits}', text)
+        self.assertIn('auth_token_cache_misses_total', text)
+
+    def test_get_stats(self):
+        """Pass GET/stats"""
+        res = self.client().get('/stats?top=1', headers=self.headers_assistant)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['counts']['movies'])
+        self.assertEqual(sum(year['movies'] for year in data['movies_per_year']),
+                         data['counts']['movies'])
+        self.assertTrue(len(data['top_actors']) <= 1)
+
     def test_add_new_movie(self):
         """Pass POST/movies to create a new movie"""
         res = self.client().post('/movies', json=self.new_movie,
@@ -223,6 +559,16 @@ class CastingAgencyAPITestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Bad request')
 
+    def test_400_invalid_release_date_to_add_new_movie(self):
+        """Fail POST/movies with a release date that is not YYYY-MM-DD"""
+        res = self.client().post('/movies', json={
+            'title': 'The Irishman', 'release_date': '11/27/2019'},
+            headers=self.headers_producer)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
     def test_patch_movie(self):
         """Pass PATCH/movies/<id> to update a movie"""
         res = self.client().patch('/movies/1', json=self.update_movie,
@@ -243,6 +589,17 @@ class CastingAgencyAPITestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Resource not found')
 
+    def test_400_invalid_release_date_to_update_movie(self):
+        """Fail PATCH/movies/<id> with a release date that is not
+        YYYY-MM-DD"""
+        res = self.client().patch('/movies/1',
+                                  json={'release_date': 'May 7, 2020'},
+                                  headers=self.headers_producer)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
     def test_delete_movie(self):
         """Pass DELETE/movies/<id> to delete a movie"""
         res = self.client().delete('/movies/2', headers=self.headers_producer)
@@ -293,6 +650,39 @@ class CastingAgencyAPITestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['cast'])
 
+    def test_add_new_cast_bulk(self):
+        """Pass POST/cast/bulk with new, existing and invalid pairs"""
+        res = self.client().post('/cast/bulk',
+                                 json=[self.new_cast, self.new_cast, {}],
+                                 headers=self.headers_producer)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['results']), 3)
+        self.assertEqual(data['results'][1]['status'], 'exists')
+        self.assertEqual(data['results'][2]['status'], 'invalid')
+
+    def test_insert_new_castings_skips_cast_pairs(self):
+        """Pass castings inserted without failing on pairs cast since
+        they were looked up, only the new pairs returned"""
+        with self.app.app_context():
+            new_ids = insert_new_castings(
+                [{'actor_id': 1, 'movie_id': 1},
+                 {'actor_id': 3, 'movie_id': 1}], 10)
+            self.assertEqual(new_ids, {})
+            db.session.rollback()
+
+    def test_403_updating_actors_bulk_by_assistant(self):
+        """Fail POST/actors/bulk by assistant role"""
+        res = self.client().post('/actors/bulk', json=[self.new_actor],
+                                 headers=self.headers_assistant)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Permission not found.')
+
     def test_400_if_no_body_parameters_provided_to_add_new_cast(self):
         """Fail POST/cast by sending empty json data"""
         res = self.client().post('/cast', json={}, headers=self.headers_producer)
@@ -343,6 +733,242 @@ class CastingAgencyAPITestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Permission not found.')
 
+    def test_403_requesting_metrics_by_producer(self):
+        """Fail GET/metrics by producer role"""
+        res = self.client().get('/metrics', headers=self.headers_producer)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['success'], False)
+
+    def test_403_requesting_profile_by_producer(self):
+        """Fail GET/_debug/profile by producer role"""
+        res = self.client().get('/_debug/profile?seconds=1',
+                                headers=self.headers_producer)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['success'], False)
+
+    def test_400_profile_args_not_finite(self):
+        """Fail profile arguments that are NaN or infinite"""
+        for query in ('interval_ms=nan', 'interval_ms=inf', 'seconds=nan',
+                      'seconds=inf'):
+            with self.app.test_request_context(f'/_debug/profile?{query}'):
+                with self.assertRaises(BadRequest):
+                    profile_args()
+
+    def test_403_requesting_pool_stats_by_producer(self):
+        """Fail GET/_debug/pool by producer role"""
+        res = self.client().get('/_debug/pool', headers=self.headers_producer)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['success'], False)
+
+
+class FakeKeySource:
+    """JWKS key source returning the queued (jwks, max_age) results
+    in turn, raising the queued exceptions, and counting its calls"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        result = self.results[min(self.calls, len(self.results)) - 1]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def jwks_of(*kids):
+    return {'keys': [{'kid': kid, 'kty': 'RSA', 'n': 'n', 'e': 'AQAB'}
+                     for kid in kids]}
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """This class represents the JWKS key store test case"""
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('jwks.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_keys_cached_for_max_age(self):
+        """Pass keys fetched once and kept for the advertised max-age"""
+        source = FakeKeySource((jwks_of('a'), 120))
+        store = JWKSKeyStore(source)
+
+        self.assertEqual(store.get_key('a')['kid'], 'a')
+        self.now += 119
+        self.assertEqual(store.get_key('a')['kid'], 'a')
+        self.assertEqual(source.calls, 1)
+        self.now += 2
+        store.get_key('a')
+        self.assertEqual(source.calls, 2)
+
+    def test_ttl_clamped_and_defaulted(self):
+        """Pass max-age clamped to [min_ttl, max_ttl], default_ttl
+        used when the source sets none"""
+        source = FakeKeySource((jwks_of('a'), 0))
+        store = JWKSKeyStore(source, min_ttl=30)
+        store.get_key('a')
+        self.now += 29
+        store.get_key('a')
+        self.assertEqual(source.calls, 1)
+
+        source = FakeKeySource((jwks_of('a'), 10 ** 6))
+        store = JWKSKeyStore(source, max_ttl=3600)
+        store.get_key('a')
+        self.now += 3601
+        store.get_key('a')
+        self.assertEqual(source.calls, 2)
+
+        source = FakeKeySource((jwks_of('a'), None))
+        store = JWKSKeyStore(source, default_ttl=600)
+        store.get_key('a')
+        self.now += 599
+        store.get_key('a')
+        self.assertEqual(source.calls, 1)
+
+    def test_unknown_kid_refreshes_at_most_every_min_ttl(self):
+        """Pass unknown kid refreshing the keys, once per min_ttl"""
+        source = FakeKeySource((jwks_of('a'), 600), (jwks_of('a', 'b'), 600))
+        store = JWKSKeyStore(source, min_ttl=30)
+        store.get_key('a')
+
+        self.now += 10
+        self.assertIsNone(store.get_key('b'))
+        self.assertIsNone(store.get_key('b'))
+        self.assertEqual(source.calls, 1)
+        self.now += 21
+        self.assertEqual(store.get_key('b')['kid'], 'b')
+        self.assertEqual(source.calls, 2)
+
+    def test_stale_keys_served_when_refresh_fails(self):
+        """Pass previous keys kept when the source fails,
+        retried after min_ttl"""
+        source = FakeKeySource((jwks_of('a'), 60), OSError('unreachable'))
+        store = JWKSKeyStore(source, min_ttl=30)
+        store.get_key('a')
+
+        self.now += 61
+        self.assertEqual(store.get_key('a')['kid'], 'a')
+        self.assertEqual(source.calls, 2)
+        self.now += 29
+        self.assertEqual(store.get_key('a')['kid'], 'a')
+        self.assertEqual(source.calls, 2)
+        self.now += 2
+        store.get_key('a')
+        self.assertEqual(source.calls, 3)
+
+    def test_concurrent_refreshes_single_flight(self):
+        """Pass one source call for callers waiting on the same refresh"""
+        release = threading.Event()
+        calls = []
+
+        def slow_source():
+            calls.append(1)
+            release.wait(5)
+            return jwks_of('a'), 600
+
+        store = JWKSKeyStore(slow_source)
+        found = []
+        threads = [threading.Thread(target=lambda: found.append(
+            store.get_key('a'))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([key['kid'] for key in found], ['a'] * 5)
+
+    def test_set_source_drops_cached_keys(self):
+        """Pass keys read again from a new FileKeySource"""
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for kid in ('a', 'b'):
+                paths.append(os.path.join(directory, f'{kid}.json'))
+                with open(paths[-1], 'w') as jwks_file:
+                    json.dump(jwks_of(kid), jwks_file)
+            store = JWKSKeyStore(FileKeySource(paths[0]))
+            self.assertIsNotNone(store.get_key('a'))
+
+            store.set_source(FileKeySource(paths[1]))
+            self.assertIsNone(store.get_key('a'))
+            self.assertIsNotNone(store.get_key('b'))
+
+    def test_parse_max_age(self):
+        """Pass max-age read from Cache-Control"""
+        self.assertEqual(parse_max_age('public, max-age=300'), 300)
+        self.assertEqual(parse_max_age('s-maxage=10, max-age=60'), 60)
+        self.assertEqual(parse_max_age('no-store'), 0)
+        self.assertIsNone(parse_max_age('public'))
+        self.assertIsNone(parse_max_age(None))
+
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """This class represents the read replica routing test case,
+    with a SQLite file standing for the primary and one for the replica"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.app = Flask(__name__)
+        setup_db(self.app,
+                 'sqlite:///' + os.path.join(directory.name, 'primary.db'),
+                 ['sqlite:///' + os.path.join(directory.name, 'replica.db')])
+        self.addCleanup(self.app.extensions['replicas'].dispose)
+        self.addCleanup(db.get_engine(self.app).dispose)
+        self.app.extensions['replicas'].replicas[0].check()
+        replica = self.app.extensions['replicas'].replicas[0].engine
+        db.metadata.create_all(bind=replica)
+        with self.app.app_context():
+            db.session.add(Actor('On Primary', 40, 'female'))
+            db.session.commit()
+        replica.execute(Actor.__table__.insert().values(
+            name='On Replica', age=40, gender='male'))
+
+    def names(self):
+        return [actor.name for actor in Actor.query.order_by(Actor.id)]
+
+    def test_read_only_reads_from_replica(self):
+        """Pass SELECTs of a read_only request sent to the replica"""
+        with self.app.test_request_context():
+            g.read_only = True
+            self.assertEqual(self.names(), ['On Replica'])
+
+    def test_reads_after_write_stay_on_primary(self):
+        """Pass reads following a flush of the request sent to the primary"""
+        with self.app.test_request_context():
+            g.read_only = True
+            db.session.add(Actor('Written', 30, 'male'))
+            db.session.flush()
+            self.assertEqual(self.names(), ['On Primary', 'Written'])
+            db.session.rollback()
+
+    def test_health_check_runs_in_background(self):
+        """Pass a replica unused until its first health check, which
+        is started in a background thread instead of the request"""
+        replica = Replica('sqlite://')
+        self.addCleanup(replica.engine.dispose)
+        with mock.patch('replicas.threading.Thread') as thread:
+            self.assertFalse(replica.is_usable(0))
+            self.assertFalse(replica.is_usable(0))
+        thread.assert_called_once_with(target=replica._run_check, daemon=True)
+        thread.return_value.start.assert_called_once_with()
+
+    def test_reads_without_read_only_use_primary(self):
+        """Pass SELECTs of a request not marked read_only sent to the
+        primary"""
+        with self.app.test_request_context():
+            self.assertEqual(self.names(), ['On Primary'])
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
@@ -0,0 +1,285 @@
+import csv
+import datetime
+import io
+import json
+from models import db, Actor, Movie, Casting, bump_versions, refresh_stats
+
+
+'''
+Bulk import / export
+Moves the Actor, Movie and Casting tables to and from CSV or NDJSON
+files, with COPY on PostgreSQL and batched executemany elsewhere
+'''
+
+
+TABLES = {'actors': Actor, 'movies': Movie, 'cast': Casting}
+FORMATS = ('csv', 'ndjson')
+BATCH_SIZE = 10000
+
+
+def column_names(model):
+    return [column.name for column in model.__table__.columns]
+
+
+def is_postgresql():
+    return db.engine.dialect.name == 'postgresql'
+
+
+class IterFile(io.RawIOBase):
+    """Read-only file object over an iterator of strings,
+    used to feed generated CSV to COPY ... FROM STDIN
+    """
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk.encode()
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def ndjson_to_csv(lines, columns):
+    """Yields CSV lines (no header) for the NDJSON lines,
+    keeping only the given columns"""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    for line in lines:
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        writer.writerow(['' if row.get(c) is None else row[c]
+                         for c in columns])
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+
+
+def read_columns(model, header):
+    """Returns the columns named in the header,
+    raises ValueError on unknown columns"""
+    columns = list(header)
+    unknown = set(columns) - set(column_names(model))
+    if unknown:
+        raise ValueError(f'unknown columns: {", ".join(sorted(unknown))}')
+    return columns
+
+
+# Export
+
+
+def export_table(model, out, fmt='csv'):
+    """Writes every row of the model table to the text file out,
+    in id order, and returns the number of rows written
+    Keyword arguments:
+    model: Actor, Movie or Casting
+    out: writable text file
+    fmt: csv (with header) or ndjson
+    """
+    if is_postgresql():
+        return export_copy(model, out, fmt)
+    columns = column_names(model)
+    rows = db.session.query(*[getattr(model, c) for c in columns]) \
+        .order_by(model.id).yield_per(BATCH_SIZE)
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            out.write(json.dumps(dict(zip(columns, row)), default=str) + '\n')
+            count += 1
+    return count
+
+
+def export_copy(model, out, fmt):
+    table = model.__tablename__
+    columns = ', '.join(column_names(model))
+    select = f'SELECT {columns} FROM "{table}" ORDER BY id'
+    if fmt == 'csv':
+        sql = f'COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER true)'
+    else:
+        # CSV with control characters as quote and delimiter
+        # writes the json text of each row as is
+        sql = f'COPY (SELECT row_to_json(t) FROM ({select}) t) TO STDOUT ' \
+            "WITH (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')"
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.copy_expert(sql, out)
+        count = cursor.rowcount
+        connection.commit()
+        return count
+    finally:
+        connection.close()
+
+
+# Import
+
+
+def import_table(model, source, fmt='csv', replace=False):
+    """Loads the rows of the text file source into the model table in one
+    transaction and returns the (read, inserted) row counts.
+    Rows whose id already exists are skipped, as are castings referencing
+    a missing actor or movie and pairs already cast. Id sequences are
+    moved past the highest imported id.
+    Keyword arguments:
+    model: Actor, Movie or Casting
+    source: readable text file, CSV with a header row or NDJSON
+    fmt: csv or ndjson
+    replace: empty the table (and the castings referencing it) first,
+    in a transaction of its own
+    The summary counters are rebuilt afterwards.
+    """
+    if is_postgresql():
+        counts = import_copy(model, source, fmt, replace)
+    else:
+        counts = import_executemany(model, source, fmt, replace)
+    bump_versions(model.__tablename__)
+    db.session.commit()
+    refresh_stats()
+    return counts
+
+
+def empty_tables(models):
+    """Deletes every row of the model tables and of the castings
+    referencing them, in one transaction, and rebuilds the summary
+    counters"""
+    if is_postgresql():
+        tables = ', '.join(f'"{model.__tablename__}"' for model in models)
+        db.session.execute(f'TRUNCATE {tables} CASCADE')
+    else:
+        db.session.execute(Casting.__table__.delete())
+        for model in models:
+            db.session.execute(model.__table__.delete())
+    bump_versions('Casting', *[model.__tablename__ for model in models])
+    db.session.commit()
+    refresh_stats()
+
+
+def import_copy(model, source, fmt, replace):
+    table = model.__tablename__
+    if fmt == 'csv':
+        columns = read_columns(model, next(csv.reader([source.readline()])))
+        data = source
+    else:
+        columns = column_names(model)
+        data = IterFile(ndjson_to_csv(source, columns))
+    column_list = ', '.join(columns)
+    staged = ', '.join(f's.{c}' for c in columns)
+
+    if replace:
+        empty_tables([model])
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(
+            f'CREATE TEMP TABLE staging (LIKE "{table}" INCLUDING DEFAULTS) '
+            'ON COMMIT DROP')
+        cursor.copy_expert(
+            f'COPY staging ({column_list}) FROM STDIN WITH (FORMAT csv)', data)
+        read = cursor.rowcount
+        if model is Casting:
+            # drop orphans and pairs already cast instead of failing
+            # on the foreign keys
+            cursor.execute(
+                f'INSERT INTO "Casting" ({column_list}) '
+                f'SELECT DISTINCT ON (s.actor_id, s.movie_id) {staged} '
+                'FROM staging s '
+                'JOIN "Actor" a ON a.id = s.actor_id '
+                'JOIN "Movie" m ON m.id = s.movie_id '
+                'WHERE NOT EXISTS (SELECT 1 FROM "Casting" c '
+                'WHERE c.actor_id = s.actor_id AND c.movie_id = s.movie_id) '
+                'ORDER BY s.actor_id, s.movie_id '
+                'ON CONFLICT DO NOTHING')
+        else:
+            cursor.execute(
+                f'INSERT INTO "{table}" ({column_list}) '
+                f'SELECT {staged} FROM staging s ON CONFLICT (id) DO NOTHING')
+        inserted = cursor.rowcount
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+            f'COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM "{table}"')
+        connection.commit()
+        return read, inserted
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def import_executemany(model, source, fmt, replace):
+    if fmt == 'csv':
+        reader = csv.DictReader(source)
+        read_columns(model, reader.fieldnames or [])
+        rows = reader
+    else:
+        rows = (json.loads(line) for line in source if line.strip())
+
+    table = model.__table__
+    insert = table.insert().prefix_with('OR IGNORE', dialect='sqlite')
+    known = None
+    if model is Casting:
+        known = {
+            'actors': {r[0] for r in db.session.query(Actor.id)},
+            'movies': {r[0] for r in db.session.query(Movie.id)},
+            'pairs': set(db.session.query(Casting.actor_id, Casting.movie_id))}
+
+    if replace:
+        empty_tables([model])
+        if known is not None:
+            known['pairs'] = set()
+    read = inserted = 0
+    try:
+        batch = []
+        for row in rows:
+            read += 1
+            row = convert_row(model, row)
+            if known is not None:
+                pair = (row['actor_id'], row['movie_id'])
+                if pair[0] not in known['actors'] or \
+                        pair[1] not in known['movies'] or \
+                        pair in known['pairs']:
+                    continue
+                known['pairs'].add(pair)
+            batch.append(row)
+            if len(batch) >= BATCH_SIZE:
+                inserted += db.session.execute(insert, batch).rowcount
+                batch = []
+        if batch:
+            inserted += db.session.execute(insert, batch).rowcount
+        db.session.commit()
+        return read, inserted
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def convert_row(model, row):
+    """Returns the row with values converted to the column types"""
+    converted = {}
+    for column in model.__table__.columns:
+        value = row.get(column.name)
+        if value is None or value == '':
+            continue
+        python_type = column.type.python_type
+        if python_type is datetime.date and isinstance(value, str):
+            value = datetime.date.fromisoformat(value)
+        elif python_type is int:
+            value = int(value)
+        converted[column.name] = value
+    return converted